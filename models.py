@@ -99,8 +99,40 @@ class Quiz(db.Model):
         onupdate=db.func.now()
     )
     title = db.Column(db.String(250))
+    time_limit = db.Column(db.Integer)
+    content_hash = db.Column(db.String(40))
 
-    def __init__(self, canvas_id, course_id, title=None):
+    def __init__(self, canvas_id, course_id, title=None, time_limit=None, content_hash=None):
         self.canvas_id = canvas_id
         self.course_id = course_id
         self.title = title
+        self.time_limit = time_limit
+        self.content_hash = content_hash
+
+
+class AppliedExtension(db.Model):
+    """
+    The extra time last given to a user on a quiz in Canvas, so the
+    same extension isn't posted again.
+    """
+    __tablename__ = 'applied_extension'
+    id = db.Column(db.Integer, primary_key=True)
+    quiz_canvas_id = db.Column(db.Integer, nullable=False)
+    user_canvas_id = db.Column(db.Integer, nullable=False)
+    extra_time = db.Column(db.Integer)
+    # True if Canvas sent the extension back when it was posted.
+    verified = db.Column(db.Boolean, default=False)
+    applied_date = db.Column(
+        db.DateTime,
+        server_default=db.func.now(),
+        onupdate=db.func.now()
+    )
+    __table_args__ = (
+        db.UniqueConstraint('quiz_canvas_id', 'user_canvas_id'),
+    )
+
+    def __init__(self, quiz_canvas_id, user_canvas_id, extra_time=None, verified=False):
+        self.quiz_canvas_id = quiz_canvas_id
+        self.user_canvas_id = user_canvas_id
+        self.extra_time = extra_time
+        self.verified = verified
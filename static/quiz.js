@@ -8,6 +8,8 @@ var results_div = document.getElementById("results");
 var i = 0;
 var update_interval_id = null;
 var refresh_interval_id = null;
+// Groups of students added with a different percent, sent with the next submit.
+var pending_groups = [];
 
 $("#user_list_div").on("click", ".user", function(e) {
 	e.preventDefault();
@@ -66,6 +68,7 @@ $("#apply_now").on("click", function(e) {
 	$(update_status).show();
 	$("#update").hide();
 	$("#submit_button").hide();
+	$("#add_group_button").hide();
 	$("#close_button").prop("disabled", true);
 	$("#close_x").hide();
 
@@ -87,14 +90,26 @@ $("#go_button").on("click", function() {
 
 	modal_selected_user_list.innerHTML = "";
 	var num_selected_users = selected_user_list.children.length;
+	if ($("#selection_select").val()) {
+		num_selected_users = 0;
+	}
+	var has_selection = hasSelection();
 
-	if (num_selected_users === 0) {
+	if (!has_selection && pending_groups.length === 0) {
 		$("#submit_button").prop("disabled", true);
 	}
 	else {
 		$("#submit_button").show();
 		$("#submit_button").prop("disabled", false);
 	}
+	$("#add_group_button").prop("disabled", !has_selection);
+	showPendingGroups();
+
+	if ($("#selection_select").val()) {
+		var selection_li = $("<li></li>");
+		selection_li.text($("#selection_select option:selected").text());
+		$(modal_selected_user_list).append(selection_li);
+	}
 
 	for (i=0; i<num_selected_users; i++) {
 		var user_id = selected_user_list.children[i].getAttribute("data-user-id");
@@ -108,6 +123,12 @@ $("#go_button").on("click", function() {
 	}
 });
 
+$("#add_group_button").on("click", function(e) {
+	pending_groups.push(getSelectedGroup());
+	clearSelectedStudents();
+	$("#percent_input").val("");
+});
+
 $("#clear_button").on("click", function(e) {
 	clearSelectedStudents();
 });
@@ -119,6 +140,7 @@ $("#submit_button").on("click", function(e) {
 
 $("#go_modal").on("hidden.bs.modal", function(e) {
 	$("#percent_form").show();
+	$("#add_group_button").show();
 	$(update_status).hide();
 	$(results_div).hide();
 	$("#results_button").hide();
@@ -140,6 +162,7 @@ function clearSelectedStudents() {
 	while (selected_user_list.children.length > 0) {
 		selected_user_list.children[0].click();
 	}
+	$("#selection_select").val("");
 }
 
 function clearAlerts() {
@@ -158,9 +181,14 @@ function ajaxFilter(query, page, callback) {
 		if (xhttp.readyState == 4 && xhttp.status == 200) {
 			user_list_div.innerHTML = xhttp.responseText;
 		}
+		else if (xhttp.readyState == 4 && xhttp.status == 503) {
+			user_list_div.innerHTML = "<div id=\"user_list\"><p></p></div>";
+			$("#user_list p").text(xhttp.responseText);
+		}
 	};
 	xhttp.onload = callback;
 	xhttp.open("GET", filter_url+"?query=" + query + "&page=" + page, true);
+	xhttp.setRequestHeader("X-Requested-With", "XMLHttpRequest");
 	xhttp.send();
 }
 
@@ -181,19 +209,69 @@ function getPercent() {
 	}
 }
 
-function ajaxSend() {
+function hasSelection() {
+	return Boolean($("#selection_select").val()) || selected_user_list.children.length > 0;
+}
+
+function getSelectedGroup() {
+	// A section or every student is looked up server-side, so only its id is sent.
+	var selection = $("#selection_select").val();
+	if (selection) {
+		var selection_group = {
+			user_names: [$("#selection_select option:selected").text()],
+			percent: getPercent()
+		};
+		if (selection === "all") {
+			selection_group.all_students = true;
+		}
+		else {
+			selection_group.section_id = selection;
+		}
+		return selection_group;
+	}
 
 	var selected_users = selected_user_list.children;
 
-	var users_percent_obj = {
+	var group = {
 		user_ids: [],
+		user_names: [],
 		percent: getPercent()
 	};
 
 	for (i=0; i<selected_users.length; i++) {
-		var user_id = selected_users[i].getAttribute("data-user-id");
-		users_percent_obj.user_ids.push(user_id);
+		group.user_ids.push(selected_users[i].getAttribute("data-user-id"));
+		group.user_names.push($(selected_users[i]).text());
+	}
+	return group;
+}
+
+function showPendingGroups() {
+	var pending_list = $("#modal_pending_groups");
+	pending_list.empty();
+
+	for (i=0; i<pending_groups.length; i++) {
+		var new_li = $("<li></li>");
+		new_li.text(pending_groups[i].percent + "%: " + pending_groups[i].user_names.join(", "));
+		pending_list.append(new_li);
+	}
+	$("#pending_groups").toggle(pending_groups.length > 0);
+}
+
+function ajaxSend() {
+	var groups = pending_groups.slice();
+	if (hasSelection()) {
+		groups.push(getSelectedGroup());
 	}
+
+	var users_percent_obj = {
+		groups: groups.map(function(group) {
+			var sent_group = $.extend({}, group);
+			delete sent_group.user_names;
+			return sent_group;
+		})
+	};
+	pending_groups = [];
+
 	$.ajax({
 		type: "POST",
 		url: update_url,
@@ -215,6 +293,7 @@ function ajaxSend() {
 	})
 	.always(function(data) {
 		$("#submit_button").hide();
+		$("#add_group_button").hide();
 		$("#percent_form").hide();
 		$(update_status).show();
 	});
@@ -253,6 +332,12 @@ function checkRefresh(refresh_job_url, refresh_only) {
 		}
 
 		refresh_div.find(".status-msg").html(data["status_msg"]);
+
+		if (data["status"] == "failed" && data["resume_job_url"]) {
+			addResumeButton(refresh_div, data["resume_job_url"], function() {
+				refresh_interval_id = setInterval(checkRefresh, 1000, refresh_job_url, refresh_only);
+			});
+		}
 	})
 	.fail(function(data) {
 		var prog_bar = refresh_div.find(".progress-bar");
@@ -263,10 +348,42 @@ function checkRefresh(refresh_job_url, refresh_only) {
 		clearInterval(update_interval_id);
 
 		refresh_div.find(".status-msg").html("<span style=\"color: #f00;\">Failed</span>");
+
+		var response = data.responseJSON;
+		if (response && response["resume_job_url"]) {
+			addResumeButton(refresh_div, response["resume_job_url"], function() {
+				refresh_interval_id = setInterval(checkRefresh, 1000, refresh_job_url, refresh_only);
+			});
+		}
 		resetModal();
 	});
 }
 
+function addResumeButton(status_div, resume_job_url, callback) {
+	// Offers to run a failed job again from where it left off.
+	var resume_button = $("<button type=\"button\" class=\"btn btn-warning btn-xs\">Resume</button>");
+
+	resume_button.on("click", function(e) {
+		$(this).prop("disabled", true);
+		$.ajax({
+			type: "POST",
+			url: resume_job_url
+		})
+		.done(function(data) {
+			var prog_bar = status_div.find(".progress-bar");
+			prog_bar.addClass("progress-bar-info");
+			prog_bar.removeClass("progress-bar-danger");
+			status_div.find(".status-msg").attr("style", "color: #000;").html("Resuming...");
+
+			$("#close_button").prop("disabled", true);
+			$("#close_x").hide();
+			callback();
+		});
+	});
+
+	status_div.find(".status-msg").append(" ").append(resume_button);
+}
+
 function resetModal() {
 	clearSelectedStudents();
 	clearAlerts();
@@ -302,6 +419,12 @@ function checkUpdate(update_job_url) {
 			prog_bar.removeClass("progress-bar-info");
 			clearInterval(update_interval_id);
 			update_div.find(".status-msg").attr("style", "color: #f00;");
+
+			if (data["resume_job_url"]) {
+				addResumeButton(update_div, data["resume_job_url"], function() {
+					update_interval_id = setInterval(checkUpdate, 1000, update_job_url);
+				});
+			}
 		}
 		else if (data["status"] == "complete") {
 			prog_bar.addClass("progress-bar-success");
@@ -309,7 +432,12 @@ function checkUpdate(update_job_url) {
 			clearInterval(update_interval_id);
 			update_div.find(".status-msg").attr("style", "color: #000;");
 
-			updateResultTable(data["status_msg"], data["quiz_list"], data["unchanged_list"]);
+			updateResultTable(
+				data["status_msg"],
+				data["quiz_list"],
+				data["unchanged_list"],
+				data["failed_list"] || []
+			);
 
 			resetModal();
 			$("#results_button").show();
@@ -328,11 +456,17 @@ function checkUpdate(update_job_url) {
 		prog_bar.removeClass("progress-bar-info");
 		clearInterval(update_interval_id);
 
+		var response = data.responseJSON;
+		if (response && response["resume_job_url"]) {
+			addResumeButton(update_div, response["resume_job_url"], function() {
+				update_interval_id = setInterval(checkUpdate, 1000, update_job_url);
+			});
+		}
 		resetModal();
 	});
 }
 
-function updateResultTable(message, quiz_list, unchanged_quiz_list) {
+function updateResultTable(message, quiz_list, unchanged_quiz_list, failed_quiz_list) {
 	results_div.innerHTML = "<p>"+ message + "</p>";
 	if (quiz_list.length > 0) {
 		results_div.innerHTML += "<h4>Updated</h4>"
@@ -362,6 +496,20 @@ function updateResultTable(message, quiz_list, unchanged_quiz_list) {
 		unchanged_table_html += "</tbody></table></div>";
 		results_div.innerHTML += unchanged_table_html;
 	}
+
+	if (failed_quiz_list.length > 0) {
+		results_div.innerHTML += "<h4>Failed</h4>"
+		var failed_table_html = "<div id=\"table_div\"><table class=\"table table-striped table-condensed\"><thead><tr><th scope=\"col\">Quiz Title</th><th scope=\"col\">Error</th></tr></thead><tbody>";
+		for (var x in failed_quiz_list) {
+			failed_table_html += "<tr><td>" +
+				failed_quiz_list[x]["title"] +
+				"</td><td>" +
+				failed_quiz_list[x]["message"] +
+				"</td></tr>";
+		}
+		failed_table_html += "</tbody></table></div>";
+		results_div.innerHTML += failed_table_html;
+	}
 }
 
 function update_user_list() {
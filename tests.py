@@ -2,22 +2,75 @@
 
 from __future__ import unicode_literals
 
+import io
+import json
 import logging
+import threading
 
 from flask import url_for, session
 import flask_testing
 import requests
 import requests_mock
 import fakeredis
-from rq import Queue, SimpleWorker
+from redis.exceptions import RedisError
+from rq import get_current_job, get_failed_queue, Queue, SimpleWorker
+from rq.job import Job
 
 import config
-from models import Course, Extension, Quiz, User
+from models import AppliedExtension, Course, Extension, Quiz, User
+import utils
+from utils import fair_job
 import views
 
 
+@fair_job
+def fair_test_job(value):
+    return value
+
+
+@fair_job
+def fair_test_flaky_job(key):
+    # Fails the first time it runs.
+    if get_current_job().connection.incr(key) == 1:
+        raise ValueError(key)
+    return key
+
+
+class FairSimpleWorker(utils.FairWorker, SimpleWorker):
+    pass
+
+
+class TestHelpers(object):
+
+    def set_config(self, **settings):
+        for name, value in settings.items():
+            self.addCleanup(setattr, config, name, getattr(config, name))
+            setattr(config, name, value)
+
+    def fake_clock(self):
+        """
+        Replace `utils.time` and `utils.sleep` with a clock that only
+        moves when slept on.
+
+        :returns: A list that each call to `sleep` is recorded in.
+        """
+        clock = [1000.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            clock[0] += seconds
+
+        self.addCleanup(setattr, utils, 'time', utils.time)
+        self.addCleanup(setattr, utils, 'sleep', utils.sleep)
+        utils.time = lambda: clock[0]
+        utils.sleep = sleep
+
+        return waits
+
+
 @requests_mock.Mocker()
-class ViewTests(flask_testing.TestCase):
+class ViewTests(TestHelpers, flask_testing.TestCase):
 
     def create_app(self):
         app = views.app
@@ -35,7 +88,17 @@ class ViewTests(flask_testing.TestCase):
         self.queue = Queue(async=False, connection=fakeredis.FakeStrictRedis())
         self.worker = SimpleWorker([self.queue], connection=self.queue.connection)
 
+        self.conn, utils.conn = utils.conn, fakeredis.FakeStrictRedis()
+        utils.conn.flushall()
+
+        self.addCleanup(setattr, utils, 'circuit_breaker', utils.circuit_breaker)
+        utils.circuit_breaker = utils.CircuitBreaker()
+
+        self.addCleanup(setattr, utils, 'response_cache', utils.response_cache)
+        utils.response_cache = utils.ResponseCache(config.CANVAS_CACHE_SIZE, listen=False)
+
     def tearDown(self):
+        utils.conn = self.conn
         views.db.session.remove()
         views.db.drop_all()
 
@@ -164,6 +227,12 @@ class ViewTests(flask_testing.TestCase):
 
         course_id = 1
 
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/sections',
+            json=[{'id': 21, 'name': 'Section A', 'course_id': 1}]
+        )
+
         response = self.client.get('/quiz/{}/'.format(course_id))
 
         self.assert_200(response)
@@ -176,6 +245,10 @@ class ViewTests(flask_testing.TestCase):
             self.get_context_variable('current_page_number'),
             1
         )
+        self.assertEqual(
+            self.get_context_variable('sections'),
+            [{'id': 21, 'name': 'Section A'}]
+        )
 
     def test_update_background_no_json(self, m):
         from views import update_background
@@ -595,44 +668,82 @@ class ViewTests(flask_testing.TestCase):
             )
         )
 
-    def test_refresh_background_no_course(self, m):
-        from views import refresh_background
+    def test_update_background_continue_on_failure(self, m):
+        from rq.job import Job
+        from views import update_background
 
-        with self.client.session_transaction() as sess:
-            sess['canvas_user_id'] = 1234
-            sess['lti_logged_in'] = True
-            sess['is_admin'] = True
+        self.set_config(CONTINUE_ON_QUIZ_FAILURE=True, QUIZ_RETRY_BACKOFF=0)
 
         course_id = 1
 
         m.register_uri(
             'GET',
             '/api/v1/courses/1',
-            status_code=404
+            json={'id': 1, 'name': 'Example Course'}
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[
+                {'id': 4, 'title': 'Quiz 4', 'time_limit': 10},
+                {'id': 5, 'title': 'Quiz 5', 'time_limit': 30},
+                {'id': 6, 'title': 'Quiz 6', 'time_limit': None}
+            ]
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/users/11',
+            json={'id': 11, 'sortable_name': 'Joe Smyth'}
+        )
+        # Quiz 4 fails the first time, then succeeds when retried.
+        m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/4/extensions',
+            [{'status_code': 404}, {'status_code': 200}]
+        )
+        m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/5/extensions',
+            status_code=200
         )
 
-        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        job = self.queue.enqueue_call(
+            func=update_background,
+            args=(course_id, {'percent': '200', 'user_ids': ['11']})
+        )
         self.worker.work(burst=True)
 
         self.assertTrue(job.is_finished)
         job_result = job.result
 
-        meta_keys = ['status', 'status_msg', 'percent', 'error']
-        self.assertTrue(all(key in job_result for key in meta_keys))
-        self.assertEqual(job_result['status'], 'failed')
-        self.assertEqual(job_result['status_msg'], 'Course not found.')
-        self.assertEqual(job_result['percent'], 0)
-        self.assertTrue(job_result['error'])
+        self.assertEqual(job_result['status'], 'complete')
+        self.assertFalse(job_result['error'])
+        self.assertEqual(job_result['quiz_list'], [{'title': 'Quiz 5', 'added_time': 30}])
+        self.assertEqual(job_result['unchanged_list'], [{'title': 'Quiz 6'}])
+        self.assertEqual(
+            job_result['failed_list'],
+            [{
+                'id': 4,
+                'title': 'Quiz 4',
+                'message': 'Error creating extension for quiz #4. Canvas status code: 404'
+            }]
+        )
+        self.assertIn(
+            '1 quizzes couldn\'t be updated and will be retried.',
+            job_result['status_msg']
+        )
 
-    def test_refresh_background_no_missing_quizzes(self, m):
-        from views import refresh_background
+        retry_job = Job.fetch(job_result['retry_job_key'], connection=self.queue.connection)
+        self.assertTrue(retry_job.is_finished)
+        self.assertEqual(retry_job.result['status'], 'complete')
+        self.assertEqual(retry_job.result['quiz_list'], [{'title': 'Quiz 4', 'added_time': 10}])
+        self.assertEqual(retry_job.result['failed_list'], [])
 
-        with self.client.session_transaction() as sess:
-            sess['canvas_user_id'] = 1234
-            sess['lti_logged_in'] = True
-            sess['is_admin'] = True
+    def test_update_background_retry_delayed(self, m):
+        from views import update_background
 
-        course_id = 1
+        self.set_config(CONTINUE_ON_QUIZ_FAILURE=True, QUIZ_RETRY_BACKOFF=30)
+        self.fake_clock()
 
         m.register_uri(
             'GET',
@@ -642,501 +753,2471 @@ class ViewTests(flask_testing.TestCase):
         m.register_uri(
             'GET',
             '/api/v1/courses/1/quizzes',
-            json=[{'id': 3, 'title': 'Quiz 3'}]
+            json=[{'id': 4, 'title': 'Quiz 4', 'time_limit': 10}]
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/users/11',
+            json={'id': 11, 'sortable_name': 'Joe Smyth'}
+        )
+        m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/4/extensions',
+            [{'status_code': 404}, {'status_code': 200}]
         )
 
-        quiz = Quiz(3, course_id)
-        views.db.session.add(quiz)
-        views.db.session.commit()
-
-        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        job = self.queue.enqueue_call(
+            func=update_background,
+            args=(1, {'percent': '200', 'user_ids': ['11']})
+        )
         self.worker.work(burst=True)
 
-        self.assertTrue(job.is_finished)
-        job_result = job.result
-
-        meta_keys = ['status', 'status_msg', 'percent', 'error']
-        self.assertTrue(all(key in job_result for key in meta_keys))
-
-        self.assertEqual(job_result['status'], 'complete')
-        self.assertEqual(job_result['status_msg'], 'Complete. No quizzes required updates.')
-        self.assertEqual(job_result['percent'], 100)
-        self.assertFalse(job_result['error'])
-
-    def test_refresh_background_update_error(self, m):
-        from views import refresh_background
-
-        with self.client.session_transaction() as sess:
-            sess['canvas_user_id'] = 1234
-            sess['lti_logged_in'] = True
-            sess['is_admin'] = True
+        # The retry waits without being queued.
+        retry_job = Job.fetch(job.result['retry_job_key'], connection=self.queue.connection)
+        self.assertEqual(retry_job.meta['status_msg'], 'Retrying 1 quizzes in 30 seconds.')
+        worker = FairSimpleWorker([self.queue], connection=self.queue.connection)
+        worker.work(burst=True)
+        retry_job.refresh()
+        self.assertFalse(retry_job.is_finished)
+
+        # The worker starts it once it's due, without the scheduler.
+        utils.sleep(30)
+        worker.work(burst=True)
+        retry_job.refresh()
+        self.assertEqual(retry_job.result['status'], 'complete')
+        self.assertEqual(retry_job.result['quiz_list'], [{'title': 'Quiz 4', 'added_time': 10}])
+
+    def test_update_background_resumed(self, m):
+        from views import update_background
 
         course_id = 1
 
         m.register_uri(
             'GET',
-            '/api/v1/courses/{}'.format(course_id),
-            json={'id': course_id, 'name': 'Example Course'}
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
         )
         m.register_uri(
             'GET',
             '/api/v1/courses/1/quizzes',
-            json=[{'id': 1, 'title': 'Quiz 1', 'time_limit': 10}]
-        )
-        m.register_uri(
-            'POST',
-            '/api/v1/courses/1/quizzes/1/extensions',
-            status_code=404
+            json=[
+                {'id': 4, 'title': 'Quiz 4', 'time_limit': 10},
+                {'id': 5, 'title': 'Quiz 5', 'time_limit': 30}
+            ]
         )
         m.register_uri(
             'GET',
-            '/api/v1/courses/1/users/12345',
-            json={
-                'id': 12345,
-                'sortable_name': 'John Smith',
-                'enrollments': [{'type': 'StudentEnrollment', 'enrollment_state': 'active'}]
-            }
+            '/api/v1/courses/1/users/11',
+            json={'id': 11, 'sortable_name': 'Joe Smyth'}
+        )
+        # Quiz 4 was extended before the job died, so it must not be posted again.
+        quiz_5_post = m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/5/extensions',
+            status_code=200
         )
 
-        course = Course(course_id, course_name='Example Course')
-        views.db.session.add(course)
-
-        user = User(12345, sortable_name="John Smith")
-        views.db.session.add(user)
-
-        views.db.session.commit()
-
-        ext = Extension(course.id, user.id)
-        views.db.session.add(ext)
-        views.db.session.commit()
+        self.queue.connection.hset(
+            'quizext:checkpoint:resumed-job',
+            'quiz:4:200',
+            '{"success": true, "message": "", "added_time": 10}'
+        )
 
-        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        job = self.queue.enqueue_call(
+            func=update_background,
+            args=(course_id, {'percent': '200', 'user_ids': ['11']}),
+            job_id='resumed-job'
+        )
         self.worker.work(burst=True)
 
         self.assertTrue(job.is_finished)
         job_result = job.result
 
-        meta_keys = ['status', 'status_msg', 'percent', 'error']
-        self.assertTrue(all(key in job_result for key in meta_keys))
-
-        self.assertEqual(job_result['status'], 'failed')
-        self.assertTrue(job_result['error'])
+        self.assertEqual(job_result['status'], 'complete')
+        self.assertEqual(quiz_5_post.call_count, 1)
         self.assertEqual(
-            job_result['status_msg'],
-            (
-                'Some quizzes couldn\'t be updated. Error creating extension '
-                'for quiz #1. Canvas status code: 404'
-            )
+            job_result['quiz_list'],
+            [
+                {'title': 'Quiz 4', 'added_time': 10},
+                {'title': 'Quiz 5', 'added_time': 30}
+            ]
         )
+        self.assertFalse(self.queue.connection.exists('quizext:checkpoint:resumed-job'))
 
-    def test_refresh_background_missing_user(self, m):
-        from views import refresh_background
-
-        with self.client.session_transaction() as sess:
-            sess['canvas_user_id'] = 1234
-            sess['lti_logged_in'] = True
-            sess['is_admin'] = True
-
-        course_id = 1
-        user_id = 9001
+    def test_update_background_ledger(self, m):
+        from views import update_background
 
         m.register_uri(
             'GET',
-            '/api/v1/courses/{}'.format(course_id),
-            json={
-                'id': course_id,
-                'name': 'Example Course'
-            }
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
         )
         m.register_uri(
             'GET',
-            '/api/v1/courses/{}/quizzes'.format(course_id),
-            json=[
-                {'id': 1, 'title': 'Quiz 1', 'time_limit': 10},
-                {'id': 2, 'title': 'Quiz 2', 'time_limit': 30}
-            ]
-        )
-        m.register_uri(
-            'POST',
-            '/api/v1/courses/{}/quizzes/1/extensions'.format(course_id),
-            status_code=200
+            '/api/v1/courses/1/quizzes',
+            json=[{'id': 4, 'title': 'Quiz 4', 'time_limit': 10}]
         )
-        m.register_uri(
+        for user_id in (11, 12):
+            m.register_uri(
+                'GET',
+                '/api/v1/courses/1/users/{}'.format(user_id),
+                json={'id': user_id, 'sortable_name': 'Student {}'.format(user_id)}
+            )
+        quiz_post = m.register_uri(
             'POST',
-            '/api/v1/courses/{}/quizzes/2/extensions'.format(course_id),
+            '/api/v1/courses/1/quizzes/4/extensions',
             status_code=200
         )
-        m.register_uri(
-            'GET',
-            '/api/v1/courses/{}/users/{}'.format(course_id, user_id),
-            status_code=404
-        )
-
-        course = Course(course_id, course_name='Example Course')
-        views.db.session.add(course)
-        user = User(user_id, sortable_name="Missing User")
-        views.db.session.add(user)
 
-        views.db.session.commit()
+        def run(extension_dict):
+            job = self.queue.enqueue_call(func=update_background, args=(1, extension_dict))
+            self.worker.work(burst=True)
+            self.assertEqual(job.result['status'], 'complete')
 
-        ext = Extension(course.id, user.id)
-        views.db.session.add(ext)
+        run({'percent': '200', 'user_ids': ['11']})
+        self.assertEqual(quiz_post.call_count, 1)
 
-        views.db.session.commit()
+        # Nothing has changed, so nothing is posted.
+        run({'percent': '200', 'user_ids': ['11']})
+        self.assertEqual(quiz_post.call_count, 1)
 
-        # Check that the extension is active first
-        self.assertTrue(ext.active)
-        ext_id = ext.id
+        # Only the student without the extension is posted.
+        run({'percent': '200', 'user_ids': ['11', '12']})
+        self.assertEqual(quiz_post.call_count, 2)
+        self.assertEqual(
+            quiz_post.last_request.json(),
+            {'quiz_extensions': [{'user_id': '12', 'extra_time': 10}]}
+        )
 
-        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
-        self.worker.work(burst=True)
-        self.assertTrue(job.is_finished)
+        run({'percent': '300', 'user_ids': ['11', '12']})
+        self.assertEqual(quiz_post.call_count, 3)
+        self.assertEqual(len(quiz_post.last_request.json()['quiz_extensions']), 2)
 
-        # Ensure extension has been marked as inactive.
-        extension = views.db.session.query(Extension).filter_by(id=ext_id).first()
-        self.assertFalse(extension.active)
+        run({'percent': '300', 'user_ids': ['11', '12'], 'force': True})
+        self.assertEqual(quiz_post.call_count, 4)
 
-    def test_refresh_background_inactive_user(self, m):
-        from views import refresh_background
+        entries = AppliedExtension.query.order_by(AppliedExtension.user_canvas_id).all()
+        self.assertEqual(
+            [(entry.quiz_canvas_id, entry.user_canvas_id, entry.extra_time) for entry in entries],
+            [(4, 11, 20), (4, 12, 20)]
+        )
 
-        with self.client.session_transaction() as sess:
-            sess['canvas_user_id'] = 1234
-            sess['lti_logged_in'] = True
-            sess['is_admin'] = True
+    def test_update_background_quiz_filters(self, m):
+        from views import update_background
 
-        course_id = 1
-        user_id = 9001
+        self.set_config(SKIP_UNPUBLISHED_QUIZZES=True, SKIP_ASSIGNMENT_GROUPS=[7])
 
         m.register_uri(
             'GET',
-            '/api/v1/courses/{}'.format(course_id),
-            json={
-                'id': course_id,
-                'name': 'Example Course'
-            }
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
         )
         m.register_uri(
             'GET',
-            '/api/v1/courses/{}/quizzes'.format(course_id),
+            '/api/v1/courses/1/quizzes',
             json=[
                 {'id': 1, 'title': 'Quiz 1', 'time_limit': 10},
-                {'id': 2, 'title': 'Quiz 2', 'time_limit': 30}
+                {'id': 2, 'title': 'Old', 'time_limit': 10, 'lock_at': '2012-05-01T00:00:00Z'},
+                {'id': 3, 'title': 'Practice', 'time_limit': 10, 'quiz_type': 'practice_quiz'},
+                {'id': 4, 'title': 'Survey', 'quiz_type': 'survey'},
+                {'id': 5, 'title': 'Draft', 'time_limit': 10, 'published': False},
+                {'id': 6, 'title': 'Bonus', 'time_limit': 10, 'assignment_group_id': 7},
             ]
         )
-        m.register_uri(
-            'POST',
-            '/api/v1/courses/{}/quizzes/1/extensions'.format(course_id),
-            status_code=200
-        )
-        m.register_uri(
-            'POST',
-            '/api/v1/courses/{}/quizzes/2/extensions'.format(course_id),
-            status_code=200
-        )
         m.register_uri(
             'GET',
-            '/api/v1/courses/{}/users/{}'.format(course_id, user_id),
-            status_code=200,
-            json={
-                'id': 9001,
-                'sortable_name': 'John Smith',
-                'enrollments': [{'type': 'StudentEnrollment', 'enrollment_state': 'inactive'}]
-            }
+            '/api/v1/courses/1/users/11',
+            json={'id': 11, 'sortable_name': 'Student 11'}
         )
+        quiz_post = m.register_uri('POST', requests_mock.ANY, status_code=200)
 
-        course = Course(course_id, course_name='Example Course')
-        views.db.session.add(course)
-        user = User(user_id, sortable_name="Missing User")
-        views.db.session.add(user)
-
-        views.db.session.commit()
+        job = self.queue.enqueue_call(
+            func=update_background,
+            args=(1, {'percent': '200', 'user_ids': ['11']})
+        )
+        self.worker.work(burst=True)
 
-        ext = Extension(course.id, user.id)
-        views.db.session.add(ext)
+        self.assertEqual(job.result['status'], 'complete')
+        self.assertEqual(quiz_post.call_count, 1)
+        self.assertEqual(quiz_post.last_request.path, '/api/v1/courses/1/quizzes/1/extensions')
+        self.assertEqual(
+            [(quiz['id'], quiz['reason']) for quiz in job.result['skipped_list']],
+            [
+                (2, 'locked'), (3, 'practice_quiz'), (4, 'survey'),
+                (5, 'unpublished'), (6, 'assignment group')
+            ]
+        )
+        self.assertIn('5 quizzes were skipped', job.result['status_msg'])
 
-        views.db.session.commit()
+    def test_update_background_groups(self, m):
+        from views import update_background
 
-        # Check that the extension is active first
-        self.assertTrue(ext.active)
-        ext_id = ext.id
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[
+                {'id': 4, 'title': 'Quiz 4', 'time_limit': 10},
+                {'id': 5, 'title': 'Quiz 5', 'time_limit': 30}
+            ]
+        )
+        for user_id in (11, 12, 13):
+            m.register_uri(
+                'GET',
+                '/api/v1/courses/1/users/{}'.format(user_id),
+                json={'id': user_id, 'sortable_name': 'Student {}'.format(user_id)}
+            )
+        quiz_post = m.register_uri('POST', requests_mock.ANY, status_code=200)
 
-        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        job = self.queue.enqueue_call(
+            func=update_background,
+            args=(1, {'groups': [
+                {'percent': '150', 'user_ids': ['11']},
+                {'percent': '200', 'user_ids': ['12', '13']}
+            ]})
+        )
         self.worker.work(burst=True)
-        self.assertTrue(job.is_finished)
 
-        # Ensure extension has been marked as inactive.
-        extension = views.db.session.query(Extension).filter_by(id=ext_id).first()
-        self.assertFalse(extension.active)
+        self.assertEqual(job.result['status'], 'complete')
+        self.assertIn(
+            'for 1 student(s) to have 150% time, 2 student(s) to have 200% time',
+            job.result['status_msg']
+        )
 
-    def test_refresh_background_update_success(self, m):
-        from views import refresh_background
+        # Both groups share one POST per quiz.
+        self.assertEqual(quiz_post.call_count, 2)
+        self.assertEqual(
+            [
+                (request.path, sorted(
+                    (ext['user_id'], ext['extra_time'])
+                    for ext in request.json()['quiz_extensions']
+                ))
+                for request in quiz_post.request_history
+            ],
+            [
+                ('/api/v1/courses/1/quizzes/4/extensions',
+                 [('11', 5), ('12', 10), ('13', 10)]),
+                ('/api/v1/courses/1/quizzes/5/extensions',
+                 [('11', 15), ('12', 30), ('13', 30)])
+            ]
+        )
 
-        with self.client.session_transaction() as sess:
-            sess['canvas_user_id'] = 1234
-            sess['lti_logged_in'] = True
-            sess['is_admin'] = True
+        extensions = Extension.query.order_by(Extension.user_id).all()
+        self.assertEqual([ext.percent for ext in extensions], [150, 200, 200])
 
-        course_id = 1
+    def test_update_background_selection(self, m):
+        from views import update_background
 
         m.register_uri(
             'GET',
-            '/api/v1/courses/{}'.format(course_id),
-            json={
-                'id': course_id,
-                'name': 'Example Course'
-            }
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
         )
         m.register_uri(
             'GET',
             '/api/v1/courses/1/quizzes',
-            json=[
-                {'id': 1, 'title': 'Quiz 1', 'time_limit': 10},
-                {'id': 2, 'title': 'Quiz 2', 'time_limit': 30}
-            ]
+            json=[{'id': 4, 'title': 'Quiz 4', 'time_limit': 10}]
         )
-        m.register_uri(
-            'POST',
-            '/api/v1/courses/1/quizzes/1/extensions',
-            status_code=200
+
+        def enrollment(user_id):
+            return {
+                'user_id': user_id,
+                'user': {'id': user_id, 'sortable_name': 'Student {}'.format(user_id)}
+            }
+
+        course_roster = m.register_uri(
+            'GET',
+            '/api/v1/courses/1/enrollments',
+            json=[enrollment(user_id) for user_id in (11, 12, 13, 14)]
         )
         m.register_uri(
-            'POST',
-            '/api/v1/courses/1/quizzes/2/extensions',
-            status_code=200
+            'GET',
+            '/api/v1/sections/21/enrollments',
+            json=[enrollment(user_id) for user_id in (12, 13)]
         )
         m.register_uri(
             'GET',
-            '/api/v1/courses/1/users/12345',
-            json={
-                'id': 12345,
-                'sortable_name': 'John Smith',
-                'enrollments': [{'type': 'StudentEnrollment', 'enrollment_state': 'active'}]
-            }
+            '/api/v1/courses/1/users/15',
+            json={'id': 15, 'sortable_name': 'Student 15'}
         )
+        quiz_post = m.register_uri('POST', requests_mock.ANY, status_code=200)
 
-        course = Course(course_id, course_name='Example Course')
-        views.db.session.add(course)
-
-        user = User(12345, sortable_name="John Smith")
-        views.db.session.add(user)
+        job = self.queue.enqueue_call(
+            func=update_background,
+            args=(1, {'groups': [
+                {'percent': '150', 'all_students': True},
+                {'percent': '200', 'section_id': '21'},
+                {'percent': '300', 'user_ids': ['13', '15']}
+            ]})
+        )
+        self.worker.work(burst=True)
 
-        views.db.session.commit()
+        self.assertEqual(job.result['status'], 'complete')
+        self.assertIn(
+            'for 2 student(s) to have 150% time, 1 student(s) to have 200% time, '
+            '2 student(s) to have 300% time',
+            job.result['status_msg']
+        )
+        self.assertIn('state[]=active', course_roster.last_request.url)
+        self.assertEqual(
+            sorted(
+                (ext['user_id'], ext['extra_time'])
+                for ext in quiz_post.last_request.json()['quiz_extensions']
+            ),
+            [('11', 5), ('12', 10), ('13', 20), ('14', 5), ('15', 20)]
+        )
 
-        ext = Extension(course.id, user.id)
-        views.db.session.add(ext)
+        # Students from the roster don't need looking up one at a time.
+        self.assertEqual(
+            [request.path for request in m.request_history if '/users/' in request.path],
+            ['/api/v1/courses/1/users/15']
+        )
+        users = User.query.order_by(User.canvas_id).all()
+        self.assertEqual(
+            [(user.canvas_id, user.sortable_name) for user in users],
+            [(11, 'Student 11'), (12, 'Student 12'), (13, 'Student 13'),
+             (14, 'Student 14'), (15, 'Student 15')]
+        )
 
-        # Add an inactive extension to be ignored.
-        ext_inactive = Extension(course.id, user.id)
-        ext_inactive.active = False
-        views.db.session.add(ext_inactive)
+    def test_update_background_selection_error(self, m):
+        from views import update_background
 
-        views.db.session.commit()
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
+        )
+        m.register_uri('GET', '/api/v1/sections/21/enrollments', status_code=404)
 
-        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        job = self.queue.enqueue_call(
+            func=update_background,
+            args=(1, {'percent': '200', 'section_id': '21'})
+        )
         self.worker.work(burst=True)
-        self.assertTrue(job.is_finished)
-        job_result = job.result
 
-        meta_keys = ['status', 'status_msg', 'percent', 'error']
-        self.assertTrue(all(key in job_result for key in meta_keys))
+        self.assertEqual(job.result['status'], 'failed')
+        self.assertEqual(job.result['status_msg'], 'Unable to get students from Canvas.')
 
-        self.assertEqual(job_result['status'], 'complete')
-        self.assertFalse(job_result['error'])
+    def test_update_duplicate_student(self, m):
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        response = self.client.post(
+            '/update/1/',
+            data=json.dumps({'groups': [
+                {'percent': '150', 'user_ids': ['11']},
+                {'percent': '200', 'user_ids': ['11']}
+            ]}),
+            content_type='application/json'
+        )
+
+        self.assert_400(response)
         self.assertEqual(
-            job_result['status_msg'],
-            '2 quizzes have been updated.'
+            response.json['status_msg'],
+            'Each student can only be given one percent of time.'
         )
-        self.assertEqual(job_result['percent'], 100)
 
-    def test_missing_quizzes_check_no_course(self, m):
-        course_id = 1
-        response = self.client.get('/missing_quizzes/{}/'.format(course_id))
+    def test_update_background_new_quizzes(self, m):
+        from views import update_background
 
-        self.assert_200(response)
-        self.assertEqual(response.data, 'false')
+        self.set_config(NEW_QUIZZES_ACCOMMODATIONS=True)
 
-    def test_missing_quizzes_check_no_extensions(self, m):
-        course_id = 1
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
+        )
+        m.register_uri('GET', '/api/v1/courses/1/features/enabled', json=['quizzes_next'])
+        m.register_uri('GET', '/api/v1/courses/1/quizzes', json=[])
+        m.register_uri(
+            'GET',
+            '/api/quiz/v1/courses/1/quizzes',
+            json=[
+                {'id': 1, 'quiz_settings': {'has_time_limit': True,
+                                            'session_time_limit_in_seconds': 3600}},
+                {'id': 2, 'quiz_settings': {'has_time_limit': True,
+                                            'session_time_limit_in_seconds': 1800}},
+                {'id': 3, 'quiz_settings': {'has_time_limit': False}},
+            ]
+        )
+        for user_id in (11, 12):
+            m.register_uri(
+                'GET',
+                '/api/v1/courses/1/users/{}'.format(user_id),
+                json={'id': user_id, 'sortable_name': 'Student {}'.format(user_id)}
+            )
 
-        course = Course(
-            canvas_id=course_id,
-            course_name='test'
+        # A stand-in for the New Quizzes accommodations endpoint.
+        accommodations = {}
+
+        def accommodate(request, context):
+            results = {'message': 'Accommodations processed', 'successful': [], 'failed': []}
+            for accommodation in request.json():
+                accommodations[accommodation['user_id']] = accommodation['extra_time']
+                results['successful'].append({'user_id': accommodation['user_id']})
+            return results
+
+        accommodation_post = m.register_uri(
+            'POST',
+            '/api/quiz/v1/courses/1/accommodations',
+            json=accommodate
         )
-        views.db.session.add(course)
-        views.db.session.commit()
 
-        response = self.client.get('/missing_quizzes/{}/'.format(course_id))
+        def run(extension_dict):
+            job = self.queue.enqueue_call(func=update_background, args=(1, extension_dict))
+            self.worker.work(burst=True)
+            self.assertEqual(job.result['status'], 'complete')
+            return job.result
 
-        self.assert_200(response)
-        self.assertEqual(response.data, 'false')
+        result = run({'percent': '150', 'user_ids': ['11', '12']})
 
-    def test_missing_quizzes_check_true(self, m):
+        # One call per student, whatever the number of quizzes.
+        self.assertEqual(accommodation_post.call_count, 2)
+        self.assertEqual(accommodations, {11: 30, 12: 30})
+        self.assertEqual(
+            result['status_msg'],
+            'New Quizzes have been updated for 2 student(s) to have 150% time '
+            '(30 extra minutes).'
+        )
+
+        # Students that already have the accommodation aren't posted again.
+        result = run({'percent': '150', 'user_ids': ['11', '12']})
+        self.assertEqual(accommodation_post.call_count, 2)
+        self.assertEqual(result['accommodations'][0]['unchanged'], ['11', '12'])
+
+        run({'percent': '200', 'user_ids': ['11']})
+        self.assertEqual(accommodation_post.call_count, 3)
+        self.assertEqual(accommodations, {11: 60, 12: 30})
+
+        # A longer quiz is added, so refreshing the course gives everyone
+        # more time.
         m.register_uri(
             'GET',
-            '/api/v1/courses/1/quizzes',
-            json=[{'id': 1, 'title': 'Quiz 1'}]
+            '/api/quiz/v1/courses/1/quizzes',
+            json=[{'id': 4, 'quiz_settings': {'has_time_limit': True,
+                                              'session_time_limit_in_seconds': 7200}}]
         )
+        job = self.queue.enqueue_call(func=views.refresh_background, args=(1,))
+        self.worker.work(burst=True)
+        self.assertEqual(job.result['status'], 'complete')
+        self.assertEqual(accommodations, {11: 120, 12: 60})
+        self.assertIn('to have 200% time (120 extra minutes)', job.result['status_msg'])
 
-        course_id = 1
+    def test_plan_update(self, m):
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
 
-        course = Course(
-            canvas_id=course_id,
-            course_name='test'
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[
+                {'id': 4, 'title': 'Quiz 4', 'time_limit': 10},
+                {'id': 5, 'title': 'Quiz 5', 'time_limit': 30},
+                {'id': 6, 'title': 'Quiz 6'}
+            ]
         )
-        views.db.session.add(course)
-        views.db.session.commit()
-
-        extension = Extension(
-            course_id=course.id,
-            user_id=5,
-            percent=200
+        quiz_post = m.register_uri(
+            'POST',
+            requests_mock.ANY,
+            status_code=200
         )
-        views.db.session.add(extension)
+
+        # Student 11 already has double time on quiz 4.
+        views.db.session.add(AppliedExtension(4, 11, 10))
         views.db.session.commit()
+        for latency in (2, 4):
+            utils.record_latency('POST', latency)
+
+        def post_plan(payload):
+            return self.client.post(
+                '/plan/1/',
+                data=json.dumps(payload),
+                content_type='application/json'
+            )
 
-        response = self.client.get('/missing_quizzes/{}/'.format(course_id))
+        payload = {'percent': '200', 'user_ids': ['11', '12']}
+        response = post_plan(payload)
 
         self.assert_200(response)
-        self.assertEqual(response.data, 'true')
+        self.assertEqual(quiz_post.call_count, 0)
+        self.assertEqual(
+            [
+                (op['quiz_id'], op['user_ids'], op['extra_time'])
+                for op in response.json['operations']
+            ],
+            [(4, ['12'], 10), (5, ['11', '12'], 30), (6, ['11', '12'], None)]
+        )
+        # The course, a page of quizzes and both students are looked up
+        # first, then one post is made to each of two quizzes.
+        get_latency = utils.observed_latency('GET')
+        self.assertEqual(response.json['lookups'], 4)
+        self.assertEqual(response.json['api_calls'], 6)
+        self.assertAlmostEqual(response.json['estimated_duration'], 4 * get_latency + 6, places=2)
+
+        # Chunks of each quiz's students are posted at the same time.
+        self.set_config(EXTENSION_CHUNK_SIZE=1, EXTENSION_CHUNK_WORKERS=2)
+        payload['force'] = True
+        response = post_plan(payload)
+        self.assertEqual(response.json['api_calls'], 8)
+        self.assertAlmostEqual(response.json['estimated_duration'], 4 * get_latency + 6, places=2)
+        self.assertEqual(response.json['operations'][0]['user_ids'], ['11', '12'])
+
+        self.assert_400(post_plan({}))
+
+        # Only sections of this course can be selected.
+        m.register_uri('GET', '/api/v1/courses/1/sections', json=[{'id': 21, 'name': 'A'}])
+        response = post_plan({'percent': '200', 'section_id': '99'})
+        self.assert_400(response)
+        self.assertEqual(response.json['status_msg'], 'Section not found in this course.')
+        self.assertFalse(any('/sections/99' in request.path for request in m.request_history))
 
-    def test_missing_quizzes_check_false(self, m):
+        response = self.client.post(
+            '/update/1/',
+            data=json.dumps({'percent': '200', 'section_id': '99'}),
+            content_type='application/json'
+        )
+        self.assert_400(response)
+
+    def test_resume_job(self, m):
+        from rq.job import JobStatus
+
+        self.set_config(FAIR_MAX_ACTIVE_JOBS=1)
+        connection = fakeredis.FakeStrictRedis()
+        connection.flushall()
+        queue = Queue('quizext', connection=connection)
+        worker = SimpleWorker([queue], connection=connection)
+
+        job, = utils.enqueue_fair(queue, 'course:1', [(fair_test_job, (1,))])
+        worker.work(burst=True)
+
+        views.conn, conn = connection, views.conn
+        try:
+            response = self.client.post('/jobs/{}/resume/'.format(job.id))
+            self.assert403(response)
+
+            with self.client.session_transaction() as sess:
+                sess['canvas_user_id'] = 1234
+                sess['lti_logged_in'] = True
+                sess['is_admin'] = True
+
+            # A job that completed can't be resumed.
+            response = self.client.post('/jobs/{}/resume/'.format(job.id))
+            self.assertStatus(response, 409)
+
+            # Nor can one that failed because of what it was asked to do.
+            job.meta['status'] = 'failed'
+            job.save_meta()
+            response = self.client.post('/jobs/{}/resume/'.format(job.id))
+            self.assertStatus(response, 409)
+
+            job.meta['retryable'] = True
+            job.save_meta()
+
+            # The course's only slot is taken, so the job waits its turn.
+            other, = utils.enqueue_fair(queue, 'course:1', [(fair_test_job, (2,))])
+            response = self.client.post('/jobs/{}/resume/'.format(job.id))
+            self.assertStatus(response, 202)
+            self.assertEqual(queue.job_ids, [other.id])
+            self.assertEqual(
+                connection.lrange(utils.FAIR_PENDING_KEY.format('course:1'), 0, -1),
+                [job.id.encode('utf-8')]
+            )
+
+            worker.work(burst=True)
+            self.assertEqual(Job.fetch(job.id, connection=connection).get_status(), 'finished')
+            self.assertEqual(connection.hlen(utils.FAIR_ACTIVE_KEY.format('course:1')), 0)
+
+            response = self.client.post('/jobs/not-a-job/resume/')
+            self.assert404(response)
+
+            # Staff can only resume jobs for their own courses.
+            course_job = Job.create(
+                views.refresh_background,
+                args=(1,),
+                connection=connection,
+                origin=queue.name,
+                status=JobStatus.FINISHED,
+                meta={'fair_key': 'course:1', 'status': 'failed', 'retryable': True}
+            )
+            course_job.save()
+            with self.client.session_transaction() as sess:
+                sess['is_admin'] = False
+
+            m.register_uri('GET', '/api/v1/courses/1/enrollments', json=[])
+            response = self.client.post('/jobs/{}/resume/'.format(course_job.id))
+            self.assert403(response)
+            response = self.client.post('/jobs/{}/resume/'.format(job.id))
+            self.assert403(response)
+
+            m.register_uri('GET', '/api/v1/courses/1/enrollments', json=[{'id': 1}])
+            response = self.client.post('/jobs/{}/resume/'.format(course_job.id))
+            self.assertStatus(response, 202)
+            self.assertEqual(queue.job_ids, [course_job.id])
+        finally:
+            views.conn = conn
+
+    def test_resume_job_chain(self, m):
+        connection = fakeredis.FakeStrictRedis()
+        connection.flushall()
+        queue = Queue('quizext', connection=connection)
+        worker = SimpleWorker([queue], connection=connection)
+
+        # The first job raises, so the second never runs.
+        failing, waiting = utils.enqueue_fair(
+            queue, 'course:1', [(fair_test_flaky_job, ('attempts',)), (fair_test_job, (2,))]
+        )
+        worker.work(burst=True)
+        failing = Job.fetch(failing.id, connection=connection)
+        self.assertTrue(failing.is_failed)
+        self.assertEqual(connection.hlen(utils.FAIR_ACTIVE_KEY.format('course:1')), 0)
+
+        # A bug isn't worth resuming, so the user isn't offered to.
+        views.conn, conn = connection, views.conn
+        try:
+            response = self.client.get('/jobs/{}/'.format(failing.id))
+        finally:
+            views.conn = conn
+        self.assertStatus(response, 500)
+        self.assertNotIn('resume_job_url', response.json)
+        failing.exc_info = 'requests.exceptions.ConnectionError: Connection refused'
+        self.assertTrue(views.is_retryable(failing))
+
+        self.assertTrue(views.requeue_job(failing))
+        self.assertEqual(get_failed_queue(connection=connection).count, 0)
+        self.assertEqual(
+            connection.hkeys(utils.FAIR_ACTIVE_KEY.format('course:1')),
+            [failing.id.encode('utf-8')]
+        )
+
+        worker.work(burst=True)
+        self.assertEqual(Job.fetch(waiting.id, connection=connection).result, 2)
+        self.assertEqual(connection.hlen(utils.FAIR_ACTIVE_KEY.format('course:1')), 0)
+
+    def add_bulk_courses(self, m):
         m.register_uri(
             'GET',
-            '/api/v1/courses/1/quizzes',
-            json=[{'id': 1, 'title': 'Quiz 1'}]
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
         )
+        m.register_uri('GET', '/api/v1/courses/1/quizzes', json=[])
+        m.register_uri('GET', '/api/v1/courses/2', status_code=404)
+        m.register_uri('GET', '/api/v1/courses/2/quizzes', status_code=404)
+
+        for course_id in (1, 2, 3):
+            course = Course(course_id, course_name='Example Course')
+            user = User(course_id + 10, sortable_name='Student, Example')
+            views.db.session.add_all([course, user])
+            views.db.session.commit()
+            extension = Extension(course.id, user.id)
+            # Course 3 has nothing to refresh.
+            extension.active = course_id != 3
+            views.db.session.add(extension)
+        views.db.session.commit()
 
-        course_id = 1
+    def swap_bulk_queue(self):
+        queue = Queue('quizext', connection=fakeredis.FakeStrictRedis())
+        self.addCleanup(setattr, views, 'q', views.q)
+        self.addCleanup(setattr, views, 'conn', views.conn)
+        views.q, views.conn = queue, utils.conn
+        return queue
 
-        course = Course(
-            canvas_id=course_id,
-            course_name='test'
-        )
-        views.db.session.add(course)
+    def test_bulk_refresh(self, m):
+        self.add_bulk_courses(m)
+        queue = self.swap_bulk_queue()
+        self.set_config(BULK_REFRESH_CONCURRENCY=1)
 
-        quiz = Quiz(
-            canvas_id=1,
-            course_id=course.id
-        )
-        views.db.session.add(quiz)
+        response = self.client.post('/bulk_refresh/')
+        self.assert403(response)
 
-        views.db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
 
-        extension = Extension(
-            course_id=course.id,
-            user_id=5,
-            percent=200
-        )
-        views.db.session.add(extension)
-        views.db.session.commit()
+        response = self.client.post('/bulk_refresh/')
+        self.assertStatus(response, 202)
+        run_id = response.json['run_id']
+
+        # Only one course is refreshed at a time.
+        self.assertEqual(len(queue.job_ids), 1)
+        progress = self.client.get(response.json['run_url']).json
+        self.assertEqual(progress['status'], 'running')
+        self.assertEqual(progress['total'], 2)
+        self.assertEqual(progress['done'], 0)
+
+        SimpleWorker([queue], connection=queue.connection).work(burst=True)
+
+        progress = self.client.get('/bulk_refresh/{}/'.format(run_id)).json
+        self.assertEqual(progress['status'], 'complete')
+        self.assertEqual(progress['done'], 2)
+        self.assertEqual(progress['failed'], 1)
+        self.assertEqual(progress['quizzes_updated'], 0)
+        self.assertEqual(list(progress['failures']), ['2'])
+
+        # A course finished again, e.g. by a resumed job, isn't counted twice.
+        views.finish_bulk_course(run_id, 1, {'status': 'complete', 'quizzes_updated': 3})
+        progress = self.client.get('/bulk_refresh/{}/'.format(run_id)).json
+        self.assertEqual(progress['done'], 2)
+        self.assertEqual(progress['quizzes_updated'], 0)
+
+        self.assert404(self.client.get('/bulk_refresh/not-a-run/'))
+
+    def test_bulk_refresh_resume(self, m):
+        self.add_bulk_courses(m)
+        queue = self.swap_bulk_queue()
+        self.set_config(BULK_REFRESH_CONCURRENCY=1)
+
+        with self.client.session_transaction() as sess:
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        run_id = views.start_bulk_refresh()
+
+        # Nothing to do while the first course's job is still queued.
+        self.assertEqual(views.resume_bulk_refresh(run_id), 0)
+        self.assertEqual(len(queue.job_ids), 1)
+
+        # The worker was restarted and lost the job.
+        Job.fetch(queue.job_ids[0], connection=queue.connection).delete()
+
+        response = self.client.post('/bulk_refresh/{}/resume/'.format(run_id))
+        self.assertStatus(response, 202)
+        self.assertEqual(len(queue.job_ids), 1)
+
+        SimpleWorker([queue], connection=queue.connection).work(burst=True)
+
+        progress = views.bulk_refresh_progress(run_id)
+        self.assertEqual(progress['status'], 'complete')
+        self.assertEqual(progress['done'], 2)
+
+    def test_import(self, m):
+        queue = self.swap_bulk_queue()
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/enrollments',
+            json=[
+                {'user_id': 11, 'user': {'id': 11, 'sortable_name': 'Student 11',
+                                         'sis_user_id': 'S11'}},
+                {'user_id': 12, 'user': {'id': 12, 'sortable_name': 'Student 12',
+                                         'sis_user_id': 'S12'}}
+            ]
+        )
+        m.register_uri('GET', '/api/v1/courses/2/enrollments', status_code=404)
+        m.register_uri('GET', '/api/v1/courses/1', json={'id': 1, 'name': 'Example Course'})
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[{'id': 4, 'title': 'Quiz 4', 'time_limit': 10}]
+        )
+        m.register_uri('POST', requests_mock.ANY, status_code=200)
+
+        csv_file = (
+            b'\xef\xbb\xbfSIS_User_ID,course_id,percent\n'
+            b'S11,1,150\n'
+            b'S12,1,120\n'
+            b'S13,1,200\n'
+            b'S12,1,200\n'
+            b'S11,2,200\n'
+            b'S11,1,50\n'
+        )
+
+        def post_import(data, filename):
+            return self.client.post(
+                '/import/',
+                data={'file': (io.BytesIO(data), filename)},
+                content_type='multipart/form-data'
+            )
+
+        self.assert403(post_import(csv_file, 'accommodations.csv'))
+
+        with self.client.session_transaction() as sess:
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        self.assert400(post_import(csv_file, 'accommodations.txt'))
+
+        response = post_import(csv_file, 'accommodations.csv')
+        self.assertStatus(response, 202)
+        import_job_id = response.json['import_job_url'].rstrip('/').rsplit('/', 1)[-1]
+        SimpleWorker([queue], connection=queue.connection).work(burst=True)
+        result = Job.fetch(import_job_id, connection=queue.connection).result
+
+        self.assertEqual(result['status'], 'complete')
+        self.assertEqual(result['rows'], 6)
+        self.assertEqual(result['imported'], 2)
+        self.assertEqual(
+            result['errors'],
+            [
+                {'line': 4, 'error': 'No active student with SIS ID S13 in course #1.'},
+                {'line': 6, 'error': 'Unable to get students in course #2.'},
+                {'line': 7, 'error': '`percent` must be a whole number of at least 100.'}
+            ]
+        )
+        self.assertEqual(list(result['jobs']), [1])
+        self.assertEqual(views.conn.keys('quizext:import:*'), [])
+
+        users = User.query.order_by(User.canvas_id).all()
+        self.assertEqual(
+            [(user.canvas_id, user.sis_id, user.sortable_name) for user in users],
+            [(11, 'S11', 'Student 11'), (12, 'S12', 'Student 12')]
+        )
+        extensions = Extension.query.order_by(Extension.user_id).all()
+        self.assertEqual([ext.percent for ext in extensions], [150, 200])
+
+        # One job updates every imported student in the course, without
+        # looking them up or saving them again.
+        update_job = Job.fetch(result['jobs'][1], connection=queue.connection)
+        self.assertEqual(
+            update_job.args[1],
+            {
+                'groups': [
+                    {'percent': 150, 'user_ids': ['11']},
+                    {'percent': 200, 'user_ids': ['12']}
+                ],
+                'saved': True
+            }
+        )
+        self.assertEqual(update_job.result['status'], 'complete')
+        self.assertFalse(any('/users/' in request.path for request in m.request_history))
+
+    def test_import_resumed(self, m):
+        queue = self.swap_bulk_queue()
+        self.set_config(IMPORT_BATCH_SIZE=1)
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/enrollments',
+            json=[{'user_id': 11, 'user': {'id': 11, 'sis_user_id': 'S11'}}]
+        )
+        roster_2 = m.register_uri(
+            'GET',
+            '/api/v1/courses/2/enrollments',
+            exc=utils.DeadlineExceeded('Canvas took too long to respond. Please try again.')
+        )
+
+        job = views.start_import([
+            b'{"sis_user_id": "S11", "course_id": 1, "percent": 150}\n',
+            b'{"sis_user_id": "S12", "course_id": 2, "percent": 200}\n'
+        ], 'jsonl')
+        worker = SimpleWorker([queue], connection=queue.connection)
+        worker.work(burst=True)
+
+        job.refresh()
+        self.assertEqual(job.meta['status'], 'failed')
+        self.assertTrue(views.is_retryable(job))
+        # The first batch was saved before the deadline ran out.
+        self.assertEqual(Extension.query.count(), 1)
+
+        roster_2 = m.register_uri(
+            'GET',
+            '/api/v1/courses/2/enrollments',
+            json=[{'user_id': 12, 'user': {'id': 12, 'sis_user_id': 'S12'}}]
+        )
+        self.assertTrue(views.requeue_job(job))
+        worker.work(burst=True)
+
+        job.refresh()
+        self.assertEqual(job.meta['status'], 'complete')
+        self.assertEqual(job.meta['imported'], 2)
+        self.assertEqual(roster_2.call_count, 1)
+        self.assertEqual(Extension.query.count(), 2)
+
+    def test_schedule_sweeps(self, m):
+        self.add_bulk_courses(m)
+        queue = self.swap_bulk_queue()
+        worker = SimpleWorker([queue], connection=queue.connection)
+        # Every course is due straight away.
+        self.set_config(REFRESH_SWEEP_INTERVAL=0)
+
+        def sweep():
+            job_ids = set(queue.job_ids)
+            self.assertEqual(sorted(views.schedule_sweeps()), [1, 2])
+            jobs = [
+                Job.fetch(job_id, connection=queue.connection)
+                for job_id in queue.job_ids if job_id not in job_ids
+            ]
+            worker.work(burst=True)
+            return {
+                job.args[0]: Job.fetch(job.id, connection=queue.connection).result
+                for job in jobs
+            }
+
+        results = sweep()
+        self.assertEqual(results[1]['status_msg'], 'Complete. No quizzes required updates.')
+        # Course 2 isn't in Canvas, so it is checked again next time.
+        self.assertEqual(results[2]['status'], 'failed')
+        self.assertEqual(views.conn.hkeys(views.SWEEP_FINGERPRINT_KEY), [b'1'])
+
+        results = sweep()
+        self.assertEqual(results[1]['status_msg'], 'Complete. No quizzes have changed.')
+        self.assertEqual(results[2]['status_msg'], 'Course not found.')
+
+        # A course whose quizzes change is refreshed again.
+        m.register_uri('GET', '/api/v1/courses/1/quizzes', json=[{'id': 5, 'title': 'Quiz 5'}])
+        m.register_uri('GET', '/api/v1/courses/1/enrollments', json=[])
+        results = sweep()
+        self.assertEqual(results[1]['status'], 'complete')
+        self.assertNotEqual(results[1]['status_msg'], 'Complete. No quizzes have changed.')
+
+        # Courses without active extensions are dropped from the schedule.
+        Extension.query.update({'active': False})
+        views.db.session.commit()
+        self.assertEqual(views.schedule_sweeps(), [])
+        self.assertEqual(views.conn.zcard(views.SWEEP_SCHEDULE_KEY), 0)
+        self.assertEqual(views.conn.hlen(views.SWEEP_FINGERPRINT_KEY), 0)
+
+    def test_schedule_sweeps_legacy_client(self, m):
+        # `redis.from_url` gives the legacy client, which orders zadd's
+        # arguments differently.
+        self.add_bulk_courses(m)
+        self.swap_bulk_queue()
+        views.conn = fakeredis.FakeRedis()
+        self.set_config(REFRESH_SWEEP_INTERVAL=0)
+
+        self.assertEqual(sorted(views.schedule_sweeps()), [1, 2])
+        self.assertEqual(
+            sorted(views.conn.zrange(views.SWEEP_SCHEDULE_KEY, 0, -1)),
+            [b'1', b'2']
+        )
+
+    def test_schedule_sweeps_claim(self, m):
+        self.add_bulk_courses(m)
+        self.swap_bulk_queue()
+        self.set_config(REFRESH_SWEEP_INTERVAL=60)
+        views.conn.zadd(views.SWEEP_SCHEDULE_KEY, **{'1': 0, '2': 0})
+        due = views.conn.zrangebyscore(views.SWEEP_SCHEDULE_KEY, '-inf', utils.time())
+
+        self.assertEqual(sorted(views.schedule_sweeps()), [1, 2])
+
+        # A scheduler that read the same due courses before they were
+        # moved along doesn't queue them again.
+        self.addCleanup(setattr, views.conn, 'zrangebyscore', views.conn.zrangebyscore)
+        views.conn.zrangebyscore = lambda *args, **kwargs: due
+        self.assertEqual(views.schedule_sweeps(), [])
+
+    def test_sweep_background_failed_quizzes(self, m):
+        self.add_bulk_courses(m)
+        queue = self.swap_bulk_queue()
+        worker = SimpleWorker([queue], connection=queue.connection)
+        self.set_config(CONTINUE_ON_QUIZ_FAILURE=True, QUIZ_RETRY_BACKOFF=30)
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[{'id': 1, 'title': 'Quiz 1', 'time_limit': 10}]
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/enrollments',
+            json=[{'user_id': 11, 'user': {'id': 11}}]
+        )
+        m.register_uri('POST', '/api/v1/courses/1/quizzes/1/extensions', status_code=404)
+
+        def sweep():
+            job, = views.enqueue_fair(queue, views.fair_key(1), [(views.sweep_background, (1,))])
+            worker.work(burst=True)
+            return Job.fetch(job.id, connection=queue.connection).result
+
+        # A quiz that failed is swept again, even if nothing changed.
+        result = sweep()
+        self.assertEqual(result['status'], 'complete')
+        self.assertEqual(len(result['failed_list']), 1)
+        self.assertIsNone(views.conn.hget(views.SWEEP_FINGERPRINT_KEY, 1))
+
+        m.register_uri('POST', '/api/v1/courses/1/quizzes/1/extensions', status_code=200)
+        result = sweep()
+        self.assertEqual(result['failed_list'], [])
+        self.assertIsNotNone(views.conn.hget(views.SWEEP_FINGERPRINT_KEY, 1))
+
+    def test_scheduler_tick(self, m):
+        self.add_bulk_courses(m)
+        self.swap_bulk_queue()
+        self.set_config(REFRESH_SWEEP_INTERVAL=0)
+
+        def broken_sweeps():
+            raise RedisError('Connection refused')
+
+        self.addCleanup(setattr, views, 'schedule_sweeps', views.schedule_sweeps)
+        schedule_sweeps, views.schedule_sweeps = views.schedule_sweeps, broken_sweeps
+
+        # An error is logged rather than stopping the scheduler.
+        views.scheduler_tick()
+
+        views.schedule_sweeps = schedule_sweeps
+        views.scheduler_tick()
+        self.assertEqual(views.conn.zcard(views.SWEEP_SCHEDULE_KEY), 2)
+
+    def test_schedule_sweeps_before_unlock(self, m):
+        from datetime import datetime, timedelta
+
+        self.add_bulk_courses(m)
+        queue = self.swap_bulk_queue()
+        worker = SimpleWorker([queue], connection=queue.connection)
+        self.set_config(REFRESH_SWEEP_INTERVAL=60 * 60 * 24 * 7, REFRESH_UNLOCK_LEAD=60 * 60)
+
+        def canvas_time(value):
+            return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        unlock_at = datetime.utcnow().replace(microsecond=0) + timedelta(hours=3)
+        m.register_uri('GET', '/api/v1/courses/1/quizzes', json=[
+            {'id': 1, 'title': 'Quiz 1', 'time_limit': 10, 'unlock_at': canvas_time(unlock_at)},
+            {
+                'id': 2, 'title': 'Quiz 2', 'time_limit': 10,
+                'unlock_at': canvas_time(unlock_at + timedelta(days=1))
+            },
+            # Too close to unlocking to be checked ahead of time.
+            {
+                'id': 3, 'title': 'Quiz 3', 'time_limit': 10,
+                'unlock_at': canvas_time(datetime.utcnow() + timedelta(minutes=30))
+            },
+            # Extensions don't change untimed quizzes.
+            {
+                'id': 4, 'title': 'Quiz 4',
+                'unlock_at': canvas_time(unlock_at - timedelta(minutes=30))
+            }
+        ])
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/enrollments',
+            json=[{'user_id': 11, 'user': {'id': 11}}]
+        )
+        # None of the quizzes can be extended, so none are saved, but the
+        # sweep still sees when they unlock.
+        m.register_uri('POST', requests_mock.ANY, status_code=404)
+
+        # The regular check is a week away.
+        views.conn.zadd(views.SWEEP_SCHEDULE_KEY, **{'1': utils.time() + 60 * 60 * 24 * 7})
+        views.enqueue_fair(queue, views.fair_key(1), [(views.sweep_background, (1,))])
+        worker.work(burst=True)
+        self.assertEqual(Quiz.query.count(), 0)
+
+        views.schedule_sweeps()
+
+        pre_unlock = utils.to_timestamp(unlock_at - timedelta(hours=1))
+        self.assertEqual(views.conn.zscore(views.SWEEP_SCHEDULE_KEY, '1'), pre_unlock)
+
+        # Once due, the course is queued and put back on the regular
+        # schedule, then brought forward again for the next unlock.
+        views.conn.zadd(views.SWEEP_SCHEDULE_KEY, **{'1': 0})
+        self.assertEqual(views.schedule_sweeps(), [1])
+        self.assertEqual(len(queue.job_ids), 1)
+        self.assertGreater(views.conn.zscore(views.SWEEP_SCHEDULE_KEY, '1'), pre_unlock)
+
+        self.assertEqual(views.schedule_sweeps(), [])
+        self.assertEqual(views.conn.zscore(views.SWEEP_SCHEDULE_KEY, '1'), pre_unlock)
+
+        # Unlocks are forgotten along with the course.
+        Extension.query.update({'active': False})
+        views.db.session.commit()
+        views.schedule_sweeps()
+        self.assertEqual(views.conn.hlen(views.SWEEP_UNLOCKS_KEY), 0)
+
+    def test_refresh_background_no_course(self, m):
+        from views import refresh_background
+
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        course_id = 1
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            status_code=404
+        )
+
+        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        self.worker.work(burst=True)
+
+        self.assertTrue(job.is_finished)
+        job_result = job.result
+
+        meta_keys = ['status', 'status_msg', 'percent', 'error']
+        self.assertTrue(all(key in job_result for key in meta_keys))
+        self.assertEqual(job_result['status'], 'failed')
+        self.assertEqual(job_result['status_msg'], 'Course not found.')
+        self.assertEqual(job_result['percent'], 0)
+        self.assertTrue(job_result['error'])
+
+    def test_refresh_background_no_missing_quizzes(self, m):
+        from views import refresh_background
+
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        course_id = 1
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[{'id': 3, 'title': 'Quiz 3'}]
+        )
+
+        quiz = Quiz(3, course_id)
+        views.db.session.add(quiz)
+        views.db.session.commit()
+
+        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        self.worker.work(burst=True)
+
+        self.assertTrue(job.is_finished)
+        job_result = job.result
+
+        meta_keys = ['status', 'status_msg', 'percent', 'error']
+        self.assertTrue(all(key in job_result for key in meta_keys))
+
+        self.assertEqual(job_result['status'], 'complete')
+        self.assertEqual(job_result['status_msg'], 'Complete. No quizzes required updates.')
+        self.assertEqual(job_result['percent'], 100)
+        self.assertFalse(job_result['error'])
+
+    def test_refresh_background_skipped_quizzes(self, m):
+        from views import refresh_background
+
+        self.set_config(SKIP_UNPUBLISHED_QUIZZES=True)
+        m.register_uri('GET', '/api/v1/courses/1', json={'id': 1, 'name': 'Example Course'})
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[{'id': 1, 'title': 'Quiz 1', 'time_limit': 10, 'published': False}]
+        )
+
+        course = Course(1, course_name='Example Course')
+        user = User(12345, sortable_name='John Smith')
+        views.db.session.add_all([course, user])
+        views.db.session.commit()
+        views.db.session.add(Extension(course.id, user.id))
+        views.db.session.commit()
+
+        # Quizzes the filters skip are never saved, so they mustn't make
+        # every refresh look up the roster.
+        job = self.queue.enqueue_call(func=refresh_background, args=(1,))
+        self.worker.work(burst=True)
+        self.assertEqual(job.result['status_msg'], 'Complete. No quizzes required updates.')
+        self.assertFalse(any('/enrollments' in request.path for request in m.request_history))
+
+    def test_refresh_background_update_error(self, m):
+        from views import refresh_background
+
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        course_id = 1
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/{}'.format(course_id),
+            json={'id': course_id, 'name': 'Example Course'}
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[{'id': 1, 'title': 'Quiz 1', 'time_limit': 10}]
+        )
+        m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/1/extensions',
+            status_code=404
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/enrollments',
+            json=[{'user_id': 12345, 'user': {'id': 12345, 'sortable_name': 'John Smith'}}]
+        )
+
+        course = Course(course_id, course_name='Example Course')
+        views.db.session.add(course)
+
+        user = User(12345, sortable_name="John Smith")
+        views.db.session.add(user)
+
+        views.db.session.commit()
+
+        ext = Extension(course.id, user.id)
+        views.db.session.add(ext)
+        views.db.session.commit()
+
+        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        self.worker.work(burst=True)
+
+        self.assertTrue(job.is_finished)
+        job_result = job.result
+
+        meta_keys = ['status', 'status_msg', 'percent', 'error']
+        self.assertTrue(all(key in job_result for key in meta_keys))
+
+        self.assertEqual(job_result['status'], 'failed')
+        self.assertTrue(job_result['error'])
+        self.assertEqual(
+            job_result['status_msg'],
+            (
+                'Some quizzes couldn\'t be updated. Error creating extension '
+                'for quiz #1. Canvas status code: 404'
+            )
+        )
+
+    def test_refresh_background_missing_user(self, m):
+        from views import refresh_background
+
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        course_id = 1
+        user_id = 9001
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/{}'.format(course_id),
+            json={
+                'id': course_id,
+                'name': 'Example Course'
+            }
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/{}/quizzes'.format(course_id),
+            json=[
+                {'id': 1, 'title': 'Quiz 1', 'time_limit': 10},
+                {'id': 2, 'title': 'Quiz 2', 'time_limit': 30}
+            ]
+        )
+        m.register_uri(
+            'POST',
+            '/api/v1/courses/{}/quizzes/1/extensions'.format(course_id),
+            status_code=200
+        )
+        m.register_uri(
+            'POST',
+            '/api/v1/courses/{}/quizzes/2/extensions'.format(course_id),
+            status_code=200
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/{}/enrollments'.format(course_id),
+            json=[]
+        )
+
+        course = Course(course_id, course_name='Example Course')
+        views.db.session.add(course)
+        user = User(user_id, sortable_name="Missing User")
+        views.db.session.add(user)
+
+        views.db.session.commit()
+
+        ext = Extension(course.id, user.id)
+        views.db.session.add(ext)
+
+        views.db.session.commit()
+
+        # Check that the extension is active first
+        self.assertTrue(ext.active)
+        ext_id = ext.id
+
+        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        self.worker.work(burst=True)
+        self.assertTrue(job.is_finished)
+
+        # Ensure extension has been marked as inactive.
+        extension = views.db.session.query(Extension).filter_by(id=ext_id).first()
+        self.assertFalse(extension.active)
+
+    def test_refresh_background_inactive_user(self, m):
+        from views import refresh_background
+
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        course_id = 1
+        user_id = 9001
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/{}'.format(course_id),
+            json={
+                'id': course_id,
+                'name': 'Example Course'
+            }
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/{}/quizzes'.format(course_id),
+            json=[
+                {'id': 1, 'title': 'Quiz 1', 'time_limit': 10},
+                {'id': 2, 'title': 'Quiz 2', 'time_limit': 30}
+            ]
+        )
+        m.register_uri(
+            'POST',
+            '/api/v1/courses/{}/quizzes/1/extensions'.format(course_id),
+            status_code=200
+        )
+        m.register_uri(
+            'POST',
+            '/api/v1/courses/{}/quizzes/2/extensions'.format(course_id),
+            status_code=200
+        )
+        # Canvas only lists active students, so an inactive one is missing
+        # from the roster.
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/{}/enrollments'.format(course_id),
+            json=[{'user_id': 42, 'user': {'id': 42, 'sortable_name': 'Other Student'}}]
+        )
+
+        course = Course(course_id, course_name='Example Course')
+        views.db.session.add(course)
+        user = User(user_id, sortable_name="Missing User")
+        views.db.session.add(user)
+
+        views.db.session.commit()
+
+        ext = Extension(course.id, user.id)
+        views.db.session.add(ext)
+
+        views.db.session.commit()
+
+        # Check that the extension is active first
+        self.assertTrue(ext.active)
+        ext_id = ext.id
+
+        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        self.worker.work(burst=True)
+        self.assertTrue(job.is_finished)
+
+        # Ensure extension has been marked as inactive.
+        extension = views.db.session.query(Extension).filter_by(id=ext_id).first()
+        self.assertFalse(extension.active)
+
+    def test_refresh_background_update_success(self, m):
+        from views import refresh_background
+
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        course_id = 1
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/{}'.format(course_id),
+            json={
+                'id': course_id,
+                'name': 'Example Course'
+            }
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[
+                {'id': 1, 'title': 'Quiz 1', 'time_limit': 10},
+                {'id': 2, 'title': 'Quiz 2', 'time_limit': 30}
+            ]
+        )
+        m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/1/extensions',
+            status_code=200
+        )
+        m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/2/extensions',
+            status_code=200
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/enrollments',
+            json=[{'user_id': 12345, 'user': {'id': 12345, 'sortable_name': 'John Smith'}}]
+        )
+
+        course = Course(course_id, course_name='Example Course')
+        views.db.session.add(course)
+
+        user = User(12345, sortable_name="John Smith")
+        views.db.session.add(user)
+
+        views.db.session.commit()
+
+        ext = Extension(course.id, user.id)
+        views.db.session.add(ext)
+
+        # Add an inactive extension to be ignored.
+        ext_inactive = Extension(course.id, user.id)
+        ext_inactive.active = False
+        views.db.session.add(ext_inactive)
+
+        views.db.session.commit()
+
+        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        self.worker.work(burst=True)
+        self.assertTrue(job.is_finished)
+        job_result = job.result
+
+        meta_keys = ['status', 'status_msg', 'percent', 'error']
+        self.assertTrue(all(key in job_result for key in meta_keys))
+
+        self.assertEqual(job_result['status'], 'complete')
+        self.assertFalse(job_result['error'])
+        self.assertEqual(
+            job_result['status_msg'],
+            '2 quizzes have been updated.'
+        )
+        self.assertEqual(job_result['percent'], 100)
+        self.assertEqual(
+            job_result['quiz_list'],
+            [{'title': 'Quiz 1', 'added_time': 0}, {'title': 'Quiz 2', 'added_time': 0}]
+        )
+        self.assertEqual(job_result['unchanged_list'], [])
+        self.assertEqual(job_result['failed_list'], [])
+        self.assertEqual(job_result['quizzes_updated'], 2)
+
+        # Refreshing again finds nothing left to post.
+        Quiz.query.delete()
+        views.db.session.commit()
+        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        self.worker.work(burst=True)
+        self.assertEqual(job.result['status'], 'complete')
+        self.assertEqual(job.result['quizzes_updated'], 0)
+        self.assertFalse(any('/users/' in request.path for request in m.request_history))
+
+        # Without the roster there's no telling who is still enrolled.
+        m.register_uri('GET', '/api/v1/courses/1/enrollments', status_code=500)
+        Quiz.query.delete()
+        views.db.session.commit()
+        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        self.worker.work(burst=True)
+        self.assertEqual(job.result['status'], 'failed')
+        self.assertEqual(
+            job.result['status_msg'],
+            'Unable to get the course roster from Canvas.'
+        )
+        self.assertEqual(Extension.query.filter_by(active=True).count(), 1)
+
+    def test_refresh_background_changed_time_limit(self, m):
+        from views import refresh_background
+
+        course_id = 1
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[
+                {'id': 1, 'title': 'Quiz 1', 'time_limit': 10},
+                {'id': 2, 'title': 'Quiz 2', 'time_limit': 45}
+            ]
+        )
+        quiz_1_post = m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/1/extensions',
+            status_code=200
+        )
+        quiz_2_post = m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/2/extensions',
+            status_code=200
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/enrollments',
+            json=[{'user_id': 12345, 'user': {'id': 12345, 'sortable_name': 'John Smith'}}]
+        )
+
+        course = Course(course_id, course_name='Example Course')
+        user = User(12345, sortable_name='John Smith')
+        views.db.session.add_all([course, user])
+        views.db.session.commit()
+
+        # Quiz 2's time limit was changed from 30 to 45 minutes in Canvas.
+        views.db.session.add_all([
+            Extension(course.id, user.id, percent=200),
+            Quiz(1, course.id, 'Quiz 1', time_limit=10),
+            Quiz(2, course.id, 'Quiz 2', time_limit=30)
+        ])
+        views.db.session.commit()
+
+        job = self.queue.enqueue_call(func=refresh_background, args=(course_id,))
+        self.worker.work(burst=True)
+
+        self.assertEqual(job.result['status'], 'complete')
+        self.assertEqual(job.result['status_msg'], '1 quizzes have been updated.')
+        self.assertEqual(quiz_1_post.call_count, 0)
+        self.assertEqual(quiz_2_post.call_count, 1)
+        self.assertEqual(
+            quiz_2_post.last_request.json(),
+            {'quiz_extensions': [{'user_id': 12345, 'extra_time': 45}]}
+        )
+
+        quiz = Quiz.query.filter_by(canvas_id=2).first()
+        self.assertEqual(quiz.time_limit, 45)
+        self.assertEqual(len(quiz.content_hash), 40)
+
+    def test_missing_quizzes_check_no_course(self, m):
+        course_id = 1
+        response = self.client.get('/missing_quizzes/{}/'.format(course_id))
+
+        self.assert_200(response)
+        self.assertEqual(response.data, 'false')
+
+    def test_missing_quizzes_check_no_extensions(self, m):
+        course_id = 1
+
+        course = Course(
+            canvas_id=course_id,
+            course_name='test'
+        )
+        views.db.session.add(course)
+        views.db.session.commit()
+
+        response = self.client.get('/missing_quizzes/{}/'.format(course_id))
+
+        self.assert_200(response)
+        self.assertEqual(response.data, 'false')
+
+    def test_missing_quizzes_check_true(self, m):
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[{'id': 1, 'title': 'Quiz 1'}]
+        )
+
+        course_id = 1
+
+        course = Course(
+            canvas_id=course_id,
+            course_name='test'
+        )
+        views.db.session.add(course)
+        views.db.session.commit()
+
+        extension = Extension(
+            course_id=course.id,
+            user_id=5,
+            percent=200
+        )
+        views.db.session.add(extension)
+        views.db.session.commit()
+
+        response = self.client.get('/missing_quizzes/{}/'.format(course_id))
+
+        self.assert_200(response)
+        self.assertEqual(response.data, 'true')
+
+    def test_missing_quizzes_check_false(self, m):
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[{'id': 1, 'title': 'Quiz 1'}]
+        )
+
+        course_id = 1
+
+        course = Course(
+            canvas_id=course_id,
+            course_name='test'
+        )
+        views.db.session.add(course)
+
+        quiz = Quiz(
+            canvas_id=1,
+            course_id=course.id
+        )
+        views.db.session.add(quiz)
+
+        views.db.session.commit()
+
+        extension = Extension(
+            course_id=course.id,
+            user_id=5,
+            percent=200
+        )
+        views.db.session.add(extension)
+        views.db.session.commit()
+
+        response = self.client.get('/missing_quizzes/{}/'.format(course_id))
+
+        self.assert_200(response)
+        self.assertEqual(response.data, 'false')
+
+    def test_filter_no_students_found(self, m):
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/search_users',
+            json=[]
+        )
+
+        course_id = 1
+        response = self.client.get('/filter/{}/'.format(course_id))
+        self.assert_200(response)
+        self.assert_template_used('user_list.html')
+        self.assertEqual(len(self.get_context_variable('users')), 0)
+        self.assertEqual(self.get_context_variable('max_pages'), 1)
+
+    def test_filter(self, m):
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/search_users',
+            json=[
+                {'id': 1, 'name': 'John Smith'},
+                {'id': 2, 'name': 'Jane Doe'}
+            ],
+            headers={
+                "Link": "<http://example.com/api/v1/courses/1/search_users?page=99>; rel=\"last\""
+            }
+        )
+
+        course_id = 1
+        response = self.client.get('/filter/{}/'.format(course_id))
+        self.assert_200(response)
+        self.assert_template_used('user_list.html')
+        self.assertEqual(len(self.get_context_variable('users')), 2)
+        self.assertEqual(self.get_context_variable('max_pages'), 99)
+
+    def test_filter_canvas_unavailable(self, m):
+        with self.client.session_transaction() as sess:
+            sess['canvas_user_id'] = 1234
+            sess['lti_logged_in'] = True
+            sess['is_admin'] = True
+
+        self.set_config(CANVAS_BREAKER_FAILURES=1)
+        search_users = m.register_uri(
+            'GET',
+            '/api/v1/courses/1/search_users',
+            status_code=503
+        )
+
+        response = self.client.get('/filter/1/')
+        self.assertStatus(response, 503)
+        self.assert_template_used('error.html')
+        self.assertEqual(search_users.call_count, 1)
+
+        # The breaker is open now, so Canvas isn't asked again.
+        response = self.client.get('/filter/1/', headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertStatus(response, 503)
+        self.assertIn(b'Canvas is not responding', response.data)
+        self.assertEqual(search_users.call_count, 1)
+
+    def test_update_background_canvas_unavailable(self, m):
+        from views import update_background
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
+        )
+        utils.circuit_breaker.opened_at = utils.time()
+
+        job = self.queue.enqueue_call(
+            func=update_background,
+            args=(1, {'percent': '200', 'user_ids': ['11']})
+        )
+        self.worker.work(burst=True)
+
+        self.assertTrue(job.is_finished)
+        self.assertEqual(job.result['status'], 'failed')
+        self.assertTrue(job.result['error'])
+        self.assertIn('Canvas is not responding', job.result['status_msg'])
+        self.assertEqual(m.call_count, 0)
+
+    def test_update_background_deadline(self, m):
+        from views import update_background
+
+        self.set_config(JOB_DEADLINE=60)
+        self.fake_clock()
+
+        def slow_extension(request, context):
+            utils.sleep(90)
+            return {}
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            json={'id': 1, 'name': 'Example Course'}
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[
+                {'id': 4, 'title': 'Quiz 4', 'time_limit': 10},
+                {'id': 5, 'title': 'Quiz 5', 'time_limit': 30}
+            ]
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/users/11',
+            json={'id': 11, 'sortable_name': 'Joe Smyth'}
+        )
+        quiz_4_post = m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/4/extensions',
+            json=slow_extension
+        )
+        quiz_5_post = m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/5/extensions',
+            json={}
+        )
+
+        job = self.queue.enqueue_call(
+            func=update_background,
+            args=(1, {'percent': '200', 'user_ids': ['11']})
+        )
+        self.worker.work(burst=True)
+
+        self.assertTrue(job.is_finished)
+        self.assertEqual(job.result['status'], 'failed')
+        self.assertEqual(
+            job.result['status_msg'],
+            'Ran out of time before this quiz could be updated.'
+        )
+        self.assertEqual(quiz_4_post.call_count, 1)
+        self.assertEqual(quiz_5_post.call_count, 0)
+
+    def test_metrics(self, m):
+        response = self.client.get('/metrics')
+
+        self.assert_200(response)
+        self.assertIn('concurrency_limit', response.json['canvas'])
+        self.assertIn('tokens', response.json['canvas'])
+
+    def test_lti_tool_not_admin_or_instructor(self, m):
+        user_id = 42
+
+        response = self.client.post(
+            '/launch',
+            data={
+                'custom_canvas_course_id': 'test',
+                'custom_canvas_user_id': user_id,
+                'custom_canvas_api_domain': config.TESTING_API_URL,
+                'ext_roles': []
+            }
+        )
+        self.assert_200(response)
+        self.assert_template_used('error.html')
+        self.assertEqual(
+            self.get_context_variable('message'),
+            'Must be an Administrator or Instructor'
+        )
+
+    def test_lti_tool(self, m):
+        user_id = 42
+
+        with self.client as c:
+            response = c.post(
+                '/launch',
+                data={
+                    'custom_canvas_course_id': 'test',
+                    'custom_canvas_user_id': user_id,
+                    'custom_canvas_api_domain': config.TESTING_API_URL,
+                    'ext_roles': 'Administrator'
+                }
+            )
+            self.assert200(response)
+            self.assertTrue(session.get('is_admin', False))
+
+
+@requests_mock.Mocker()
+class UtilTests(TestHelpers, flask_testing.TestCase):
+
+    def create_app(self):
+        app = views.app
+        app.config['TESTING'] = True
+        app.config['DEBUG'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/test.db'
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.config['threaded'] = True
+        return app
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        views.db.init_app(self.app)
+        with self.app.test_request_context():
+            views.db.create_all()
+
+        self.conn, utils.conn = utils.conn, fakeredis.FakeStrictRedis()
+        utils.conn.flushall()
+
+        self.addCleanup(setattr, utils, 'circuit_breaker', utils.circuit_breaker)
+        utils.circuit_breaker = utils.CircuitBreaker()
+
+        self.addCleanup(setattr, utils, 'response_cache', utils.response_cache)
+        utils.response_cache = utils.ResponseCache(config.CANVAS_CACHE_SIZE, listen=False)
+
+    def tearDown(self):
+        utils.conn = self.conn
+        logging.disable(logging.NOTSET)
+        views.db.session.remove()
+        views.db.drop_all()
+
+    def test_canvas_request_retries_transient_error(self, m):
+        from utils import canvas_request
+
+        self.set_config(CANVAS_RETRY_BACKOFF=0)
+
+        adapter = m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            [
+                {'status_code': 503},
+                {'status_code': 429, 'headers': {'Retry-After': '0'}},
+                {'status_code': 200, 'json': {'id': 1}}
+            ]
+        )
+
+        response = canvas_request('GET', '{}courses/1'.format(config.API_URL))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(adapter.call_count, 3)
+
+    def test_canvas_request_limited_post_retries(self, m):
+        from utils import canvas_request
+
+        self.set_config(CANVAS_RETRY_BACKOFF=0)
+
+        adapter = m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/2/extensions',
+            status_code=500
+        )
+
+        response = canvas_request(
+            'POST',
+            '{}courses/1/quizzes/2/extensions'.format(config.API_URL)
+        )
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(adapter.call_count, config.CANVAS_POST_RETRIES + 1)
+
+    def test_canvas_request_not_retried(self, m):
+        from utils import canvas_request
+
+        adapter = m.register_uri('GET', '/api/v1/courses/1', status_code=404)
+
+        response = canvas_request('GET', '{}courses/1'.format(config.API_URL))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(adapter.call_count, 1)
+
+    def test_retry_delay(self, m):
+        from utils import retry_delay
+
+        response = requests.Response()
+        response.headers['Retry-After'] = '12'
+        self.assertEqual(retry_delay(0, response), 12)
+
+        response.headers['Retry-After'] = '3600'
+        self.assertEqual(retry_delay(0, response), config.CANVAS_RETRY_MAX_BACKOFF)
+
+        delay = retry_delay(2)
+        self.assertTrue(0 <= delay <= config.CANVAS_RETRY_BACKOFF * 4)
+
+    def test_adaptive_limiter(self, m):
+        from utils import AdaptiveLimiter
+
+        def canvas_response(remaining, status_code=200, text=''):
+            response = requests.Response()
+            response.status_code = status_code
+            response._content = text.encode('utf-8')
+            response.headers['X-Rate-Limit-Remaining'] = str(remaining)
+            response.headers['X-Request-Cost'] = '1.5'
+            return response
+
+        limiter = AdaptiveLimiter(8, 1, 10)
+
+        # Plenty of budget left: the limit grows by one per round trip.
+        for i in range(10):
+            limiter.acquire()
+            limiter.release(canvas_response(config.CANVAS_RATE_LIMIT_HIGH))
+        self.assertEqual(limiter.metrics()['concurrency_limit'], 9)
+
+        # Budget running low: back off before Canvas starts refusing requests.
+        limiter.acquire()
+        limiter.release(canvas_response(config.CANVAS_RATE_LIMIT_LOW - 1))
+        self.assertEqual(limiter.metrics()['concurrency_limit'], 4)
+
+        # Only one cut per interval, however many responses report it.
+        limiter.acquire()
+        limiter.release(canvas_response(config.CANVAS_RATE_LIMIT_LOW - 1))
+        self.assertEqual(limiter.metrics()['concurrency_limit'], 4)
+
+        limiter._last_decrease = 0
+        limiter.acquire()
+        limiter.release(
+            canvas_response(600, status_code=403, text='403 Forbidden (Rate Limit Exceeded)')
+        )
+        limiter._last_decrease = 0
+        limiter.acquire()
+        limiter.release(canvas_response(0))
+        limiter._last_decrease = 0
+        limiter.acquire()
+        limiter.release(canvas_response(0))
+
+        self.assertEqual(
+            limiter.metrics(),
+            {
+                'concurrency_limit': 1,
+                'in_flight': 0,
+                'rate_limit_remaining': 0,
+                'request_cost': 1.5
+            }
+        )
+
+    def test_adaptive_limiter_deadline(self, m):
+        from utils import AdaptiveLimiter, deadline, DeadlineExceeded
+
+        limiter = AdaptiveLimiter(1, 1, 1)
+        limiter.acquire()
+
+        # No room frees up, so the wait ends with the deadline.
+        with deadline(0.05):
+            with self.assertRaises(DeadlineExceeded):
+                limiter.acquire()
+        self.assertEqual(limiter.metrics()['in_flight'], 1)
+
+        # Room freed up by another request is picked up before the deadline.
+        timer = threading.Timer(0.05, limiter.release)
+        timer.start()
+        with deadline(5):
+            limiter.acquire()
+        timer.join()
+        self.assertEqual(limiter.metrics()['in_flight'], 1)
+
+    def test_canvas_request_rate_limit_exceeded(self, m):
+        from utils import canvas_request
+
+        self.set_config(CANVAS_RETRY_BACKOFF=0)
+
+        adapter = m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            [
+                {'status_code': 403, 'text': '403 Forbidden (Rate Limit Exceeded)'},
+                {'status_code': 200, 'json': {'id': 1}}
+            ]
+        )
+
+        response = canvas_request('GET', '{}courses/1'.format(config.API_URL))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(adapter.call_count, 2)
+
+    def test_canvas_request_token_refused(self, m):
+        from utils import canvas_request, token_label, TokenPool
+
+        self.addCleanup(setattr, utils, 'token_pool', utils.token_pool)
+        utils.token_pool = TokenPool(['a', 'b'])
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            request_headers={'Authorization': 'Bearer a'},
+            status_code=401,
+            headers={'WWW-Authenticate': 'Bearer realm="canvas-lms"'},
+            json={'errors': [{'message': 'Invalid access token.'}]}
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            request_headers={'Authorization': 'Bearer b'},
+            json={'id': 1},
+            headers={'X-Rate-Limit-Remaining': '600'}
+        )
+
+        for _ in range(2):
+            response = canvas_request('GET', '{}courses/1'.format(config.API_URL))
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(m.call_count, 3)
+
+        metrics = utils.token_pool.metrics()
+        self.assertFalse(metrics[token_label('a')]['healthy'])
+        self.assertEqual(metrics[token_label('a')]['refused'], 1)
+        self.assertTrue(metrics[token_label('b')]['healthy'])
+        self.assertEqual(metrics[token_label('b')]['requests'], 2)
+        self.assertEqual(metrics[token_label('b')]['rate_limit_remaining'], 600)
+
+    def test_is_token_refused(self, m):
+        from utils import is_token_refused
+
+        def canvas_response(status_code, text='', headers=None):
+            response = requests.Response()
+            response.status_code = status_code
+            response._content = text.encode('utf-8')
+            response.headers.update(headers or {})
+            return response
+
+        self.assertTrue(is_token_refused(
+            canvas_response(401, headers={'WWW-Authenticate': 'Bearer realm="canvas-lms"'})
+        ))
+        self.assertTrue(is_token_refused(
+            canvas_response(401, '{"errors": [{"message": "Invalid access token."}]}')
+        ))
+        # The token's user isn't allowed to do this; another token
+        # wouldn't be either.
+        self.assertFalse(is_token_refused(
+            canvas_response(401, '{"status": "unauthorized", "errors": '
+                                 '[{"message": "user not authorized to perform that action"}]}')
+        ))
+        self.assertFalse(is_token_refused(canvas_response(403, '403 Forbidden')))
+        self.assertFalse(is_token_refused(
+            canvas_response(403, '403 Forbidden (Rate Limit Exceeded)')
+        ))
+        self.assertFalse(is_token_refused(canvas_response(404, 'Invalid access token')))
+
+    def test_circuit_breaker(self, m):
+        from utils import canvas_request, CanvasUnavailable
+
+        self.set_config(
+            CANVAS_BREAKER_FAILURES=2,
+            CANVAS_BREAKER_RESET_TIMEOUT=30,
+            CANVAS_RETRY_BACKOFF=0
+        )
+        self.fake_clock()
+        url = '{}courses/1'.format(config.API_URL)
+
+        adapter = m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            [
+                {'status_code': 502},
+                {'status_code': 502},
+                {'status_code': 502},
+                {'status_code': 200, 'json': {'id': 1}}
+            ]
+        )
+
+        # The breaker opens after the second failure, so no more retries are sent.
+        with self.assertRaises(CanvasUnavailable):
+            canvas_request('GET', url)
+        self.assertEqual(adapter.call_count, 2)
+        self.assertEqual(utils.circuit_breaker.state, 'open')
+
+        with self.assertRaises(CanvasUnavailable):
+            canvas_request('GET', url)
+        self.assertEqual(adapter.call_count, 2)
+
+        # After the timeout a failed probe opens it again...
+        utils.sleep(30)
+        self.assertEqual(utils.circuit_breaker.state, 'half_open')
+        with self.assertRaises(CanvasUnavailable):
+            canvas_request('GET', url)
+        self.assertEqual(adapter.call_count, 3)
+        self.assertEqual(utils.circuit_breaker.state, 'open')
+
+        # ...and a successful one closes it.
+        utils.sleep(30)
+        response = canvas_request('GET', url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(utils.circuit_breaker.state, 'closed')
+
+    def test_circuit_breaker_slow_call(self, m):
+        from utils import CircuitBreaker
+
+        self.set_config(CANVAS_BREAKER_FAILURES=1, CANVAS_BREAKER_SLOW_CALL=-1)
+
+        m.register_uri('GET', '/api/v1/courses/1', json={'id': 1})
+
+        response = utils.canvas_request('GET', '{}courses/1'.format(config.API_URL))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(utils.circuit_breaker.state, CircuitBreaker.OPEN)
+
+    def test_deadline(self, m):
+        from utils import (
+            canvas_request, check_deadline, deadline, DeadlineExceeded, remaining_time
+        )
+
+        self.set_config(CANVAS_CONNECT_TIMEOUT=5, CANVAS_READ_TIMEOUT=30)
+        self.fake_clock()
+        url = '{}courses/1'.format(config.API_URL)
+
+        m.register_uri('GET', '/api/v1/courses/1', json={'id': 1})
+
+        self.assertIsNone(remaining_time())
+        canvas_request('GET', url)
+        self.assertEqual(m.last_request.timeout, (5, 30))
+
+        with deadline(20):
+            canvas_request('GET', url)
+            self.assertEqual(m.last_request.timeout, (5, 20))
+
+            # An inner deadline can't outlast the outer one.
+            with deadline(60):
+                utils.sleep(15)
+                self.assertEqual(remaining_time(), 5)
+                canvas_request('GET', url)
+                self.assertEqual(m.last_request.timeout, (5, 5))
+
+            utils.sleep(5)
+            with self.assertRaises(DeadlineExceeded):
+                check_deadline()
+            with self.assertRaises(DeadlineExceeded):
+                canvas_request('GET', url)
+
+        self.assertIsNone(remaining_time())
+        self.assertEqual(m.call_count, 3)
+
+    def test_in_parallel_deadline(self, m):
+        from utils import check_deadline, deadline, DeadlineExceeded, in_parallel, remaining_time
+
+        self.fake_clock()
+        lock = threading.Lock()
+
+        def call(item):
+            with lock:
+                deadline_at = utils.time() + remaining_time()
+                utils.sleep(4)
+            return deadline_at
+
+        # Calls that start late get the time that is left, not a fresh
+        # copy of what was left when the pool started.
+        with deadline(20):
+            utils.sleep(5)
+            self.assertEqual(in_parallel(call, [1, 2, 3, 4], 2), [1020] * 4)
+
+        def check(item):
+            with lock:
+                utils.sleep(4)
+            check_deadline()
+
+        with deadline(10):
+            with self.assertRaises(DeadlineExceeded):
+                in_parallel(check, [1, 2, 3, 4], 2)
+
+    def test_canvas_request_retry_past_deadline(self, m):
+        from utils import canvas_request, deadline, DeadlineExceeded
+
+        self.set_config(CANVAS_RETRY_BACKOFF=0)
+        self.fake_clock()
+
+        adapter = m.register_uri(
+            'GET',
+            '/api/v1/courses/1',
+            status_code=503,
+            headers={'Retry-After': '10'}
+        )
+
+        with deadline(5):
+            with self.assertRaises(DeadlineExceeded):
+                canvas_request('GET', '{}courses/1'.format(config.API_URL))
+
+        # Waiting to retry would have gone past the deadline.
+        self.assertEqual(adapter.call_count, 1)
+
+    def test_single_flight(self, m):
+        import threading
+        import time
+        from utils import get_course
+
+        results = []
+
+        def slow_course(request, context):
+            # Ask again while this request is still in flight.
+            follower = threading.Thread(target=lambda: results.append(get_course(1)))
+            follower.start()
+            time.sleep(0.2)
+            return {'id': 1, 'name': 'Example Course'}
+
+        adapter = m.register_uri('GET', '/api/v1/courses/1', json=slow_course)
+
+        results.append(get_course(1))
+        while len(results) < 2:
+            time.sleep(0.01)
+
+        self.assertEqual(adapter.call_count, 1)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(utils.flights.metrics()['requests_in_flight'], 0)
+
+    def test_single_flight_redis(self, m):
+        from utils import get_course, FLIGHT_LOCK_KEY, FLIGHT_RESULT_KEY
+
+        self.set_config(SINGLE_FLIGHT_REDIS=True, CANVAS_CACHE_TTLS={})
+        waits = self.fake_clock()
+
+        adapter = m.register_uri('GET', '/api/v1/courses/1', json={'id': 1, 'name': 'Course'})
+
+        # The first process makes the request and shares the result.
+        self.assertEqual(get_course(1)['name'], 'Course')
+        self.assertEqual(adapter.call_count, 1)
+        result_keys = utils.conn.keys(FLIGHT_RESULT_KEY.format('*'))
+        self.assertEqual(len(result_keys), 1)
+        self.assertEqual(utils.conn.keys(FLIGHT_LOCK_KEY.format('*')), [])
+
+        # Another process is already asking, so wait for its result.
+        utils.conn.flushall()
+        key = result_keys[0].decode('utf-8')[len('quizext:flight:'):-len(':result')]
+        utils.conn.set(FLIGHT_LOCK_KEY.format(key), 1)
+
+        sleep = utils.sleep
+
+        def other_process_finishes(seconds):
+            sleep(seconds)
+            utils.conn.set(FLIGHT_RESULT_KEY.format(key), '{"id": 1, "name": "Shared"}')
+
+        utils.sleep = other_process_finishes
+
+        self.assertEqual(get_course(1)['name'], 'Shared')
+        self.assertEqual(adapter.call_count, 1)
+        self.assertEqual(len(waits), 1)
+
+    def test_response_cache(self, m):
+        from utils import get_course, get_quizzes, invalidate_cache
+
+        self.set_config(CANVAS_CACHE_TTLS={'get_course': 60})
+        self.fake_clock()
+
+        course = m.register_uri('GET', '/api/v1/courses/1', json={'id': 1, 'name': 'Course'})
+        quizzes = m.register_uri('GET', '/api/v1/courses/1/quizzes', json=[])
+
+        get_course(1)
+        self.assertEqual(get_course('1')['name'], 'Course')
+        self.assertEqual(course.call_count, 1)
+
+        # Another process finds it in Redis.
+        utils.response_cache.l1.clear()
+        get_course(1)
+        self.assertEqual(course.call_count, 1)
+
+        get_quizzes(1)
+        get_quizzes(1)
+        self.assertEqual(quizzes.call_count, 2)
+
+        metrics = utils.canvas_metrics()['cache']
+        self.assertEqual(metrics['l1']['hits'], 1)
+        self.assertEqual(metrics['l1']['misses'], 2)
+        self.assertEqual(metrics['l2']['hits'], 1)
+        self.assertEqual(metrics['l2']['hit_ratio'], 0.5)
+
+        # Expire both tiers. (The fake clock doesn't reach Redis.)
+        utils.sleep(61)
+        utils.conn.flushall()
+        get_course(1)
+        self.assertEqual(course.call_count, 2)
+
+        pubsub = utils.conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(utils.CACHE_INVALIDATE_CHANNEL)
+        pubsub.get_message()
+
+        invalidate_cache(get_course, '1')
+        get_course(1)
+        self.assertEqual(course.call_count, 3)
+        self.assertEqual(
+            pubsub.get_message()['data'].decode('utf-8'),
+            utils.call_key('get_course', (), {'course_id': 1})
+        )
+
+    def test_response_cache_invalidation_message(self, m):
+        from utils import call_key, ResponseCache
+
+        cache = ResponseCache(2, listen=False)
+        cache.l1.set('a', 1, 60)
+        cache.l1.set('b', 2, 60)
+        cache.l1.get('a')
+        cache.l1.set('c', 3, 60)
+
+        # 'b' was used least recently, so it was evicted.
+        self.assertIsNone(cache.l1.get('b'))
+        self.assertEqual(cache.l1.get('a'), 1)
+
+        cache.handle_invalidation({'type': 'message', 'data': b'a'})
+        self.assertIsNone(cache.l1.get('a'))
+        self.assertEqual(cache.l1.get('c'), 3)
+        self.assertEqual(call_key('f', (1,), {}), call_key('f', ('1',), {}))
+
+        # Defaults are part of the key, however the call is made.
+        roster = m.register_uri('GET', '/api/v1/courses/1/enrollments', json=[])
+        self.set_config(CANVAS_CACHE_TTLS={'get_roster': 60})
+        utils.get_roster(1, section_id=None)
+        utils.get_roster('1')
+        self.assertEqual(roster.call_count, 1)
+        utils.invalidate_cache(utils.get_roster, 1)
+        utils.get_roster(1, None)
+        self.assertEqual(roster.call_count, 2)
+
+    def test_token_pool_choose(self, m):
+        from utils import TokenPool
+
+        pool = TokenPool(['a', 'b', 'a', ''])
+        self.assertEqual(pool.tokens, ['a', 'b'])
+
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['X-Rate-Limit-Remaining'] = '100'
+        pool.record('a', response)
+
+        self.assertEqual(pool.choose(), 'b')
+        self.assertEqual(pool.choose(exclude={'b'}), 'a')
+        self.assertIsNone(pool.choose(exclude={'a', 'b'}))
+
+    def test_acquire_canvas_budget(self, m):
+        from utils import acquire_canvas_budget
+
+        self.set_config(
+            CANVAS_BUCKET_CAPACITY=5,
+            CANVAS_BUCKET_INTERACTIVE_RESERVE=2,
+            CANVAS_BUCKET_REFILL_RATE=1
+        )
+        waits = self.fake_clock()
 
-        response = self.client.get('/missing_quizzes/{}/'.format(course_id))
+        # Background work may not eat into the interactive reserve.
+        self.addCleanup(setattr, utils, 'has_request_context', utils.has_request_context)
+        utils.has_request_context = lambda: False
 
-        self.assert_200(response)
-        self.assertEqual(response.data, 'false')
+        for i in range(3):
+            acquire_canvas_budget('token')
+        self.assertEqual(waits, [])
 
-    def test_filter_no_students_found(self, m):
-        with self.client.session_transaction() as sess:
-            sess['canvas_user_id'] = 1234
-            sess['lti_logged_in'] = True
-            sess['is_admin'] = True
+        acquire_canvas_budget('token')
+        self.assertEqual(waits, [1.0])
 
-        m.register_uri(
-            'GET',
-            '/api/v1/courses/1/search_users',
-            json=[]
+        # Other tokens have their own budget.
+        acquire_canvas_budget('other token')
+        self.assertEqual(waits, [1.0])
+
+    def test_acquire_canvas_budget_interactive(self, m):
+        from utils import acquire_canvas_budget
+
+        self.set_config(
+            CANVAS_BUCKET_CAPACITY=5,
+            CANVAS_BUCKET_INTERACTIVE_RESERVE=2,
+            CANVAS_BUCKET_REFILL_RATE=1
         )
+        waits = self.fake_clock()
 
-        course_id = 1
-        response = self.client.get('/filter/{}/'.format(course_id))
-        self.assert_200(response)
-        self.assert_template_used('user_list.html')
-        self.assertEqual(len(self.get_context_variable('users')), 0)
-        self.assertEqual(self.get_context_variable('max_pages'), 1)
+        # Page loads can use the whole bucket.
+        for i in range(5):
+            acquire_canvas_budget('token')
+        self.assertEqual(waits, [])
 
-    def test_filter(self, m):
-        with self.client.session_transaction() as sess:
-            sess['canvas_user_id'] = 1234
-            sess['lti_logged_in'] = True
-            sess['is_admin'] = True
+        acquire_canvas_budget('token')
+        self.assertEqual(waits, [1.0])
 
-        m.register_uri(
-            'GET',
-            '/api/v1/courses/1/search_users',
-            json=[
-                {'id': 1, 'name': 'John Smith'},
-                {'id': 2, 'name': 'Jane Doe'}
-            ],
-            headers={
-                "Link": "<http://example.com/api/v1/courses/1/search_users?page=99>; rel=\"last\""
-            }
+    def test_extend_quiz_chunked(self, m):
+        from utils import execute_operations, ExtensionOperation, extend_quiz
+
+        self.set_config(EXTENSION_CHUNK_SIZE=2, EXTENSION_CHUNK_WORKERS=2)
+
+        def extensions(request, context):
+            user_ids = [extension['user_id'] for extension in request.json()['quiz_extensions']]
+            context.status_code = 500 if 5 in user_ids else 200
+            return ''
+
+        quiz_post = m.register_uri(
+            'POST',
+            '/api/v1/courses/1/quizzes/2/extensions',
+            text=extensions
         )
+        quiz = {'id': 2, 'title': 'A Quiz', 'time_limit': 10}
 
-        course_id = 1
-        response = self.client.get('/filter/{}/'.format(course_id))
-        self.assert_200(response)
-        self.assert_template_used('user_list.html')
-        self.assertEqual(len(self.get_context_variable('users')), 2)
-        self.assertEqual(self.get_context_variable('max_pages'), 99)
+        response = extend_quiz(1, quiz, 200, [1, 2, 3, 4])
+        self.assertTrue(response['success'])
+        self.assertEqual(quiz_post.call_count, 2)
+        self.assertEqual(
+            [len(request.json()['quiz_extensions']) for request in quiz_post.request_history],
+            [2, 2]
+        )
 
-    def test_lti_tool_not_admin_or_instructor(self, m):
-        user_id = 42
+        operation = ExtensionOperation(quiz, 200, [1, 2, 3, 4, 5], 10)
+        self.assertEqual(operation.api_calls, 3)
 
-        response = self.client.post(
-            '/launch',
-            data={
-                'custom_canvas_course_id': 'test',
-                'custom_canvas_user_id': user_id,
-                'custom_canvas_api_domain': config.TESTING_API_URL,
-                'ext_roles': []
-            }
+        response, = execute_operations(1, [operation])
+        self.assertFalse(response['success'])
+        self.assertEqual(response['failed_user_ids'], [5])
+        self.assertEqual(
+            response['message'],
+            'Error creating extension for 1 of 5 users on quiz #2. Canvas status code: 500'
         )
-        self.assert_200(response)
-        self.assert_template_used('error.html')
+
+        # The users whose chunks went through are in the ledger.
         self.assertEqual(
-            self.get_context_variable('message'),
-            'Must be an Administrator or Instructor'
+            sorted(entry.user_canvas_id for entry in AppliedExtension.query),
+            [1, 2, 3, 4]
         )
 
-    def test_lti_tool(self, m):
-        user_id = 42
+    def test_extend_quiz_verified(self, m):
+        from utils import applied_extensions, execute_operations, ExtensionOperation
 
-        with self.client as c:
-            response = c.post(
-                '/launch',
-                data={
-                    'custom_canvas_course_id': 'test',
-                    'custom_canvas_user_id': user_id,
-                    'custom_canvas_api_domain': config.TESTING_API_URL,
-                    'ext_roles': 'Administrator'
-                }
-            )
-            self.assert200(response)
-            self.assertTrue(session.get('is_admin', False))
+        def extensions(request, context):
+            # Canvas sends back the extensions it saved, as strings.
+            return {'quiz_extensions': [
+                {'quiz_id': 2, 'user_id': str(extension['user_id']),
+                 'extra_time': 5 if extension['user_id'] == 3 else extension['extra_time']}
+                for extension in request.json()['quiz_extensions']
+            ]}
 
+        m.register_uri('POST', '/api/v1/courses/1/quizzes/2/extensions', json=extensions)
+        quiz = {'id': 2, 'title': 'A Quiz', 'time_limit': 10}
 
-@requests_mock.Mocker()
-class UtilTests(flask_testing.TestCase):
+        response, = execute_operations(1, [ExtensionOperation(quiz, 200, [1, 2, 3], 10)])
+        self.assertFalse(response['success'])
+        self.assertEqual(response['failed_user_ids'], [3])
+        self.assertEqual(response['verified_user_ids'], [1, 2])
+        self.assertEqual(
+            response['message'],
+            'Canvas did not confirm 10 minutes for 1 of 3 users on quiz #2.'
+        )
 
-    def create_app(self):
-        app = views.app
-        app.config['TESTING'] = True
-        app.config['DEBUG'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/test.db'
-        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-        app.config['threaded'] = True
-        return app
+        # IDs match however each side writes them.
+        m.register_uri('POST', '/api/v1/courses/1/quizzes/2/extensions', json={
+            'quiz_extensions': [
+                {'quiz_id': 2, 'user_id': 5, 'extra_time': 10},
+                {'quiz_id': 2, 'user_id': '06', 'extra_time': 10}
+            ]
+        })
+        response, = execute_operations(1, [ExtensionOperation(quiz, 200, ['5', '6'], 10)])
+        self.assertTrue(response['success'])
+        self.assertEqual(response['verified_user_ids'], ['5', '6'])
 
-    def setUp(self):
-        logging.disable(logging.CRITICAL)
-        views.db.init_app(self.app)
-        with self.app.test_request_context():
-            views.db.create_all()
+        # Posted without a response to check.
+        m.register_uri('POST', '/api/v1/courses/1/quizzes/2/extensions', status_code=200)
+        response, = execute_operations(1, [ExtensionOperation(quiz, 200, [4], 10)])
+        self.assertTrue(response['success'])
 
-    def tearDown(self):
-        logging.disable(logging.NOTSET)
-        views.db.session.remove()
-        views.db.drop_all()
+        entries = AppliedExtension.query.order_by(AppliedExtension.user_canvas_id)
+        self.assertEqual(
+            [(entry.user_canvas_id, entry.verified) for entry in entries],
+            [(1, True), (2, True), (4, False), (5, True), (6, True)]
+        )
+
+        self.assertEqual(sorted(applied_extensions([2], [1, 2, 3, 4])), [(2, 1), (2, 2), (2, 4)])
+        self.set_config(TRUST_UNVERIFIED_EXTENSIONS=False)
+        self.assertEqual(sorted(applied_extensions([2], [1, 2, 3, 4])), [(2, 1), (2, 2)])
 
     def test_extend_quiz(self, m):
         from utils import extend_quiz
@@ -1217,6 +3298,64 @@ class UtilTests(flask_testing.TestCase):
         self.assertIsInstance(response, list)
         self.assertEqual(len(response), 2)
 
+    def test_get_quizzes_records(self, m):
+        from utils import get_quizzes, QuizRecord
+
+        self.set_config(CANVAS_CACHE_TTLS={'get_quizzes': 60})
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[{
+                'id': 1,
+                'title': 'Quiz 1',
+                'time_limit': 20,
+                'description': '<p>Long description</p>',
+                'html_url': 'http://example.com/courses/1/quizzes/1'
+            }]
+        )
+
+        quiz, = get_quizzes(1)
+        self.assertIsInstance(quiz, QuizRecord)
+        self.assertEqual(quiz.time_limit, 20)
+        self.assertEqual(quiz['title'], 'Quiz 1')
+        self.assertEqual(quiz.get('unlock_at', 'never'), 'never')
+        self.assertIsNone(quiz.get('description'))
+        with self.assertRaises(KeyError):
+            quiz['html_url']
+        with self.assertRaises(AttributeError):
+            quiz.description = ''
+
+        # Records from the Redis cache come back as dictionaries.
+        utils.response_cache.l1.clear()
+        cached_quiz, = get_quizzes(1)
+        self.assertEqual(cached_quiz, quiz.as_dict())
+        self.assertEqual(m.call_count, 1)
+
+    def test_iter_json_array(self, m):
+        from utils import iter_json_array
+
+        def parse(body, chunk_size):
+            response = requests.Response()
+            response.raw = io.BytesIO(body.encode('utf-8'))
+            return list(iter_json_array(response, chunk_size=chunk_size))
+
+        body = ' [ {"id": 1, "title": "Café ] {"} ,\n{"id": 22, "nested": [1, {"a": []}]}, 333 ] '
+        expected = [
+            {'id': 1, 'title': 'Café ] {'},
+            {'id': 22, 'nested': [1, {'a': []}]},
+            333
+        ]
+        for chunk_size in (1, 2, 7, 1024):
+            self.assertEqual(parse(body, chunk_size), expected)
+
+        self.assertEqual(parse('[]', 1), [])
+        self.assertEqual(parse('{"errors": []}', 3), [{'errors': []}])
+
+        for body in ('', '[{"id": 1}', '[{"id": }]'):
+            with self.assertRaises(ValueError):
+                parse(body, 4)
+
     def test_get_quizzes_error(self, m):
         from utils import get_quizzes
 
@@ -1226,9 +3365,47 @@ class UtilTests(flask_testing.TestCase):
             json={"errors": {"message": "An error occurred."}}
         )
 
-        response = get_quizzes(1)
-        self.assertIsInstance(response, list)
-        self.assertEqual(len(response), 0)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            get_quizzes(1)
+
+        # Errors on a later page don't give back only the first page.
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/2/quizzes',
+            json=[{'id': 1, 'title': 'Quiz 1'}],
+            headers={'Link': '<http://example.com/api/v1/courses/2/quizzes?page=2>; rel="next"'}
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/2/quizzes?page=2',
+            json={"errors": {"message": "An error occurred."}}
+        )
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            get_quizzes(2)
+
+    def test_get_quizzes_server_error(self, m):
+        from utils import get_quizzes
+
+        self.set_config(CANVAS_RETRY_BACKOFF=0)
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[{'id': 1, 'title': 'Quiz 1'}],
+            headers={
+                'Link': '<http://example.com/api/v1/courses/1/quizzes?page=2>; rel="next"'
+            }
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes?page=2',
+            status_code=502
+        )
+
+        # A partial list of quizzes must not be mistaken for the whole course.
+        with self.assertRaises(requests.exceptions.HTTPError):
+            get_quizzes(1)
 
     def test_search_students(self, m):
         from utils import search_students
@@ -1433,6 +3610,211 @@ class UtilTests(flask_testing.TestCase):
         self.assertEqual(response[0]['title'], 'Quiz 1')
         self.assertEqual(response[1]['title'], 'Quiz 3')
 
+    def test_missing_quizzes_changed(self, m):
+        from utils import missing_quizzes, quiz_hash
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[
+                {'id': 1, 'title': 'Quiz 1', 'time_limit': 20},
+                {'id': 2, 'title': 'Quiz 2', 'time_limit': 15},
+                {'id': 3, 'title': 'Quiz 3'},
+            ]
+        )
+
+        views.db.session.add_all([
+            Quiz(course_id=1, canvas_id=1, title='Quiz 1', time_limit=10),
+            Quiz(course_id=1, canvas_id=2, title='Quiz 2', time_limit=15),
+        ])
+        views.db.session.commit()
+
+        self.assertEqual([quiz['id'] for quiz in missing_quizzes(1)], [3])
+        self.assertEqual([quiz['id'] for quiz in missing_quizzes(1, changed=True)], [1, 3])
+
+        # Once hashed, any change to a quiz is found, not just its time limit.
+        for quiz in Quiz.query:
+            quiz.content_hash = quiz_hash({'id': quiz.canvas_id, 'title': quiz.title,
+                                           'time_limit': 20 if quiz.canvas_id == 1 else 15})
+        views.db.session.commit()
+        self.assertEqual([quiz['id'] for quiz in missing_quizzes(1, changed=True)], [3])
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[
+                {'id': 1, 'title': 'Quiz 1', 'time_limit': 20, 'lock_at': '2018-01-31T23:59:00Z'},
+                {'id': 2, 'title': 'Quiz 2', 'time_limit': 15},
+                {'id': 3, 'title': 'Quiz 3'},
+            ]
+        )
+        self.assertEqual([quiz['id'] for quiz in missing_quizzes(1, changed=True)], [1, 3])
+
+    def test_quiz_hash(self, m):
+        from utils import quiz_hash, QuizRecord
+
+        quiz = {'id': 1, 'title': 'Quiz 1', 'time_limit': 10, 'description': 'Old'}
+        record = QuizRecord.from_json(quiz)
+
+        self.assertEqual(quiz_hash(quiz), quiz_hash(record))
+        self.assertEqual(quiz_hash(quiz), quiz_hash(dict(quiz, description='New')))
+        self.assertNotEqual(quiz_hash(quiz), quiz_hash(dict(quiz, time_limit=20)))
+
+    def test_get_roster(self, m):
+        from utils import get_roster
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/enrollments?per_page=100',
+            json=[
+                {'user_id': 11, 'user': {'id': 11, 'sortable_name': 'Student 11'}},
+                {'user_id': 12, 'user': {'id': 12, 'sortable_name': 'Student 12'}}
+            ],
+            headers={
+                'Link': '<http://example.com/api/v1/courses/1/enrollments?page=2>; rel="next"'
+            }
+        )
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/enrollments?page=2',
+            json=[
+                {'user_id': 12, 'user': {'id': 12, 'sortable_name': 'Student 12'}},
+                {'user_id': 13, 'user': {'id': 13, 'sis_user_id': 'S13'}}
+            ]
+        )
+
+        roster = get_roster(1, per_page=100)
+
+        self.assertEqual([user['id'] for user in roster], [11, 12, 13])
+        self.assertEqual(roster[2]['sis_user_id'], 'S13')
+
+    def test_iter_import_rows(self, m):
+        from utils import import_format, iter_import_rows
+
+        lines = [
+            b'{"sis_user_id": "S11", "course_id": 1, "percent": 150}\n',
+            b'\n',
+            b'{"sis_id": 12, "course_id": "1", "percent": "200"}\n',
+            b'{"sis_user_id": "S13", "percent": 200}\n',
+            b'not json\n',
+        ]
+
+        self.assertEqual(import_format('accommodations.JSONL'), 'jsonl')
+        self.assertEqual(import_format('accommodations', 'csv'), 'csv')
+        self.assertIsNone(import_format('accommodations.xlsx'))
+        self.assertEqual(
+            list(iter_import_rows(lines, 'jsonl')),
+            [
+                (1, ('S11', 1, 150), None),
+                (3, ('12', 1, 200), None),
+                (4, None, '`course_id` must be a Canvas course ID.'),
+                (5, None, 'Line is not valid JSON.')
+            ]
+        )
+
+    def test_catalog_fingerprint(self, m):
+        from utils import catalog_fingerprint
+
+        quizzes = [{'id': 1, 'title': 'Quiz 1'}, {'id': 2, 'title': 'Quiz 2'}]
+
+        self.assertEqual(catalog_fingerprint(quizzes), catalog_fingerprint(quizzes[::-1]))
+        self.assertNotEqual(catalog_fingerprint(quizzes), catalog_fingerprint(quizzes[:1]))
+        self.assertNotEqual(
+            catalog_fingerprint(quizzes),
+            catalog_fingerprint([quizzes[0], dict(quizzes[1], time_limit=30)])
+        )
+
+    def test_by_urgency(self, m):
+        from utils import by_urgency, parse_canvas_time, to_timestamp
+
+        now = to_timestamp(parse_canvas_time('2018-03-01T12:00:00Z'))
+        quizzes = [
+            {'id': 1, 'title': 'No dates'},
+            {'id': 2, 'unlock_at': '2018-03-05T09:00:00Z'},
+            {'id': 3, 'due_at': '2018-02-01T23:59:00Z'},
+            {'id': 4, 'unlock_at': '2018-03-02T09:00:00Z', 'due_at': '2018-03-02T10:00:00Z'},
+            {'id': 5, 'unlock_at': '2018-02-20T09:00:00Z', 'due_at': '2018-03-08T23:59:00Z'},
+        ]
+
+        self.assertEqual([quiz['id'] for quiz in by_urgency(quizzes, now)], [5, 1, 4, 2, 3])
+
+    def test_parse_canvas_time(self, m):
+        from datetime import datetime
+        from utils import parse_canvas_time
+
+        self.assertEqual(
+            parse_canvas_time('2018-01-31T23:59:00Z'),
+            datetime(2018, 1, 31, 23, 59)
+        )
+        self.assertEqual(
+            parse_canvas_time('2018-01-31T23:59:00.123Z'),
+            datetime(2018, 1, 31, 23, 59)
+        )
+        self.assertIsNone(parse_canvas_time(None))
+
+    def test_filter_quizzes(self, m):
+        from utils import filter_quizzes, parse_canvas_time, to_timestamp
+
+        now = to_timestamp(parse_canvas_time('2018-03-01T12:00:00Z'))
+        quizzes = [
+            {'id': 1, 'lock_at': '2018-03-02T00:00:00Z', 'due_at': '2018-02-28T00:00:00Z'},
+            {'id': 2, 'lock_at': '2018-02-28T00:00:00Z'},
+            {'id': 3, 'quiz_type': 'assignment', 'published': False},
+        ]
+
+        kept, skipped = filter_quizzes(quizzes, now)
+        self.assertEqual([quiz['id'] for quiz in kept], [1, 3])
+        self.assertEqual(skipped, [{'id': 2, 'title': None, 'reason': 'locked'}])
+
+        self.set_config(
+            SKIP_LOCKED_QUIZZES=False,
+            SKIP_PAST_DUE_QUIZZES=True,
+            SKIP_UNPUBLISHED_QUIZZES=True
+        )
+        kept, skipped = filter_quizzes(quizzes, now)
+        self.assertEqual(kept, [quizzes[1]])
+        self.assertEqual([quiz['reason'] for quiz in skipped], ['past due', 'unpublished'])
+
+    def test_missing_quizzes_filtered(self, m):
+        from utils import missing_quizzes
+
+        m.register_uri(
+            'GET',
+            '/api/v1/courses/1/quizzes',
+            json=[
+                {'id': 1, 'title': 'Practice', 'quiz_type': 'practice_quiz'},
+                {'id': 2, 'title': 'Quiz 2'},
+            ]
+        )
+
+        self.assertEqual([quiz['id'] for quiz in missing_quizzes(1)], [1, 2])
+        self.assertEqual([quiz['id'] for quiz in missing_quizzes(1, True, filtered=True)], [2])
+
+    def test_set_accommodation_failed(self, m):
+        from utils import set_accommodation
+
+        m.register_uri(
+            'POST',
+            '/api/quiz/v1/courses/1/accommodations',
+            json={'successful': [], 'failed': [{'user_id': 11, 'error': 'Not enrolled'}]}
+        )
+        self.assertFalse(set_accommodation(1, 11, 30)['success'])
+
+        m.register_uri('POST', '/api/quiz/v1/courses/1/accommodations', status_code=500)
+        self.assertFalse(set_accommodation(1, 11, 30)['success'])
+
+        # A successful response without the usual body.
+        m.register_uri('POST', '/api/quiz/v1/courses/1/accommodations', text='')
+        self.assertTrue(set_accommodation(1, 11, 30)['success'])
+
+    def test_accommodation_time(self, m):
+        from utils import accommodation_time
+
+        self.assertIsNone(accommodation_time([{'quiz_settings': {'has_time_limit': False}}], 200))
+        self.assertEqual(accommodation_time([
+            {'quiz_settings': {'has_time_limit': True, 'session_time_limit_in_seconds': 1230}},
+        ], 200), 21)
+
     def test_missing_quizzes_no_missing(self, m):
         from utils import missing_quizzes
 
@@ -1479,3 +3861,83 @@ class UtilTests(flask_testing.TestCase):
         self.assertIsInstance(response, list)
         self.assertEqual(len(response), 1)
         self.assertEqual(response[0]['title'], 'Quiz 1')
+
+    def test_enqueue_fair(self, m):
+        from utils import enqueue_fair
+
+        connection = fakeredis.FakeStrictRedis()
+        connection.flushall()
+        queue = Queue('fair', connection=connection)
+
+        first_refresh, first_update = enqueue_fair(
+            queue,
+            'course:1',
+            [(fair_test_job, (1,)), (fair_test_job, (2,))]
+        )
+        second_refresh, = enqueue_fair(queue, 'course:1', [(fair_test_job, (3,))])
+        other_refresh, = enqueue_fair(queue, 'course:2', [(fair_test_job, (4,))])
+
+        # Only one chain per course may be on the queue at once.
+        self.assertEqual(queue.job_ids, [first_refresh.id, other_refresh.id])
+        self.assertEqual(second_refresh.get_status(), 'deferred')
+        self.assertEqual(second_refresh.meta['status'], 'queued')
+
+        SimpleWorker([queue], connection=connection).work(burst=True)
+
+        for job, value in [
+            (first_refresh, 1), (first_update, 2), (second_refresh, 3), (other_refresh, 4)
+        ]:
+            job.refresh()
+            self.assertTrue(job.is_finished)
+            self.assertEqual(job.result, value)
+
+        self.assertEqual(connection.hlen('quizext:fair:course:1:active'), 0)
+        self.assertEqual(connection.llen('quizext:fair:course:1:pending'), 0)
+
+    def test_fair_slot_timeout(self, m):
+        from utils import enqueue_fair, reclaim_fair_slots
+
+        self.fake_clock()
+        connection = fakeredis.FakeStrictRedis()
+        connection.flushall()
+        queue = Queue('fair', connection=connection)
+        active_key = 'quizext:fair:course:1:active'
+
+        first, = enqueue_fair(queue, 'course:1', [(fair_test_job, (1,))])
+        second, = enqueue_fair(queue, 'course:1', [(fair_test_job, (2,))])
+
+        # A queued chain keeps its slot for as long as it waits.
+        utils.sleep(60 * 60 * 24)
+        reclaim_fair_slots(queue)
+        self.assertEqual(queue.job_ids, [first.id])
+
+        # Once started, its chain has as long as its jobs are allowed.
+        first.meta['fair_chain_length'] = 2
+        first.save()
+        utils.start_fair_slot(first)
+        self.assertEqual(
+            float(connection.hget(active_key, first.id)),
+            utils.time() + 2 * (config.JOB_DEADLINE + utils.JOB_TIMEOUT_GRACE)
+        )
+
+        utils.sleep(config.JOB_DEADLINE + utils.JOB_TIMEOUT_GRACE)
+        reclaim_fair_slots(queue)
+        self.assertEqual(queue.job_ids, [first.id])
+
+        # Its worker died, so the scheduler lets the next chain in.
+        utils.sleep(config.JOB_DEADLINE + utils.JOB_TIMEOUT_GRACE + 1)
+        reclaim_fair_slots(queue)
+        self.assertEqual(queue.job_ids, [first.id, second.id])
+        self.assertEqual(connection.hkeys(active_key), [second.id.encode('utf-8')])
+
+    def test_enqueue_fair_reclaims_abandoned_slot(self, m):
+        from utils import enqueue_fair
+
+        connection = fakeredis.FakeStrictRedis()
+        connection.flushall()
+        connection.hset('quizext:fair:course:1:active', 'dead-job', 0)
+        queue = Queue('fair', connection=connection)
+
+        job, = enqueue_fair(queue, 'course:1', [(fair_test_job, (1,))])
+
+        self.assertEqual(queue.job_ids, [job.id])
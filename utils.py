@@ -2,14 +2,34 @@
 
 from __future__ import unicode_literals
 
-from collections import defaultdict
+import calendar
+import codecs
+import csv
+from collections import defaultdict, OrderedDict
+from contextlib import closing, contextmanager
+from datetime import datetime
+from functools import wraps
+import hashlib
+import inspect
 import json
 import math
-import requests
+from multiprocessing.pool import ThreadPool
+import random
+import threading
+from time import sleep, time
 from urlparse import parse_qs, urlsplit
 
+from flask import has_request_context
+import redis
+from redis.exceptions import RedisError
+import requests
+from rq import get_current_job, Queue, Worker
+from rq.exceptions import DequeueTimeout, NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.worker import WorkerStatus
+
 import config
-from models import Quiz
+from models import AppliedExtension, db, Quiz
 
 import logging
 from logging.config import dictConfig
@@ -17,212 +37,2503 @@ from logging.config import dictConfig
 dictConfig(config.LOGGING_CONFIG)
 logger = logging.getLogger('app')
 
-headers = {'Authorization': 'Bearer ' + config.API_KEY}
-json_headers = {
-    'Authorization': 'Bearer ' + config.API_KEY,
-    'Content-type': 'application/json'
-}
+conn = redis.from_url(config.REDIS_URL)
 
+json_headers = {'Content-type': 'application/json'}
 
-def extend_quiz(course_id, quiz, percent, user_id_list):
+# Canvas responses worth retrying: rate limiting and server-side errors.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+BUDGET_KEY = 'quizext:budget:{}'
+CHECKPOINT_KEY = 'quizext:checkpoint:{}'
+FAIR_ACTIVE_KEY = 'quizext:fair:{}:active'
+FAIR_PENDING_KEY = 'quizext:fair:{}:pending'
+FAIR_DELAYED_KEY = 'quizext:fair:delayed'
+FLIGHT_LOCK_KEY = 'quizext:flight:{}:lock'
+FLIGHT_RESULT_KEY = 'quizext:flight:{}:result'
+CACHE_KEY = 'quizext:cache:{}'
+CACHE_INVALIDATE_CHANNEL = 'quizext:cache:invalidate'
+LATENCY_KEY = 'quizext:latency:{}'
+ACCOMMODATION_KEY = 'quizext:accommodations:{}'
+
+# Extra seconds RQ gives a job past its deadline to report that it ran out
+# of time before the work horse is killed.
+JOB_TIMEOUT_GRACE = 60
+
+
+class AdaptiveLimiter(object):
     """
-    Extends a quiz time by a percentage for a list of users.
+    Limits how many Canvas requests this process has in flight at once.
 
-    :param quiz: A quiz object from Canvas
-    :type quiz: dict
-    :param percent: The percent of original quiz time to be applied.
-        e.g. 200 is double time, 100 is normal time, <100 is invalid.
-    :type percent: int
-    :param user_id_list: A list of Canvas user IDs to add time for.
-    :type user_id_list: list
-    :rtype: dict
-    :returns: A dictionary with three parts:
+    The limit is adjusted from the rate limit headers Canvas returns with
+    every response: it is cut in half when the remaining budget drops
+    below `config.CANVAS_RATE_LIMIT_LOW`, or Canvas says the limit was
+    exceeded, and grows by one request per round trip while the budget
+    stays above `config.CANVAS_RATE_LIMIT_HIGH`.
+    """
 
-        - success `bool` False if there was an error, True otherwise.
-        - message `str` A long description of success or failure.
-        - added_time `int` The amount of time added in minutes. Returns
-        `None` if there was no time added.
+    # Seconds to wait before cutting the limit again, so one burst of
+    # low budget responses doesn't cut it all the way to the minimum.
+    DECREASE_INTERVAL = 1.0
+
+    def __init__(self, initial, minimum, maximum):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.remaining = None
+        self.request_cost = None
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until there is room for another request, but no longer than
+        the current deadline.
+
+        :raises DeadlineExceeded: If the deadline passes first.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = remaining_time()
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceeded(
+                        'Canvas took too long to respond. Please try again.'
+                    )
+                self._condition.wait(remaining)
+            self.in_flight += 1
+
+    def release(self, response=None):
+        """
+        Free up the room held by a request and adjust the limit.
+
+        :param response: The response to the request, if there was one.
+        :type response: :class:`requests.Response`
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if response is not None:
+                self._adjust(response)
+            self._condition.notify_all()
+
+    def _adjust(self, response):
+        try:
+            self.remaining = float(response.headers['X-Rate-Limit-Remaining'])
+            self.request_cost = float(response.headers['X-Request-Cost'])
+        except (KeyError, ValueError):
+            pass
+
+        if is_rate_limited(response) or (
+            self.remaining is not None and self.remaining < config.CANVAS_RATE_LIMIT_LOW
+        ):
+            if time() - self._last_decrease >= self.DECREASE_INTERVAL:
+                self.limit = max(float(self.minimum), self.limit / 2)
+                self._last_decrease = time()
+                logger.debug('Canvas concurrency limit decreased to {}'.format(int(self.limit)))
+        elif self.remaining is not None and self.remaining >= config.CANVAS_RATE_LIMIT_HIGH:
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+    def metrics(self):
+        """
+        :rtype: dict
+        :returns: The current limit, requests in flight, and the last
+            rate limit budget and request cost reported by Canvas.
+        """
+        with self._condition:
+            return {
+                'concurrency_limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'rate_limit_remaining': self.remaining,
+                'request_cost': self.request_cost
+            }
+
+
+concurrency_limiter = AdaptiveLimiter(
+    config.CANVAS_CONCURRENCY,
+    config.CANVAS_MIN_CONCURRENCY,
+    config.CANVAS_MAX_CONCURRENCY
+)
+
+
+class TokenPool(object):
     """
-    quiz_id = quiz.get('id')
-    time_limit = quiz.get('time_limit')
+    Spreads Canvas requests over several API tokens.
 
-    if time_limit is None or time_limit < 1:
-        msg = 'Quiz #{} has no time limit, so there is no time to add.'
+    Canvas rate limits each token separately, so every token added to
+    the pool adds to the requests that can be made. Each request goes to
+    the healthy token with the most rate limit budget left. Tokens that
+    Canvas refuses (a 401 or 403 saying the token is invalid) are
+    skipped for `config.API_KEY_COOLDOWN` seconds.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = []
+        self._stats = {}
+        self._lock = threading.Lock()
+
+        for token in tokens:
+            if token and token not in self._stats:
+                self.tokens.append(token)
+                self._stats[token] = {
+                    'requests': 0,
+                    'refused': 0,
+                    'remaining': None,
+                    'disabled_until': 0
+                }
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def choose(self, exclude=()):
+        """
+        Pick the token to send the next request with.
+
+        :param exclude: Tokens not to use, e.g. ones that were already
+            refused for this request.
+        :type exclude: collection
+        :rtype: str
+        :returns: The healthy token with the most budget left, or the
+            one that comes back into use soonest if none are healthy.
+            None if every token is excluded.
+        """
+        now = time()
+        with self._lock:
+            candidates = [token for token in self.tokens if token not in exclude]
+            if not candidates:
+                return None
+
+            def preference(token):
+                stats = self._stats[token]
+                remaining = stats['remaining']
+                return (
+                    max(stats['disabled_until'], now),
+                    -(remaining if remaining is not None else float('inf')),
+                    stats['requests']
+                )
+
+            return min(candidates, key=preference)
+
+    def record(self, token, response):
+        """
+        Update a token's usage and health from the response it got.
+
+        :param token: The token the request was made with.
+        :type token: str
+        :param response: The response from Canvas.
+        :type response: :class:`requests.Response`
+        """
+        with self._lock:
+            stats = self._stats[token]
+            stats['requests'] += 1
+
+            try:
+                stats['remaining'] = float(response.headers['X-Rate-Limit-Remaining'])
+            except (KeyError, ValueError):
+                pass
+
+            if is_token_refused(response):
+                stats['refused'] += 1
+                stats['disabled_until'] = time() + config.API_KEY_COOLDOWN
+                msg = 'Canvas refused API token {} ({}). Skipping it for {} seconds.'
+                logger.warning(msg.format(
+                    token_label(token),
+                    response.status_code,
+                    config.API_KEY_COOLDOWN
+                ))
+
+    def metrics(self):
+        """
+        :rtype: dict
+        :returns: Each token's usage and health, keyed by `token_label`
+            so the tokens themselves are never shown.
+        """
+        now = time()
+        with self._lock:
+            return {
+                token_label(token): {
+                    'requests': stats['requests'],
+                    'refused': stats['refused'],
+                    'rate_limit_remaining': stats['remaining'],
+                    'healthy': stats['disabled_until'] <= now
+                }
+                for token, stats in self._stats.items()
+            }
+
+
+token_pool = TokenPool([config.API_KEY] + config.API_KEY_POOL)
+
+
+class CanvasUnavailable(Exception):
+    """
+    Raised instead of sending a request while Canvas is known to be down.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to Canvas while it is failing.
+
+    After `config.CANVAS_BREAKER_FAILURES` failures in a row the breaker
+    opens and requests fail straight away with `CanvasUnavailable`
+    instead of waiting on Canvas. A failure is a dropped connection, a
+    timeout, a 5xx response, or a response slower than
+    `config.CANVAS_BREAKER_SLOW_CALL` seconds. After
+    `config.CANVAS_BREAKER_RESET_TIMEOUT` seconds one request is let
+    through as a probe: if it succeeds the breaker closes again,
+    otherwise it stays open for another timeout.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time() - self.opened_at < config.CANVAS_BREAKER_RESET_TIMEOUT:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before_request(self):
+        """
+        Check whether a request may be sent.
+
+        :raises CanvasUnavailable: If the breaker is open, or half open
+            with a probe already in flight.
+        """
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return
+
+            retry_in = max(
+                int(math.ceil(self.opened_at + config.CANVAS_BREAKER_RESET_TIMEOUT - time())),
+                1
+            )
+            raise CanvasUnavailable(
+                'Canvas is not responding right now. Please try again in '
+                '{} seconds.'.format(retry_in)
+            )
+
+    def record(self, success):
+        """
+        Record the outcome of a request let through by `before_request`.
+
+        :param success: False if the request failed or was too slow,
+            None if it was never sent or was cut short by a deadline.
+        :type success: bool
+        """
+        with self._lock:
+            self.probing = False
+
+            if success is None:
+                return
+            if success:
+                if self.opened_at is not None:
+                    logger.info('Canvas is responding again. Closing the circuit breaker.')
+                self.failures = 0
+                self.opened_at = None
+                return
+
+            self.failures += 1
+            was_open = self.opened_at is not None
+            if was_open or self.failures >= config.CANVAS_BREAKER_FAILURES:
+                self.opened_at = time()
+                if not was_open:
+                    logger.error(
+                        'Canvas failed {} requests in a row. Opening the circuit '
+                        'breaker for {} seconds.'.format(
+                            self.failures,
+                            config.CANVAS_BREAKER_RESET_TIMEOUT
+                        )
+                    )
+
+    def metrics(self):
+        """
+        :rtype: dict
+        """
         return {
-            'success': True,
-            'message': msg.format(quiz_id),
-            'added_time': None
+            'circuit_breaker': self.state,
+            'consecutive_failures': self.failures
         }
 
-    added_time = int(math.ceil(time_limit * ((float(percent) - 100) / 100) if percent else 0))
 
-    quiz_extensions = defaultdict(list)
+circuit_breaker = CircuitBreaker()
 
-    for user_id in user_id_list:
-        user_extension = {
-            'user_id': user_id,
-            'extra_time': added_time
-        }
-        quiz_extensions['quiz_extensions'].append(user_extension)
 
-    url_str = "{}courses/{}/quizzes/{}/extensions"
-    extensions_response = requests.post(
-        url_str.format(config.API_URL, course_id, quiz_id),
-        data=json.dumps(quiz_extensions),
+class DeadlineExceeded(CanvasUnavailable):
+    """
+    Raised when Canvas can't answer before the current deadline.
+    """
+
+
+_deadlines = threading.local()
+
+
+def set_deadline(seconds):
+    """
+    Limit how long this thread may spend on Canvas requests from now on.
+
+    A deadline can only be brought closer: if an earlier deadline is
+    already set, it is kept.
+
+    :param seconds: The time allowed, or None for no limit.
+    :type seconds: float
+    :rtype: float
+    :returns: The deadline that was set before, to pass back to
+        `reset_deadline` when done.
+    """
+    previous = getattr(_deadlines, 'at', None)
+    if seconds is not None:
+        at = time() + seconds
+        _deadlines.at = at if previous is None else min(at, previous)
+    return previous
+
+
+def reset_deadline(previous):
+    """
+    Go back to the deadline returned by `set_deadline`.
+
+    :param previous: The deadline to go back to.
+    :type previous: float
+    """
+    _deadlines.at = previous
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Context manager that limits the Canvas requests made inside it to
+    `seconds`, or to the time left on an outer deadline if that is less.
+    Nested helpers share the deadline, so each call has only the time
+    the calls before it left over.
+
+    :param seconds: The time allowed, or None for no limit.
+    :type seconds: float
+    """
+    previous = set_deadline(seconds)
+    try:
+        yield
+    finally:
+        reset_deadline(previous)
+
+
+def remaining_time():
+    """
+    :rtype: float
+    :returns: Seconds left before the current deadline, or None if
+        there isn't one.
+    """
+    at = getattr(_deadlines, 'at', None)
+    return None if at is None else at - time()
+
+
+def check_deadline(needed=0):
+    """
+    Make sure there is time left before the current deadline.
+
+    :param needed: The seconds that must be left, e.g. for a wait.
+    :type needed: float
+    :raises DeadlineExceeded: If there isn't enough time left.
+    """
+    remaining = remaining_time()
+    if remaining is not None and remaining <= needed:
+        raise DeadlineExceeded('Canvas took too long to respond. Please try again.')
+
+
+def deadline_timeout(timeout):
+    """
+    Shorten a `requests` timeout to fit before the current deadline.
+
+    :param timeout: A timeout in seconds, or a (connect, read) tuple.
+    :type timeout: float or tuple
+    :rtype: float or tuple
+    """
+    remaining = remaining_time()
+    if remaining is None or timeout is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(min(part, remaining) if part else remaining for part in timeout)
+    return min(timeout, remaining)
+
+
+class Flight(object):
+    """
+    A call in progress that other callers can wait for.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Shares one call, and its result, between everyone in this process
+    who asks for the same thing while it is in progress.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        Call `func`, or wait for the call already in progress for `key`.
+
+        :param key: Identifies the call. Calls with the same key must
+            return the same thing.
+        :type key: str
+        :param func: The call to make.
+        :type func: callable
+        :returns: What `func` returned.
+        :raises DeadlineExceeded: If the call in progress doesn't finish
+            before the current deadline.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.done.wait(remaining_time()):
+                raise DeadlineExceeded('Canvas took too long to respond. Please try again.')
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.result
+
+    def metrics(self):
+        """
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'coalesced_requests': self.coalesced,
+                'requests_in_flight': len(self._flights)
+            }
+
+
+flights = SingleFlight()
+
+
+def shared_flight(key, func):
+    """
+    Share a call between processes through Redis.
+
+    The first process to ask takes a lock and makes the call, then
+    stores the result for `config.SINGLE_FLIGHT_RESULT_TTL` seconds.
+    Others wait for the result instead of making the same call. If the
+    call fails, or the lock expires, the next one in line makes it.
+
+    If Redis can't be reached, the call is made anyway.
+
+    :param key: Identifies the call.
+    :type key: str
+    :param func: The call to make. Must return something JSON can
+        store.
+    :type func: callable
+    :returns: What `func` returned, here or in another process.
+    """
+    lock_key = FLIGHT_LOCK_KEY.format(key)
+    result_key = FLIGHT_RESULT_KEY.format(key)
+
+    while True:
+        try:
+            result = conn.get(result_key)
+            if result is not None:
+                return json.loads(result)
+            if conn.set(lock_key, 1, nx=True, ex=config.SINGLE_FLIGHT_LOCK_TIMEOUT):
+                break
+        except RedisError:
+            logger.warning('Unable to reach Redis to share a Canvas request.', exc_info=True)
+            return func()
+
+        check_deadline(config.SINGLE_FLIGHT_POLL_INTERVAL)
+        sleep(config.SINGLE_FLIGHT_POLL_INTERVAL)
+
+    try:
+        result = func()
+    except Exception:
+        try:
+            conn.delete(lock_key)
+        except RedisError:
+            pass
+        raise
+
+    try:
+        pipe = conn.pipeline()
+        pipe.set(
+            result_key,
+            json.dumps(result, default=json_default),
+            ex=config.SINGLE_FLIGHT_RESULT_TTL
+        )
+        pipe.delete(lock_key)
+        pipe.execute()
+    except RedisError:
+        logger.warning('Unable to share a Canvas response through Redis.', exc_info=True)
+
+    return result
+
+
+class QuizRecord(object):
+    """
+    The parts of a Canvas quiz this tool uses.
+
+    Canvas quizzes come with their description, question details and
+    URLs, none of which are needed, so only these fields are kept. For
+    code written against the Canvas dictionaries, fields can still be
+    read with `quiz['id']` or `quiz.get('id')`.
+    """
+
+    __slots__ = (
+        'id',
+        'title',
+        'time_limit',
+        'quiz_type',
+        'published',
+        'assignment_group_id',
+        'unlock_at',
+        'due_at',
+        'lock_at',
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_json(cls, quiz):
+        """
+        :param quiz: A quiz as returned by the Canvas API.
+        :type quiz: dict
+        :rtype: :class:`QuizRecord`
+        """
+        return cls(**{name: quiz.get(name) for name in cls.__slots__})
+
+    def as_dict(self):
+        """
+        :rtype: dict
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None) if name in self.__slots__ else None
+        return default if value is None else value
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __eq__(self, other):
+        return isinstance(other, QuizRecord) and self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<QuizRecord {}>'.format(self.id)  # pragma: no cover
+
+
+def json_default(value):
+    """
+    Let `json.dumps` store records like `QuizRecord` as dictionaries.
+    They come back as dictionaries, which work the same for callers
+    that use `.get` or indexing.
+    """
+    try:
+        return value.as_dict()
+    except AttributeError:
+        raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def iter_json_array(response, chunk_size=16 * 1024):
+    """
+    Parse a streamed JSON array one element at a time.
+
+    Only the element being parsed and the chunk it is in are held in
+    memory, not the whole body.
+
+    :param response: A response requested with `stream=True`.
+    :type response: :class:`requests.Response`
+    :param chunk_size: The number of bytes to read at a time.
+    :type chunk_size: int
+    :returns: A generator of the array's elements. If the body isn't an
+        array (e.g. an error object), the whole value is the only
+        thing generated.
+    :raises ValueError: If the body isn't valid JSON.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+    chunks = response.iter_content(chunk_size)
+    buf = ''
+    pos = 0
+    finished = False
+
+    def more():
+        try:
+            return text_decoder.decode(next(chunks))
+        except StopIteration:
+            return None
+
+    def skip(buf, pos, chars):
+        while pos < len(buf) and (buf[pos].isspace() or buf[pos] in chars):
+            pos += 1
+        return pos
+
+    # Find the start of the body.
+    while True:
+        pos = skip(buf, pos, '')
+        if pos < len(buf):
+            break
+        data = more()
+        if data is None:
+            raise ValueError('No JSON object could be decoded')
+        buf, pos = data, 0
+
+    if buf[pos] != '[':
+        rest = [buf[pos:]]
+        data = more()
+        while data is not None:
+            rest.append(data)
+            data = more()
+        yield json.loads(''.join(rest))
+        return
+
+    pos += 1
+    while True:
+        pos = skip(buf, pos, ',')
+        if pos < len(buf) and buf[pos] == ']':
+            return
+
+        if pos < len(buf):
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The element goes on into the next chunk.
+                pass
+            else:
+                # A number at the very end of the buffer may not be finished.
+                if end < len(buf) or finished:
+                    yield value
+                    pos = end
+                    continue
+
+        if finished:
+            raise ValueError('Unexpected end of JSON array')
+        data = more()
+        if data is None:
+            finished = True
+        else:
+            buf = buf[pos:] + data
+            pos = 0
+
+
+def call_key(name, args, kwargs):
+    """
+    :param name: The name of the function being called.
+    :type name: str
+    :param args: The positional arguments it is called with.
+    :type args: tuple
+    :param kwargs: The keyword arguments it is called with.
+    :type kwargs: dict
+    :rtype: str
+    :returns: A key that is the same for every call with the same
+        arguments. IDs given as numbers and as strings are treated as
+        the same.
+    """
+    normalized = json.dumps(
+        [['{}'.format(arg) for arg in args], {k: '{}'.format(v) for k, v in kwargs.items()}],
+        sort_keys=True
+    )
+    return '{}:{}'.format(name, hashlib.sha1(normalized.encode('utf-8')).hexdigest())
+
+
+def call_arguments(func, args, kwargs):
+    """
+    :param func: A function, or a decorator's wrapper around one.
+    :type func: callable
+    :param args: The positional arguments it is called with.
+    :type args: tuple
+    :param kwargs: The keyword arguments it is called with.
+    :type kwargs: dict
+    :rtype: dict
+    :returns: Every argument of the call by name, including defaults,
+        so the same call always gives the same arguments however they
+        were passed.
+    """
+    while hasattr(func, '__wrapped__'):
+        func = func.__wrapped__
+    return inspect.getcallargs(func, *args, **kwargs)
+
+
+class LRUCache(object):
+    """
+    A thread-safe in-process cache holding at most `size` entries, each
+    with its own expiry. The least recently used entry is evicted first.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :returns: The value stored under `key`, or None if there isn't
+            one or it has expired.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time():
+                self.misses += 1
+                return None
+
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time() + ttl, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResponseCache(object):
+    """
+    Caches Canvas lookups in two tiers: an `LRUCache` in each process
+    (L1) in front of Redis (L2), which every process shares.
+
+    How long each helper's results are kept is set in
+    `config.CANVAS_CACHE_TTLS`; helpers not listed there aren't cached.
+    Entries removed with `invalidate` are announced over Redis pub/sub
+    so every process drops its L1 copy too, unless `listen` is False.
+    """
+
+    def __init__(self, size, listen=True):
+        self.l1 = LRUCache(size)
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.listen = listen
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :returns: The cached value for `key`, or None.
+        """
+        self.listen_for_invalidations()
+
+        value = self.l1.get(key)
+        if value is not None:
+            return value
+
+        try:
+            pipe = conn.pipeline()
+            pipe.get(CACHE_KEY.format(key))
+            pipe.ttl(CACHE_KEY.format(key))
+            value, ttl = pipe.execute()
+        except RedisError:
+            logger.warning('Unable to reach the Canvas response cache.', exc_info=True)
+            return None
+
+        if value is None:
+            self.l2_misses += 1
+            return None
+
+        self.l2_hits += 1
+        value = json.loads(value)
+        if ttl and ttl > 0:
+            self.l1.set(key, value, ttl)
+        return value
+
+    def set(self, key, value, ttl):
+        self.l1.set(key, value, ttl)
+        try:
+            conn.set(CACHE_KEY.format(key), json.dumps(value, default=json_default), ex=ttl)
+        except RedisError:
+            logger.warning('Unable to reach the Canvas response cache.', exc_info=True)
+
+    def invalidate(self, key):
+        """
+        Remove `key` from Redis and from every process's L1 cache.
+        """
+        self.l1.delete(key)
+        try:
+            pipe = conn.pipeline()
+            pipe.delete(CACHE_KEY.format(key))
+            pipe.publish(CACHE_INVALIDATE_CHANNEL, key)
+            pipe.execute()
+        except RedisError:
+            logger.warning('Unable to invalidate the Canvas response cache.', exc_info=True)
+
+    def listen_for_invalidations(self):
+        """
+        Start a thread that drops L1 entries invalidated by any process,
+        unless one is already running.
+        """
+        if self._listener is not None or not self.listen or not self.l1.size:
+            return
+
+        with self._lock:
+            if self._listener is not None:
+                return
+
+            try:
+                pubsub = conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CACHE_INVALIDATE_CHANNEL)
+            except RedisError:
+                logger.warning('Unable to listen for cache invalidations.', exc_info=True)
+                return
+
+            self._listener = threading.Thread(target=self._listen, args=(pubsub,))
+            self._listener.daemon = True
+            self._listener.start()
+
+    def _listen(self, pubsub):
+        while True:
+            try:
+                message = pubsub.get_message(timeout=1.0)
+            except RedisError:
+                # Invalidations may have been missed, so start over.
+                logger.warning('Lost the cache invalidation channel.', exc_info=True)
+                self.l1.clear()
+                sleep(1)
+                continue
+
+            if message and message['type'] == 'message':
+                self.handle_invalidation(message)
+
+    def handle_invalidation(self, message):
+        """
+        :param message: A message from `CACHE_INVALIDATE_CHANNEL`.
+        :type message: dict
+        """
+        key = message['data']
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        self.l1.delete(key)
+
+    def metrics(self):
+        """
+        :rtype: dict
+        """
+        def tier(hits, misses):
+            total = hits + misses
+            return {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': float(hits) / total if total else None
+            }
+
+        l1 = tier(self.l1.hits, self.l1.misses)
+        l1['size'] = len(self.l1)
+        return {'l1': l1, 'l2': tier(self.l2_hits, self.l2_misses)}
+
+
+response_cache = ResponseCache(config.CANVAS_CACHE_SIZE)
+
+
+def cached(func):
+    """
+    Decorator for Canvas helpers that only read. Results are kept in
+    `response_cache` for as long as `config.CANVAS_CACHE_TTLS` says for
+    the helper. Cached results are shared, so must not be changed.
+    """
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        ttl = config.CANVAS_CACHE_TTLS.get(func.__name__)
+        if not ttl:
+            return func(*args, **kwargs)
+
+        key = call_key(func.__name__, (), call_arguments(func, args, kwargs))
+        value = response_cache.get(key)
+        if value is None:
+            value = func(*args, **kwargs)
+            response_cache.set(key, value, ttl)
+        return value
+
+    decorated_function.__wrapped__ = func
+    return decorated_function
+
+
+def invalidate_cache(func, *args, **kwargs):
+    """
+    Drop the cached result of a `cached` helper everywhere, so the next
+    call gets it fresh from Canvas.
+
+    :param func: The helper, e.g. `get_quizzes`.
+    :type func: callable
+    """
+    response_cache.invalidate(call_key(func.__name__, (), call_arguments(func, args, kwargs)))
+
+
+def single_flight(func):
+    """
+    Decorator for Canvas helpers that only read. Identical calls made
+    at the same time share one request to Canvas and its result, in
+    this process and, if `config.SINGLE_FLIGHT_REDIS` is set, across
+    every web process and worker.
+    """
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        key = call_key(func.__name__, (), call_arguments(func, args, kwargs))
+
+        def call():
+            if config.SINGLE_FLIGHT_REDIS:
+                return shared_flight(key, lambda: func(*args, **kwargs))
+            return func(*args, **kwargs)
+
+        return flights.do(key, call)
+
+    decorated_function.__wrapped__ = func
+    return decorated_function
+
+
+def token_label(token):
+    """
+    :param token: A Canvas API token.
+    :type token: str
+    :rtype: str
+    :returns: A short name for the token that is safe to log.
+    """
+    return hashlib.sha1(token.encode('utf-8')).hexdigest()[:8]
+
+
+def is_token_refused(response):
+    """
+    Check whether Canvas refused the API token a request was made with.
+
+    A 401 or 403 can also mean the token's user isn't allowed to do
+    something, which another token wouldn't change, so only one that
+    challenges for new credentials or names the token counts.
+
+    :param response: A response from Canvas.
+    :type response: :class:`requests.Response`
+    :rtype: bool
+    """
+    if response.status_code not in (401, 403) or is_rate_limited(response):
+        return False
+    return (
+        'WWW-Authenticate' in response.headers or
+        'Invalid access token' in response.text
+    )
+
+
+def is_rate_limited(response):
+    """
+    Check whether Canvas refused a request for exceeding the rate limit.
+
+    :param response: A response from Canvas.
+    :type response: :class:`requests.Response`
+    :rtype: bool
+    """
+    return response.status_code == 429 or (
+        response.status_code == 403 and 'Rate Limit Exceeded' in response.text
+    )
+
+
+def acquire_canvas_budget(token):
+    """
+    Take one request from the rate limit budget shared by every web
+    process and worker using `token`, waiting until there is some left.
+
+    Canvas rate limits each access token, so the budget is kept in a
+    token bucket in Redis that holds `config.CANVAS_BUCKET_CAPACITY`
+    requests and refills at `config.CANVAS_BUCKET_REFILL_RATE` per
+    second. Requests made outside of a web request (background jobs)
+    can't take the last `config.CANVAS_BUCKET_INTERACTIVE_RESERVE`
+    requests, which are kept for page loads.
+
+    If Redis can't be reached, the request is let through.
+
+    :param token: The Canvas API token the request will be made with.
+    :type token: str
+    :raises DeadlineExceeded: If there won't be any budget left before
+        the current deadline.
+    """
+    if not config.CANVAS_BUCKET_CAPACITY:
+        return
+
+    key = BUDGET_KEY.format(hashlib.sha1(token.encode('utf-8')).hexdigest())
+    reserve = 0 if has_request_context() else config.CANVAS_BUCKET_INTERACTIVE_RESERVE
+
+    def take(pipe):
+        tokens, updated = pipe.hmget(key, 'tokens', 'updated')
+        now = time()
+        if tokens is None:
+            tokens = config.CANVAS_BUCKET_CAPACITY
+        else:
+            tokens = min(
+                config.CANVAS_BUCKET_CAPACITY,
+                float(tokens) + (now - float(updated)) * config.CANVAS_BUCKET_REFILL_RATE
+            )
+
+        if tokens - 1 < reserve:
+            # Not enough left. Work out how long until there will be.
+            return (reserve + 1 - tokens) / config.CANVAS_BUCKET_REFILL_RATE
+
+        pipe.multi()
+        pipe.hmset(key, {'tokens': tokens - 1, 'updated': now})
+        pipe.expire(key, 60 * 60)
+        return 0
+
+    while True:
+        try:
+            wait = conn.transaction(take, key, value_from_callable=True)
+        except RedisError:
+            logger.warning('Unable to reach the shared Canvas rate limit budget.', exc_info=True)
+            return
+
+        if not wait:
+            return
+        check_deadline(wait)
+        sleep(wait)
+
+
+def canvas_metrics():
+    """
+    Get metrics about this process's use of the Canvas API.
+
+    :rtype: dict
+    """
+    metrics = concurrency_limiter.metrics()
+    metrics.update(circuit_breaker.metrics())
+    metrics.update(flights.metrics())
+    metrics['cache'] = response_cache.metrics()
+    metrics['tokens'] = token_pool.metrics()
+    return metrics
+
+
+def canvas_request(method, url, retries=None, **kwargs):
+    """
+    Send a request to the Canvas API, retrying transient errors.
+
+    Rate limited and 5xx responses, dropped connections and timeouts
+    are retried with exponential backoff and jitter, waiting at least as
+    long as the `Retry-After` header asks. Each attempt is made with a
+    token from `token_pool` and waits for that token's shared rate limit
+    budget, and the number of requests in flight at once is limited by
+    `concurrency_limiter`. If Canvas refuses a token, the request is
+    sent again straight away with the next one. While `circuit_breaker`
+    is open no requests are sent at all. Timeouts and retries are cut
+    short to fit in the time left before the current `deadline`.
+
+    :param method: The HTTP method to use.
+    :type method: str
+    :param url: The full URL of the API endpoint.
+    :type url: str
+    :param retries: How many times to retry. Defaults to
+        `config.CANVAS_GET_RETRIES` for GET requests, which are safe to
+        repeat, and `config.CANVAS_POST_RETRIES` for anything else.
+    :type retries: int
+    :param kwargs: Passed on to `requests.request`. An Authorization
+        header is added to any `headers` given, and `timeout` defaults to
+        `config.CANVAS_CONNECT_TIMEOUT` and `config.CANVAS_READ_TIMEOUT`.
+    :rtype: :class:`requests.Response`
+    :returns: The last response received, which may still be an error.
+    :raises requests.exceptions.RequestException: If the last attempt
+        could not connect or timed out.
+    :raises CanvasUnavailable: If the circuit breaker is open.
+    :raises DeadlineExceeded: If the request can't be finished before
+        the current deadline.
+    """
+    if retries is None:
+        retries = config.CANVAS_GET_RETRIES if method == 'GET' else config.CANVAS_POST_RETRIES
+    request_headers = dict(kwargs.pop('headers', None) or {})
+    timeout = kwargs.pop('timeout', (config.CANVAS_CONNECT_TIMEOUT, config.CANVAS_READ_TIMEOUT))
+    refused_tokens = set()
+    attempt = 0
+
+    while True:
+        token = token_pool.choose(exclude=refused_tokens)
+        request_headers['Authorization'] = 'Bearer ' + token
+
+        response = None
+        success = None
+        check_deadline()
+        circuit_breaker.before_request()
+        try:
+            acquire_canvas_budget(token)
+            concurrency_limiter.acquire()
+            try:
+                started = time()
+                response = requests.request(
+                    method,
+                    url,
+                    headers=request_headers,
+                    timeout=deadline_timeout(timeout),
+                    **kwargs
+                )
+                elapsed = time() - started
+                record_latency(method, elapsed)
+                success = (
+                    response.status_code < 500 and
+                    elapsed <= config.CANVAS_BREAKER_SLOW_CALL
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                # A call cut short by the deadline says nothing about Canvas.
+                check_deadline()
+                success = False
+                if attempt >= retries:
+                    raise
+            finally:
+                concurrency_limiter.release(response)
+        finally:
+            circuit_breaker.record(success)
+
+        if response is not None:
+            token_pool.record(token, response)
+
+            if is_token_refused(response):
+                refused_tokens.add(token)
+                if len(refused_tokens) < len(token_pool):
+                    continue
+
+            retry = response.status_code in RETRY_STATUS_CODES or is_rate_limited(response)
+            if not retry or attempt >= retries:
+                return response
+
+        delay = retry_delay(attempt, response)
+        check_deadline(delay)
+        logger.warning('Canvas request {} {} failed ({}). Retrying in {:.2f} seconds.'.format(
+            method,
+            url,
+            response.status_code if response is not None else 'no response',
+            delay
+        ))
+        sleep(delay)
+        attempt += 1
+
+
+def retry_delay(attempt, response=None):
+    """
+    Work out how long to wait before retrying a Canvas request.
+
+    :param attempt: The number of attempts made so far, minus one.
+    :type attempt: int
+    :param response: The failed response, if there was one.
+    :type response: :class:`requests.Response`
+    :rtype: float
+    :returns: A random delay of up to `config.CANVAS_RETRY_BACKOFF`
+        seconds, doubled for each attempt, or the `Retry-After` time if
+        that is longer. Never more than `config.CANVAS_RETRY_MAX_BACKOFF`.
+    """
+    delay = random.uniform(0, config.CANVAS_RETRY_BACKOFF * 2 ** attempt)
+
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get('Retry-After', 0)))
+        except ValueError:
+            pass
+
+    return min(delay, config.CANVAS_RETRY_MAX_BACKOFF)
+
+
+def extend_quiz(course_id, quiz, percent, user_id_list):
+    """
+    Extends a quiz time by a percentage for a list of users.
+
+    :param quiz: A quiz object from Canvas
+    :type quiz: dict
+    :param percent: The percent of original quiz time to be applied.
+        e.g. 200 is double time, 100 is normal time, <100 is invalid.
+    :type percent: int
+    :param user_id_list: A list of Canvas user IDs to add time for.
+    :type user_id_list: list
+    :rtype: dict
+    :returns: A dictionary with five parts:
+
+        - success `bool` False if there was an error, True otherwise.
+        - message `str` A long description of success or failure.
+        - added_time `int` The amount of time added in minutes. Returns
+        `None` if there was no time added.
+        - failed_user_ids `list` The users Canvas didn't accept, or
+        whose extra time it didn't confirm. The rest were extended.
+        - verified_user_ids `list` The users Canvas confirmed have the
+        extra time in its response.
+    """
+    quiz_id = quiz.get('id')
+    time_limit = quiz.get('time_limit')
+
+    if time_limit is None or time_limit < 1:
+        return no_time_limit_result(quiz_id)
+
+    added_time = extra_time(time_limit, percent)
+    posted = post_extensions(
+        course_id,
+        quiz_id,
+        [(user_id, added_time) for user_id in user_id_list]
+    )
+    return extension_result(quiz_id, added_time, user_id_list, posted)
+
+
+def no_time_limit_result(quiz_id):
+    """
+    :param quiz_id: The Canvas ID of the quiz.
+    :type quiz_id: int
+    :rtype: dict
+    :returns: The result of extending a quiz with no time limit. See
+        `extend_quiz`.
+    """
+    msg = 'Quiz #{} has no time limit, so there is no time to add.'
+    return {
+        'success': True,
+        'message': msg.format(quiz_id),
+        'added_time': None,
+        'failed_user_ids': [],
+        'verified_user_ids': []
+    }
+
+
+def post_extensions(course_id, quiz_id, user_times):
+    """
+    Post extra time on a quiz for users, each with their own number of
+    extra minutes.
+
+    Large lists of users are posted in chunks of
+    `config.EXTENSION_CHUNK_SIZE`, up to `config.EXTENSION_CHUNK_WORKERS`
+    at a time, so no single request grows too big to finish in time.
+    The extensions Canvas sends back are checked against the ones
+    posted.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param quiz_id: The Canvas ID of the quiz.
+    :type quiz_id: int
+    :param user_times: A list of (user ID, extra minutes) pairs.
+    :type user_times: list
+    :rtype: dict
+    :returns: A dictionary with three parts:
+
+        - failed `dict` The Canvas status code for each user in a chunk
+        Canvas didn't accept.
+        - unconfirmed `list` The users Canvas accepted but didn't send
+        back with the right extra time.
+        - verified `list` The users Canvas sent back with the right
+        extra time.
+    """
+    url = "{}courses/{}/quizzes/{}/extensions".format(config.API_URL, course_id, quiz_id)
+
+    def post_chunk(chunk):
+        quiz_extensions = defaultdict(list)
+
+        for user_id, added_time in chunk:
+            user_extension = {
+                'user_id': user_id,
+                'extra_time': added_time
+            }
+            quiz_extensions['quiz_extensions'].append(user_extension)
+
+        extensions_response = canvas_request(
+            'POST',
+            url,
+            data=json.dumps(quiz_extensions),
+            headers=json_headers
+        )
+        if extensions_response.status_code != 200:
+            return extensions_response.status_code, None
+        return 200, confirmed_extensions(extensions_response)
+
+    chunks = chunked(list(user_times), config.EXTENSION_CHUNK_SIZE)
+    results = in_parallel(post_chunk, chunks, config.EXTENSION_CHUNK_WORKERS)
+
+    posted = {'failed': {}, 'unconfirmed': [], 'verified': []}
+    for chunk, (status_code, confirmed) in zip(chunks, results):
+        for user_id, added_time in chunk:
+            if status_code != 200:
+                posted['failed'][user_id] = status_code
+            elif confirmed is None:
+                # Canvas didn't send the extensions back, so there is
+                # nothing to check.
+                continue
+            elif confirmed.get(int(user_id)) == added_time:
+                posted['verified'].append(user_id)
+            else:
+                posted['unconfirmed'].append(user_id)
+    return posted
+
+
+def extension_result(quiz_id, added_time, user_id_list, posted):
+    """
+    :param quiz_id: The Canvas ID of the quiz.
+    :type quiz_id: int
+    :param added_time: The extra minutes posted for the users.
+    :type added_time: int
+    :param user_id_list: The users to report on.
+    :type user_id_list: list
+    :param posted: The result of `post_extensions`.
+    :type posted: dict
+    :rtype: dict
+    :returns: The result of extending the quiz for the users. See
+        `extend_quiz`.
+    """
+    failed_user_ids = [user_id for user_id in user_id_list if user_id in posted['failed']]
+    unconfirmed = set(posted['unconfirmed'])
+    unconfirmed_user_ids = [user_id for user_id in user_id_list if user_id in unconfirmed]
+    verified = set(posted['verified'])
+    verified_user_ids = [user_id for user_id in user_id_list if user_id in verified]
+
+    if not failed_user_ids and not unconfirmed_user_ids:
+        msg = 'Successfully added {} minutes to quiz #{}'
+        return {
+            'success': True,
+            'message': msg.format(added_time, quiz_id),
+            'added_time': added_time,
+            'failed_user_ids': [],
+            'verified_user_ids': verified_user_ids
+        }
+    elif failed_user_ids:
+        status_code = posted['failed'][failed_user_ids[0]]
+        if len(failed_user_ids) < len(user_id_list):
+            msg = 'Error creating extension for {} of {} users on quiz #{}. Canvas status code: {}'
+            msg = msg.format(len(failed_user_ids), len(user_id_list), quiz_id, status_code)
+        else:
+            msg = 'Error creating extension for quiz #{}. Canvas status code: {}'
+            msg = msg.format(quiz_id, status_code)
+    else:
+        msg = 'Canvas did not confirm {} minutes for {} of {} users on quiz #{}.'
+        msg = msg.format(added_time, len(unconfirmed_user_ids), len(user_id_list), quiz_id)
+
+    return {
+        'success': False,
+        'message': msg,
+        'added_time': None,
+        'failed_user_ids': failed_user_ids + unconfirmed_user_ids,
+        'verified_user_ids': verified_user_ids
+    }
+
+
+def confirmed_extensions(response):
+    """
+    Read back the extensions Canvas says it saved.
+
+    :param response: The response to posting quiz extensions.
+    :type response: :class:`requests.Response`
+    :rtype: dict
+    :returns: The extra minutes Canvas confirmed for each user, keyed by
+        user ID as an int, or None if the response doesn't list the
+        extensions. Canvas may send IDs as strings, e.g. '00123'.
+    """
+    try:
+        quiz_extensions = response.json().get('quiz_extensions')
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(quiz_extensions, list):
+        return None
+
+    confirmed = {}
+    for extension in quiz_extensions:
+        try:
+            confirmed[int(extension.get('user_id'))] = extension.get('extra_time')
+        except (TypeError, ValueError):
+            continue
+    return confirmed
+
+
+def chunked(items, size):
+    """
+    :param items: The list to split up.
+    :type items: list
+    :param size: The most items in each chunk, or 0 for no limit.
+    :type size: int
+    :rtype: list
+    :returns: A list of chunks. There is always at least one, even if
+        `items` is empty.
+    """
+    if size < 1 or len(items) <= size:
+        return [items]
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def in_parallel(func, items, workers):
+    """
+    Call `func` on each item, up to `workers` at a time, under the
+    current deadline. Canvas requests made by the calls still share the
+    process's concurrency limit and the shared request budget.
+
+    :param func: The function to call.
+    :type func: callable
+    :param items: The arguments to call it with, one per call.
+    :type items: list
+    :param workers: The most calls to make at once.
+    :type workers: int
+    :rtype: list
+    :returns: The results, in the same order as `items`.
+    :raises: The first exception raised by a call.
+    """
+    workers = min(workers, len(items))
+    if workers < 2:
+        return [func(item) for item in items]
+
+    # Pool threads don't see this thread's deadline, so each call is
+    # given the same point in time to finish by, not the time that was
+    # left when the pool started.
+    at = getattr(_deadlines, 'at', None)
+
+    def call(item):
+        previous = getattr(_deadlines, 'at', None)
+        _deadlines.at = at
+        try:
+            return func(item)
+        finally:
+            reset_deadline(previous)
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class ExtensionOperation(object):
+    """
+    One extension to post: `added_time` extra minutes on a quiz for a
+    group of users.
+
+    `added_time` is None if the quiz has no time limit, and `user_ids`
+    is empty if every user already has the extension. Either way no
+    request is needed.
+    """
+
+    __slots__ = ('quiz', 'percent', 'user_ids', 'added_time')
+
+    def __init__(self, quiz, percent, user_ids, added_time):
+        self.quiz = quiz
+        self.percent = percent
+        self.user_ids = user_ids
+        self.added_time = added_time
+
+    @property
+    def api_calls(self):
+        if self.added_time is None or not self.user_ids:
+            return 0
+        return len(chunked(self.user_ids, config.EXTENSION_CHUNK_SIZE))
+
+    def as_dict(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'quiz_id': self.quiz.get('id'),
+            'title': self.quiz.get('title', '[UNTITLED QUIZ]'),
+            'percent': self.percent,
+            'user_ids': self.user_ids,
+            'extra_time': self.added_time,
+            'api_calls': self.api_calls
+        }
+
+
+def execute_operations(course_id, operations):
+    """
+    Post the extensions needed by several operations on the same quiz
+    in one go, each user with their own extra time, and record them in
+    the ledger of applied extensions.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param operations: Operations on one quiz, with no user in more
+        than one of them.
+    :type operations: list
+    :rtype: list
+    :returns: The result of each operation, the same as `extend_quiz`.
+    """
+    to_post = [
+        operation for operation in operations
+        if operation.added_time is not None and operation.user_ids
+    ]
+    posted = None
+    if to_post:
+        posted = post_extensions(
+            course_id,
+            to_post[0].quiz.get('id'),
+            [
+                (user_id, operation.added_time)
+                for operation in to_post for user_id in operation.user_ids
+            ]
+        )
+
+    responses = []
+    for operation in operations:
+        quiz_id = operation.quiz.get('id')
+        if operation.added_time is None:
+            responses.append(no_time_limit_result(quiz_id))
+            continue
+        if not operation.user_ids:
+            msg = 'Quiz #{} already has {} minutes added for every user.'
+            responses.append({
+                'success': True,
+                'message': msg.format(quiz_id, operation.added_time),
+                'added_time': operation.added_time,
+                'failed_user_ids': [],
+                'verified_user_ids': []
+            })
+            continue
+
+        response = extension_result(quiz_id, operation.added_time, operation.user_ids, posted)
+
+        # Record the users that went through even if others failed, so
+        # a retry only posts the rest.
+        failed = set(response['failed_user_ids'])
+        applied = [user_id for user_id in operation.user_ids if user_id not in failed]
+        if applied:
+            record_applied(
+                quiz_id,
+                operation.added_time,
+                applied,
+                verified=response['verified_user_ids']
+            )
+        responses.append(response)
+
+    return responses
+
+
+class ExtensionPlan(object):
+    """
+    The extensions to post for a course, worked out before anything is
+    posted. A plan can be shown to the user as a dry run, and jobs
+    carry it out a quiz at a time with `execute_operations`.
+    """
+
+    def __init__(self, course_id, steps, skipped=None, lookups=0):
+        """
+        :param course_id: The Canvas ID of the Course.
+        :type course_id: int
+        :param steps: A list of (quiz, operations) pairs, one for each
+            quiz, in the order they will be extended.
+        :type steps: list
+        :param skipped: The quizzes left out by the quiz filters, as
+            returned by `filter_quizzes`.
+        :type skipped: list
+        :param lookups: The number of requests to look up the course,
+            its students and quizzes before anything is posted.
+        :type lookups: int
+        """
+        self.course_id = course_id
+        self.steps = steps
+        self.skipped = skipped or []
+        self.lookups = lookups
+
+    @property
+    def quizzes(self):
+        return [quiz for quiz, operations in self.steps]
+
+    @property
+    def operations(self):
+        return [operation for quiz, operations in self.steps for operation in operations]
+
+    def quiz_posts(self):
+        """
+        :rtype: list
+        :returns: The number of posts for each quiz. Every user on a
+            quiz is posted in one go, chunked as in `post_extensions`.
+        """
+        posts = []
+        for quiz, operations in self.steps:
+            user_ids = [
+                user_id for operation in operations if operation.api_calls
+                for user_id in operation.user_ids
+            ]
+            posts.append(len(chunked(user_ids, config.EXTENSION_CHUNK_SIZE)) if user_ids else 0)
+        return posts
+
+    @property
+    def api_calls(self):
+        return self.lookups + sum(self.quiz_posts())
+
+    def estimated_duration(self):
+        """
+        :rtype: float
+        :returns: Roughly how many seconds the lookups and posts will
+            take, going by how long recent requests to Canvas have
+            taken. Each quiz's posts are sent up to
+            `config.EXTENSION_CHUNK_WORKERS` at a time.
+        """
+        def latency(method):
+            seconds = observed_latency(method)
+            if seconds is None:
+                return config.CANVAS_ASSUMED_LATENCY
+            return seconds
+
+        workers = max(1, config.EXTENSION_CHUNK_WORKERS)
+        rounds = sum(-(-posts // workers) for posts in self.quiz_posts())
+        return self.lookups * latency('GET') + rounds * latency('POST')
+
+    def as_dict(self):
+        """
+        :rtype: dict
+        """
+        return {
+            'course_id': self.course_id,
+            'operations': [operation.as_dict() for operation in self.operations],
+            'api_calls': self.api_calls,
+            'lookups': self.lookups,
+            'estimated_duration': self.estimated_duration(),
+            'skipped': self.skipped
+        }
+
+
+def skip_reason(quiz, now=None):
+    """
+    Check a quiz against the quiz filters in the config.
+
+    :param quiz: A quiz from Canvas.
+    :type quiz: :class:`QuizRecord` or dict
+    :param now: The current time, as seconds since the epoch.
+    :type now: float
+    :rtype: str
+    :returns: Why the quiz shouldn't be extended, or None if it should.
+    """
+    if now is None:
+        now = time()
+
+    lock_at = parse_canvas_time(quiz.get('lock_at'))
+    due_at = parse_canvas_time(quiz.get('due_at'))
+
+    if config.SKIP_LOCKED_QUIZZES and lock_at and to_timestamp(lock_at) < now:
+        return 'locked'
+    if config.SKIP_PAST_DUE_QUIZZES and due_at and to_timestamp(due_at) < now:
+        return 'past due'
+    if quiz.get('quiz_type') in config.SKIP_QUIZ_TYPES:
+        return quiz.get('quiz_type')
+    if config.SKIP_UNPUBLISHED_QUIZZES and quiz.get('published') is False:
+        return 'unpublished'
+    if quiz.get('assignment_group_id') in config.SKIP_ASSIGNMENT_GROUPS:
+        return 'assignment group'
+    return None
+
+
+def filter_quizzes(quizzes, now=None):
+    """
+    Split quizzes into those to extend and those the quiz filters in
+    the config leave out.
+
+    :param quizzes: Quizzes from Canvas.
+    :type quizzes: list
+    :param now: The current time, as seconds since the epoch.
+    :type now: float
+    :rtype: tuple
+    :returns: The quizzes to extend, and a list of dictionaries with the
+        id, title and reason for each quiz left out.
+    """
+    kept = []
+    skipped = []
+    for quiz in quizzes:
+        reason = skip_reason(quiz, now)
+        if reason is None:
+            kept.append(quiz)
+        else:
+            skipped.append({
+                'id': quiz.get('id'),
+                'title': quiz.get('title'),
+                'reason': reason
+            })
+    return kept, skipped
+
+
+def plan_extensions(course_id, quizzes, percent_user_map, force=False, lookups=0):
+    """
+    Work out the extensions to post on each quiz, leaving out quizzes
+    the quiz filters skip and users the ledger shows already have them.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param quizzes: The quizzes to extend.
+    :type quizzes: list
+    :param percent_user_map: A dictionary mapping each percent of time
+        to the list of Canvas user IDs that should get it.
+    :type percent_user_map: dict
+    :param force: Plan to post every extension, whatever the ledger
+        says.
+    :type force: bool
+    :param lookups: The number of requests made before posting. See
+        `ExtensionPlan`.
+    :type lookups: int
+    :rtype: :class:`ExtensionPlan`
+    """
+    quizzes, skipped = filter_quizzes(quizzes)
+
+    applied = {}
+    if not force:
+        applied = applied_extensions(
+            [quiz.get('id') for quiz in quizzes],
+            [user_id for user_ids in percent_user_map.values() for user_id in user_ids]
+        )
+
+    steps = []
+    for quiz in by_urgency(quizzes):
+        quiz_id = quiz.get('id')
+        time_limit = quiz.get('time_limit')
+
+        operations = []
+        for percent, user_ids in percent_user_map.iteritems():
+            if time_limit is None or time_limit < 1:
+                operations.append(ExtensionOperation(quiz, percent, user_ids, None))
+                continue
+
+            added_time = extra_time(time_limit, percent)
+            user_ids = [
+                user_id for user_id in user_ids
+                if applied.get((int(quiz_id), int(user_id))) != added_time
+            ]
+            operations.append(ExtensionOperation(quiz, percent, user_ids, added_time))
+
+        steps.append((quiz, operations))
+
+    return ExtensionPlan(course_id, steps, skipped, lookups)
+
+
+def record_latency(method, seconds):
+    """
+    Keep the last `config.CANVAS_LATENCY_SAMPLES` response times for
+    each kind of request, shared between processes.
+    """
+    key = LATENCY_KEY.format(method)
+    try:
+        pipe = conn.pipeline()
+        pipe.lpush(key, seconds)
+        pipe.ltrim(key, 0, config.CANVAS_LATENCY_SAMPLES - 1)
+        pipe.execute()
+    except RedisError:
+        logger.debug('Unable to record Canvas latency.', exc_info=True)
+
+
+def observed_latency(method):
+    """
+    :param method: The HTTP method, e.g. 'POST'.
+    :type method: str
+    :rtype: float
+    :returns: The average time recent requests took, in seconds, or
+        None if there are none to go by.
+    """
+    try:
+        samples = conn.lrange(LATENCY_KEY.format(method), 0, -1)
+    except RedisError:
+        return None
+    if not samples:
+        return None
+    return sum(float(sample) for sample in samples) / len(samples)
+
+
+def parse_canvas_time(value):
+    """
+    :param value: A timestamp from Canvas, e.g. '2018-01-31T23:59:00Z'.
+    :type value: str
+    :rtype: datetime.datetime
+    :returns: The time in UTC, or None if there isn't one.
+    """
+    if not value:
+        return None
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def to_timestamp(value):
+    """
+    :param value: A time in UTC, as returned by `parse_canvas_time`.
+    :type value: datetime.datetime
+    :rtype: float
+    :returns: The time as seconds since the epoch.
+    """
+    return calendar.timegm(value.utctimetuple())
+
+
+def by_urgency(quizzes, now=None):
+    """
+    Order quizzes so that the ones students can take soonest come first.
+
+    Quizzes that are open now come first, soonest due first, then
+    quizzes that haven't unlocked yet, soonest unlock first. Quizzes
+    that are past their due date come last.
+
+    :param quizzes: The quizzes to order.
+    :type quizzes: list
+    :param now: The current time, as seconds since the epoch.
+    :type now: float
+    :rtype: list
+    """
+    if now is None:
+        now = time()
+
+    def urgency(quiz):
+        unlock_at = parse_canvas_time(quiz.get('unlock_at'))
+        due_at = parse_canvas_time(quiz.get('due_at'))
+        opens = max(to_timestamp(unlock_at), now) if unlock_at else now
+        due = to_timestamp(due_at) if due_at else float('inf')
+        return (due < now, opens, due)
+
+    return sorted(quizzes, key=urgency)
+
+
+def extra_time(time_limit, percent):
+    """
+    :param time_limit: A quiz's time limit in minutes.
+    :type time_limit: int
+    :param percent: The percent of the time limit to give.
+    :type percent: int
+    :rtype: int
+    :returns: The minutes to add to the time limit.
+    """
+    return int(math.ceil(time_limit * ((float(percent) - 100) / 100) if percent else 0))
+
+
+def applied_extensions(quiz_ids, user_ids):
+    """
+    Look up the ledger of applied extensions.
+
+    :param quiz_ids: Canvas quiz IDs.
+    :type quiz_ids: list
+    :param user_ids: Canvas user IDs.
+    :type user_ids: list
+    :rtype: dict
+    :returns: The extra time each of the users has on each of the
+        quizzes, keyed by (quiz ID, user ID). Pairs with nothing
+        applied are left out, as are those Canvas didn't confirm unless
+        `config.TRUST_UNVERIFIED_EXTENSIONS` is set.
+    """
+    quiz_ids = {int(quiz_id) for quiz_id in quiz_ids}
+    user_ids = {int(user_id) for user_id in user_ids}
+    if not quiz_ids or not user_ids:
+        return {}
+
+    query = AppliedExtension.query.filter(
+        AppliedExtension.quiz_canvas_id.in_(quiz_ids),
+        AppliedExtension.user_canvas_id.in_(user_ids)
+    )
+    if not config.TRUST_UNVERIFIED_EXTENSIONS:
+        query = query.filter(AppliedExtension.verified.is_(True))
+
+    return {
+        (entry.quiz_canvas_id, entry.user_canvas_id): entry.extra_time
+        for entry in query
+    }
+
+
+def record_applied(quiz_id, added_time, user_id_list, verified=()):
+    """
+    Record in the ledger that users were given `added_time` on a quiz.
+
+    :param quiz_id: The Canvas ID of the quiz.
+    :type quiz_id: int
+    :param added_time: The extra minutes the users were given.
+    :type added_time: int
+    :param user_id_list: Canvas user IDs.
+    :type user_id_list: list
+    :param verified: The users Canvas confirmed have the extra time.
+    :type verified: list
+    """
+    if not user_id_list:
+        return
+
+    user_ids = {int(user_id) for user_id in user_id_list}
+    verified = {int(user_id) for user_id in verified}
+    existing = AppliedExtension.query.filter(
+        AppliedExtension.quiz_canvas_id == int(quiz_id),
+        AppliedExtension.user_canvas_id.in_(user_ids)
+    ).all()
+
+    for entry in existing:
+        entry.extra_time = added_time
+        entry.verified = entry.user_canvas_id in verified
+        user_ids.discard(entry.user_canvas_id)
+    for user_id in user_ids:
+        db.session.add(AppliedExtension(int(quiz_id), user_id, added_time, user_id in verified))
+
+    db.session.commit()
+
+
+@cached
+@single_flight
+def get_quizzes(course_id, per_page=config.MAX_PER_PAGE):
+    """
+    Get all quizzes in a Canvas course.
+
+    Each page is parsed as it arrives and only the fields in
+    `QuizRecord` are kept, so big courses don't need the full Canvas
+    quizzes in memory.
+
+    :param course_id: The Canvas ID of a Course
+    :type course_id: int
+    :param per_page: The number of quizzes to get per page.
+    :type per_page: int
+    :rtype: list
+    :returns: A list of :class:`QuizRecord`.
+    :raises requests.exceptions.HTTPError: If Canvas could not return a
+        page of quizzes, or returned errors instead of one, rather than
+        returning only some of them.
+    """
+    quizzes = []
+    quizzes_url = "{}courses/{}/quizzes?per_page={}".format(
+        config.API_URL,
+        course_id,
+        per_page
+    )
+
+    while quizzes_url:
+        quizzes_response = canvas_request('GET', quizzes_url, stream=True)
+        with closing(quizzes_response):
+            quizzes_response.raise_for_status()
+
+            for quiz in iter_json_array(quizzes_response):
+                if 'errors' in quiz:
+                    msg = 'Error getting quizzes for course #{} from Canvas. Response: {}'
+                    logger.error(msg.format(course_id, quiz))
+                    raise requests.exceptions.HTTPError(
+                        msg.format(course_id, quiz), response=quizzes_response
+                    )
+
+                quizzes.append(QuizRecord.from_json(quiz))
+
+        quizzes_url = quizzes_response.links.get('next', {}).get('url')
+
+    return quizzes
+
+
+@cached
+@single_flight
+def search_students(course_id, per_page=config.DEFAULT_PER_PAGE, page=1, search_term=""):
+    """
+    Search for students in the course.
+
+    If no search term is provided, all users are returned.
+
+    :param course_id: The Canvas ID of a Course.
+    :type course_id: int
+    :param per_page: The number of students to get
+    :type per_page: int
+    :param page: The page number to get
+    :type page: int
+    :param search_term: A string to filter students by
+    :type search_term: str
+    """
+    url_str = "{}courses/{}/search_users?per_page={}&page={}"
+    users_url = url_str.format(
+        config.API_URL,
+        course_id,
+        per_page,
+        page
+    )
+
+    users_response = canvas_request(
+        'GET',
+        users_url,
+        data={
+            'search_term': search_term,
+            'enrollment_type': 'student',
+            'enrollment_state': ['active']
+        },
+    )
+
+    try:
+        user_list = users_response.json()
+    except ValueError:
+        # response is weird. log it!
+        logger.exception('Error getting user list from Canvas.')
+        return [], 0
+
+    if 'errors' in user_list:
+        msg = 'Error getting user list from Canvas. Response: {}'
+        logger.error(msg.format(users_response))
+        return [], 0
+
+    try:
+        num_pages = int(
+            parse_qs(
+                urlsplit(
+                    users_response.links['last']['url']
+                ).query
+            )['page'][0]
+        )
+    except KeyError:
+        num_pages = 0
+
+    return user_list, num_pages
+
+
+@cached
+@single_flight
+def get_user(course_id, user_id):
+    """
+    Get a user from canvas by id, with respect to a course.
+
+    :param user_id: ID of a Canvas course.
+    :type user_id: int
+    :param user_id: ID of a Canvas user.
+    :type user_id: int
+    :rtype: dict
+    :returns: A dictionary representation of a User in Canvas.
+    """
+    response = canvas_request(
+        'GET',
+        '{}courses/{}/users/{}'.format(
+            config.API_URL,
+            course_id,
+            user_id
+        ),
+        params={'include[]': 'enrollments'}
+    )
+    response.raise_for_status()
+
+    return response.json()
+
+
+@cached
+@single_flight
+def get_sections(course_id, per_page=config.MAX_PER_PAGE):
+    """
+    Get all sections in a Canvas course.
+
+    :param course_id: The Canvas ID of a Course.
+    :type course_id: int
+    :param per_page: The number of sections to get per page.
+    :type per_page: int
+    :rtype: list
+    :returns: A list of dictionaries with the `id` and `name` of each
+        section.
+    :raises requests.exceptions.HTTPError: If Canvas could not return a
+        page of sections.
+    """
+    sections = []
+    sections_url = "{}courses/{}/sections?per_page={}".format(
+        config.API_URL,
+        course_id,
+        per_page
+    )
+
+    while sections_url:
+        response = canvas_request('GET', sections_url)
+        response.raise_for_status()
+
+        sections.extend(
+            {'id': section['id'], 'name': section.get('name')}
+            for section in response.json()
+        )
+        sections_url = response.links.get('next', {}).get('url')
+
+    return sections
+
+
+@cached
+@single_flight
+def get_roster(course_id, section_id=None, per_page=config.MAX_PER_PAGE):
+    """
+    Get every active student in a course, or in one of its sections.
+
+    The roster comes from the enrollments API, a page at a time, so a
+    whole course costs a handful of requests rather than one per
+    student.
+
+    :param course_id: The Canvas ID of a Course.
+    :type course_id: int
+    :param section_id: The Canvas ID of a section in the course, or
+        None for the whole course.
+    :type section_id: int
+    :param per_page: The number of enrollments to get per page.
+    :type per_page: int
+    :rtype: list
+    :returns: A list of users, each a dictionary with the `id`,
+        `sortable_name` and `sis_user_id` Canvas gives. A student
+        enrolled in more than one section is only listed once.
+    :raises requests.exceptions.HTTPError: If Canvas could not return a
+        page of the roster, rather than returning only some of it.
+    """
+    if section_id is None:
+        roster_url = "{}courses/{}/enrollments".format(config.API_URL, course_id)
+    else:
+        roster_url = "{}sections/{}/enrollments".format(config.API_URL, section_id)
+    roster_url += "?type[]=StudentEnrollment&state[]=active&per_page={}".format(per_page)
+
+    users = OrderedDict()
+    while roster_url:
+        response = canvas_request('GET', roster_url, stream=True)
+        with closing(response):
+            response.raise_for_status()
+
+            for enrollment in iter_json_array(response):
+                user = enrollment.get('user') or {}
+                user_id = enrollment.get('user_id', user.get('id'))
+                if user_id is None or str(user_id) in users:
+                    continue
+
+                users[str(user_id)] = {
+                    'id': user_id,
+                    'sortable_name': user.get('sortable_name'),
+                    'sis_user_id': user.get('sis_user_id')
+                }
+
+        roster_url = response.links.get('next', {}).get('url')
+
+    return list(users.values())
+
+
+@cached
+@single_flight
+def get_course(course_id):
+    """
+    Get a course from canvas by id.
+
+    :param course_id: ID of a Canvas course.
+    :type course_id: int
+    :rtype: dict
+    :returns: A dictionary representation of a Course in Canvas.
+    """
+    course_url = "{}courses/{}".format(config.API_URL, course_id)
+    response = canvas_request('GET', course_url)
+    response.raise_for_status()
+
+    return response.json()
+
+
+@cached
+@single_flight
+def uses_new_quizzes(course_id):
+    """
+    Check whether New Quizzes are turned on for a course.
+
+    :param course_id: ID of a Canvas course.
+    :type course_id: int
+    :rtype: bool
+    """
+    features_url = "{}courses/{}/features/enabled".format(config.API_URL, course_id)
+    response = canvas_request('GET', features_url)
+    response.raise_for_status()
+
+    return 'quizzes_next' in response.json()
+
+
+def new_quizzes_url():
+    """
+    :rtype: str
+    :returns: The base URL of the New Quizzes API, which sits next to
+        the main Canvas API.
+    """
+    return config.API_URL.replace('/api/v1/', '/api/quiz/v1/')
+
+
+def get_new_quizzes(course_id):
+    """
+    Get all the New Quizzes in a course.
+
+    :param course_id: ID of a Canvas course.
+    :type course_id: int
+    :rtype: list
+    :returns: A list of dictionaries representing New Quizzes.
+    """
+    quizzes = []
+    quizzes_url = "{}courses/{}/quizzes?per_page={}".format(
+        new_quizzes_url(),
+        course_id,
+        config.MAX_PER_PAGE
+    )
+
+    while quizzes_url:
+        quizzes_response = canvas_request('GET', quizzes_url)
+        quizzes_response.raise_for_status()
+
+        quizzes.extend(quizzes_response.json())
+        quizzes_url = quizzes_response.links.get('next', {}).get('url')
+
+    return quizzes
+
+
+def longest_time_limit(new_quizzes):
+    """
+    :param new_quizzes: The New Quizzes in a course.
+    :type new_quizzes: list
+    :rtype: int
+    :returns: The longest time limit in minutes, or None if no quiz has
+        a time limit.
+    """
+    time_limits = [
+        quiz.get('quiz_settings', {}).get('session_time_limit_in_seconds')
+        for quiz in new_quizzes
+        if quiz.get('quiz_settings', {}).get('has_time_limit')
+    ]
+    time_limits = [time_limit for time_limit in time_limits if time_limit]
+    if not time_limits:
+        return None
+
+    return int(math.ceil(max(time_limits) / 60.0))
+
+
+def accommodation_time(new_quizzes, percent):
+    """
+    Course accommodations give the same extra minutes on every quiz,
+    so base them on the longest time limit. Students get at least
+    `percent` time on every quiz.
+
+    :param new_quizzes: The New Quizzes in a course.
+    :type new_quizzes: list
+    :param percent: The percent of the time limit to give.
+    :type percent: int
+    :rtype: int
+    :returns: The minutes to add, or None if no quiz has a time limit.
+    """
+    time_limit = longest_time_limit(new_quizzes)
+    if time_limit is None:
+        return None
+
+    return extra_time(time_limit, percent)
+
+
+def set_accommodation(course_id, user_id, added_time):
+    """
+    Give a user extra time on every New Quiz in a course.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param user_id: The Canvas ID of the user.
+    :type user_id: int
+    :param added_time: The minutes to add.
+    :type added_time: int
+    :rtype: dict
+    :returns: The same as `extend_quiz`.
+    """
+    accommodations_url = "{}courses/{}/accommodations".format(new_quizzes_url(), course_id)
+    response = canvas_request(
+        'POST',
+        accommodations_url,
+        data=json.dumps([{
+            'user_id': int(user_id),
+            'extra_time': added_time,
+            'apply_to_in_progress_quiz_sessions': True
+        }]),
         headers=json_headers
     )
 
-    if extensions_response.status_code == 200:
-        msg = 'Successfully added {} minutes to quiz #{}'
-        return {
-            'success': True,
-            'message': msg.format(added_time, quiz_id),
-            'added_time': added_time
-        }
-    else:
-        msg = 'Error creating extension for quiz #{}. Canvas status code: {}'
+    failed = []
+    if response.status_code == 200:
+        try:
+            results = response.json()
+        except ValueError:
+            results = None
+        if isinstance(results, dict):
+            failed = results.get('failed') or []
+        else:
+            logger.warning('Unexpected accommodations response: {}'.format(response.text))
+
+    if response.status_code != 200 or failed:
+        msg = 'Error creating accommodation for user #{}. Canvas status code: {}'
         return {
             'success': False,
-            'message': msg.format(quiz_id, extensions_response.status_code),
+            'message': msg.format(user_id, response.status_code),
             'added_time': None
         }
 
+    msg = 'Successfully added {} minutes to New Quizzes for user #{}'
+    return {
+        'success': True,
+        'message': msg.format(added_time, user_id),
+        'added_time': added_time
+    }
 
-def get_quizzes(course_id, per_page=config.MAX_PER_PAGE):
+
+def accommodate_students(course_id, percent, user_ids, force=False, new_quizzes=None):
     """
-    Get all quizzes in a Canvas course.
+    Give students `percent` time on every New Quiz in a course, with one
+    call per student however many quizzes there are. Students already
+    given the same extra time are left out unless `force` is set, so
+    running this again only updates students when the extra time has
+    changed, e.g. because a longer quiz was added.
 
-    :param course_id: The Canvas ID of a Course
+    :param course_id: The Canvas ID of the Course.
     :type course_id: int
-    :param per_page: The number of quizzes to get per page.
-    :type per_page: int
-    :rtype: list
-    :returns: A list of dictionaries representing Canvas Quiz objects.
+    :param percent: The percent of the time limit to give.
+    :type percent: int
+    :param user_ids: Canvas user IDs.
+    :type user_ids: list
+    :param force: Post every accommodation, even if it was already given.
+    :type force: bool
+    :param new_quizzes: The course's New Quizzes, if already fetched.
+    :type new_quizzes: list
+    :rtype: dict
+    :returns: A dictionary with the minutes added (None if no New Quiz
+        has a time limit) and lists of the users that were given them,
+        already had them and couldn't be updated.
     """
-    quizzes = []
-    quizzes_url = "{}courses/{}/quizzes?per_page={}".format(
-        config.API_URL,
-        course_id,
-        per_page
-    )
+    if new_quizzes is None:
+        new_quizzes = get_new_quizzes(course_id)
 
-    while True:
-        quizzes_response = requests.get(quizzes_url, headers=headers)
+    result = {
+        'added_time': accommodation_time(new_quizzes, percent),
+        'accommodated': [],
+        'unchanged': [],
+        'failed': []
+    }
+    if result['added_time'] is None:
+        return result
 
-        quizzes_list = quizzes_response.json()
+    key = ACCOMMODATION_KEY.format(course_id)
+    applied = {}
+    if not force and user_ids:
+        try:
+            # Keyed by int, so '011' and 11 are the same student.
+            applied = dict(zip(user_ids, conn.hmget(key, [int(user_id) for user_id in user_ids])))
+        except RedisError:
+            logger.debug('Unable to check applied accommodations.', exc_info=True)
 
-        if 'errors' in quizzes_list:
-            break
+    for user_id in user_ids:
+        previous = applied.get(user_id)
+        if previous is not None and int(previous) == result['added_time']:
+            result['unchanged'].append(user_id)
+            continue
 
-        quizzes.extend(quizzes_list)
+        response = set_accommodation(course_id, user_id, result['added_time'])
+        if not response['success']:
+            logger.error(response['message'])
+            result['failed'].append(user_id)
+            continue
 
+        result['accommodated'].append(user_id)
         try:
-            quizzes_url = quizzes_response.links['next']['url']
-        except KeyError:
-            break
+            conn.hset(key, int(user_id), result['added_time'])
+        except RedisError:
+            logger.debug('Unable to record accommodation.', exc_info=True)
 
-    return quizzes
+    return result
 
 
-def search_students(course_id, per_page=config.DEFAULT_PER_PAGE, page=1, search_term=""):
+def import_format(filename, fmt=None):
     """
-    Search for students in the course.
+    :param filename: The name of an accommodations file.
+    :type filename: str
+    :param fmt: The format asked for, if any.
+    :type fmt: str
+    :rtype: str
+    :returns: 'csv' or 'jsonl', or None if the format isn't supported.
+    """
+    fmt = (fmt or (filename or '').rsplit('.', 1)[-1]).lower()
+    if fmt in ('jsonl', 'ndjson', 'json'):
+        return 'jsonl'
+    if fmt == 'csv':
+        return fmt
+    return None
 
-    If no search term is provided, all users are returned.
 
-    :param course_id: The Canvas ID of a Course.
-    :type course_id: int
-    :param per_page: The number of students to get
-    :type per_page: int
-    :param page: The page number to get
-    :type page: int
-    :param search_term: A string to filter students by
-    :type search_term: str
+def import_row(row):
     """
-    url_str = "{}courses/{}/search_users?per_page={}&page={}&access_token={}"
-    users_url = url_str.format(
-        config.API_URL,
-        course_id,
-        per_page,
-        page,
-        config.API_KEY
-    )
+    Check one row of an accommodations file.
 
-    users_response = requests.get(
-        users_url,
-        data={
-            'search_term': search_term,
-            'enrollment_type': 'student',
-            'enrollment_state': ['active']
-        },
-        headers=headers,
+    :param row: The row, with `sis_user_id` (or `sis_id`), `course_id`
+        and `percent`.
+    :type row: dict
+    :rtype: tuple
+    :returns: The SIS user ID, Canvas course ID and percent.
+    :raises ValueError: If the row is missing a field or has a bad one.
+    """
+    if not isinstance(row, dict):
+        raise ValueError('Row is not an object.')
+    row = dict(
+        (key.strip().lower(), value.strip() if hasattr(value, 'strip') else value)
+        for key, value in row.items() if key
     )
 
-    try:
-        user_list = users_response.json()
-    except ValueError:
-        # response is weird. log it!
-        logger.exception('Error getting user list from Canvas.')
-        return [], 0
-
-    if 'errors' in user_list:
-        msg = 'Error getting user list from Canvas. Response: {}'
-        logger.error(msg.format(users_response))
-        return [], 0
+    sis_user_id = row.get('sis_user_id') or row.get('sis_id')
+    if not sis_user_id:
+        raise ValueError('`sis_user_id` field required.')
 
     try:
-        num_pages = int(
-            parse_qs(
-                urlsplit(
-                    users_response.links['last']['url']
-                ).query
-            )['page'][0]
-        )
-    except KeyError:
-        num_pages = 0
+        course_id = int(row.get('course_id'))
+    except (TypeError, ValueError):
+        raise ValueError('`course_id` must be a Canvas course ID.')
 
-    return user_list, num_pages
-
-
-def get_user(course_id, user_id):
-    """
-    Get a user from canvas by id, with respect to a course.
-
-    :param user_id: ID of a Canvas course.
-    :type user_id: int
-    :param user_id: ID of a Canvas user.
-    :type user_id: int
-    :rtype: dict
-    :returns: A dictionary representation of a User in Canvas.
-    """
-    response = requests.get(
-        '{}courses/{}/users/{}'.format(
-            config.API_URL,
-            course_id,
-            user_id
-        ),
-        params={'include[]': 'enrollments'},
-        headers=headers
-    )
-    response.raise_for_status()
+    try:
+        percent = int(row.get('percent'))
+    except (TypeError, ValueError):
+        percent = None
+    if percent is None or percent < 100:
+        raise ValueError('`percent` must be a whole number of at least 100.')
 
-    return response.json()
+    return '{}'.format(sis_user_id), course_id, percent
 
 
-def get_course(course_id):
+def iter_import_rows(lines, fmt):
     """
-    Get a course from canvas by id.
+    Read an accommodations file one row at a time, so a large file
+    never has to be held in memory.
 
-    :param course_id: ID of a Canvas course.
-    :type course_id: int
-    :rtype: dict
-    :returns: A dictionary representation of a Course in Canvas.
+    :param lines: The file, or any iterable of its lines as UTF-8
+        bytes.
+    :type lines: iterable
+    :param fmt: 'csv', with a header row, or 'jsonl', with one JSON
+        object per line.
+    :type fmt: str
+    :rtype: generator
+    :returns: A (line number, row, error) tuple for each row. `row` is
+        as returned by `import_row`, or None if `error` says what is
+        wrong with it.
     """
-    course_url = "{}courses/{}".format(config.API_URL, course_id)
-    response = requests.get(course_url, headers=headers)
-    response.raise_for_status()
+    if fmt == 'csv':
+        # Spreadsheets often save CSV with a byte order mark.
+        reader = csv.DictReader(
+            line[len(codecs.BOM_UTF8):] if line.startswith(codecs.BOM_UTF8) else line
+            for line in lines
+        )
+        rows = (
+            (reader.line_num, dict(
+                (key.decode('utf-8'), value.decode('utf-8') if value else value)
+                for key, value in row.items() if key
+            ))
+            for row in reader
+        )
+    else:
+        rows = (
+            (line_number, line)
+            for line_number, line in enumerate(lines, 1) if line.strip()
+        )
 
-    return response.json()
+    for line_number, row in rows:
+        try:
+            if fmt != 'csv':
+                try:
+                    row = json.loads(row.decode('utf-8-sig'))
+                except ValueError:
+                    raise ValueError('Line is not valid JSON.')
+            yield line_number, import_row(row), None
+        except ValueError as error:
+            yield line_number, None, '{}'.format(error)
 
 
 def get_or_create(session, model, **kwargs):
@@ -244,7 +2555,7 @@ def get_or_create(session, model, **kwargs):
         return instance, True
 
 
-def missing_quizzes(course_id, quickcheck=False):
+def missing_quizzes(course_id, quickcheck=False, changed=False, filtered=False):
     """
     Find all quizzes that are in Canvas but not in the database.
 
@@ -253,21 +2564,40 @@ def missing_quizzes(course_id, quickcheck=False):
     :param quickcheck: Setting this to `True` will return when the
         first missinq quiz is found.
     :type quickcheck: bool
+    :param changed: Setting this to `True` also finds quizzes that have
+        changed in Canvas since they were recorded, so their extensions
+        can be posted again. Quizzes recorded without a `content_hash`
+        are only found if their time limit changed.
+    :type changed: bool
+    :param filtered: Setting this to `True` leaves out quizzes the quiz
+        filters skip.
+    :type filtered: bool
     :rtype: list
     :returns: A list of dictionaries representing missing quizzes. If
         quickcheck is true, only the first result is returned.
     """
     quizzes = get_quizzes(course_id)
 
+    recorded = {}
+    canvas_ids = [canvas_quiz.get('id') for canvas_quiz in quizzes]
+    if canvas_ids:
+        recorded = {
+            quiz.canvas_id: quiz
+            for quiz in Quiz.query.filter(Quiz.canvas_id.in_(canvas_ids))
+        }
+
     missing_list = []
 
     for canvas_quiz in quizzes:
-        quiz = Quiz.query.filter_by(canvas_id=canvas_quiz.get('id')).first()
+        quiz = recorded.get(canvas_quiz.get('id'))
 
-        if quiz:
+        if quiz and not (changed and quiz_changed(quiz, canvas_quiz)):
             # Already exists. Next!
             continue
 
+        if filtered and skip_reason(canvas_quiz):
+            continue
+
         missing_list.append(canvas_quiz)
 
         if quickcheck:
@@ -277,10 +2607,448 @@ def missing_quizzes(course_id, quickcheck=False):
     return missing_list
 
 
-def update_job(job, percent, status_msg, status, error=False):
+def quiz_changed(quiz, canvas_quiz):
+    """
+    :param quiz: A quiz recorded in the database.
+    :type quiz: :class:`models.Quiz`
+    :param canvas_quiz: The same quiz from Canvas.
+    :type canvas_quiz: :class:`QuizRecord` or dict
+    :rtype: bool
+    :returns: Whether the quiz has changed since it was recorded.
+    """
+    if quiz.content_hash is None:
+        return quiz.time_limit != canvas_quiz.get('time_limit')
+    return quiz.content_hash != quiz_hash(canvas_quiz)
+
+
+def quiz_hash(quiz):
+    """
+    :param quiz: A quiz from Canvas.
+    :type quiz: :class:`QuizRecord` or dict
+    :rtype: str
+    :returns: A hash of the quiz's fields, which changes whenever one
+        of them is changed in Canvas.
+    """
+    fields = {name: quiz.get(name) for name in QuizRecord.__slots__}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def catalog_fingerprint(quizzes):
+    """
+    :param quizzes: Every quiz in a course, from `get_quizzes`.
+    :type quizzes: list
+    :rtype: str
+    :returns: A hash of the course's quizzes, which changes whenever a
+        quiz is added, removed or changed in Canvas.
+    """
+    hashes = sorted(quiz_hash(quiz) for quiz in quizzes)
+    return hashlib.sha1(''.join(hashes).encode('utf-8')).hexdigest()
+
+
+def update_job(job, percent, status_msg, status, error=False, retryable=False):
+    """
+    Save a job's progress in its meta.
+
+    :param retryable: Whether a failed job failed because of Canvas,
+        e.g. an HTTP error or the deadline running out, so it is worth
+        resuming.
+    :type retryable: bool
+    """
     job.meta['percent'] = percent
     job.meta['status'] = status
     job.meta['status_msg'] = status_msg
     job.meta['error'] = error
+    job.meta['retryable'] = retryable
+
+    job.save()
+
+
+def get_checkpoint(job):
+    """
+    Get the steps an earlier attempt at a job already finished.
+
+    :param job: The job being run.
+    :type job: :class:`rq.job.Job`
+    :rtype: dict
+    :returns: A dictionary mapping step names to the results saved with
+        `save_checkpoint`.
+    """
+    saved = job.connection.hgetall(CHECKPOINT_KEY.format(job.id))
+    return {step: json.loads(result) for step, result in saved.items()}
+
+
+def save_checkpoint(job, step, result):
+    """
+    Record that a job has finished a step, so it is not repeated if the
+    job has to be resumed.
+
+    :param job: The job being run.
+    :type job: :class:`rq.job.Job`
+    :param step: A name for the step that is unique within the job.
+    :type step: str
+    :param result: A JSON-serializable result for the step.
+    :type result: dict
+    """
+    key = CHECKPOINT_KEY.format(job.id)
+    pipe = job.connection.pipeline()
+    pipe.hset(key, step, json.dumps(result))
+    pipe.expire(key, config.CHECKPOINT_TTL)
+    pipe.execute()
+
+
+def clear_checkpoint(job):
+    """
+    Remove a job's checkpoint once it has completed.
+
+    :param job: The job being run.
+    :type job: :class:`rq.job.Job`
+    """
+    job.connection.delete(CHECKPOINT_KEY.format(job.id))
+
+
+def fair_key(course_id, user_id=None):
+    """
+    Build the key used to share the job queue fairly.
+
+    :param course_id: The Canvas ID of the Course the job is for.
+    :type course_id: int
+    :param user_id: The Canvas ID of the user who requested the job.
+    :type user_id: int
+    :rtype: str
+    :returns: A key identifying the course or the instructor, depending
+        on `config.FAIR_SCHEDULING_KEY`.
+    """
+    if config.FAIR_SCHEDULING_KEY == 'instructor' and user_id:
+        return 'instructor:{}'.format(user_id)
+    return 'course:{}'.format(course_id)
+
+
+def enqueue_fair(queue, key, calls, delay=0):
+    """
+    Enqueue a chain of jobs without letting one course hog the queue.
+
+    Each chain holds one of `config.FAIR_MAX_ACTIVE_JOBS` slots for
+    `key` from the moment it is put on the queue until its last job
+    finishes. Chains beyond that wait in a per-key list and are moved
+    onto the queue as slots free up, so jobs for other courses are
+    interleaved with those of a course that submits a lot of work.
+
+    A delayed chain doesn't wait in the list, or hold a worker, until
+    `release_delayed_jobs` finds it due.
+
+    :param queue: The queue to run the jobs on.
+    :type queue: :class:`rq.Queue`
+    :param key: The fairness key, as returned by `fair_key`.
+    :type key: str
+    :param calls: A list of `(func, args)` tuples. Each job starts
+        after the one before it has finished.
+    :type calls: list
+    :param delay: Seconds to wait before the chain can start.
+    :type delay: float
+    :rtype: list
+    :returns: The created jobs, in the same order as `calls`.
+    """
+    jobs = []
+    for func, args in calls:
+        meta = {'fair_key': key}
+        if not jobs:
+            meta.update({
+                'percent': 0,
+                'status': 'queued',
+                'status_msg': 'Waiting for other jobs in this course to finish.',
+                'error': False
+            })
+        else:
+            meta['fair_unit'] = jobs[0].id
+
+        job = Job.create(
+            func,
+            args=args,
+            connection=queue.connection,
+            status=JobStatus.DEFERRED,
+            depends_on=jobs[-1] if jobs else None,
+            origin=queue.name,
+            timeout=config.JOB_DEADLINE + JOB_TIMEOUT_GRACE,
+            meta=meta
+        )
+        jobs.append(job)
+
+    head, tail = jobs[0], jobs[-1]
+    head.meta['fair_unit'] = head.id
+    head.meta['fair_chain_length'] = len(jobs)
+    tail.meta['fair_release'] = True
+
+    for job in jobs:
+        job.save()
+        if job is not head:
+            job.register_dependency()
+
+    if delay > 0:
+        queue.connection.zadd(FAIR_DELAYED_KEY, **{head.id: time() + delay})
+    else:
+        queue.connection.rpush(FAIR_PENDING_KEY.format(key), head.id)
+        fill_fair_slots(queue, key)
+
+    return jobs
+
+
+def release_delayed_jobs(connection):
+    """
+    Let delayed job chains that are now due wait for a slot like any
+    other. Called by the refresh scheduler, and whenever a chain ends.
+
+    :param connection: The Redis connection the jobs are kept in.
+    :type connection: :class:`redis.StrictRedis`
+    :rtype: list
+    :returns: The IDs of the first jobs of the chains released.
+    """
+    released = []
+    for job_id in connection.zrangebyscore(FAIR_DELAYED_KEY, '-inf', time()):
+        # Only one process gets to release each chain.
+        if not connection.zrem(FAIR_DELAYED_KEY, job_id):
+            continue
+
+        try:
+            job = Job.fetch(job_id, connection=connection)
+        except NoSuchJobError:
+            continue
+
+        key = job.meta['fair_key']
+        connection.rpush(FAIR_PENDING_KEY.format(key), job.id)
+        fill_fair_slots(Queue(job.origin, connection=connection), key)
+        released.append(job.id)
+
+    return released
+
+
+class FairWorker(Worker):
+    """
+    RQ worker that also starts delayed job chains once they are due
+    (see `release_delayed_jobs`), so retries don't depend on the refresh
+    scheduler running. While idle, it checks every
+    `config.FAIR_DELAYED_POLL` seconds.
+
+    Run it with `rq worker -w utils.FairWorker quizext`.
+    """
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        if timeout is not None:
+            timeout = min(timeout, config.FAIR_DELAYED_POLL)
+
+        qnames = ','.join(self.queue_names())
+        self.set_state(WorkerStatus.IDLE)
+        self.procline('Listening on ' + qnames)
+
+        while True:
+            self.heartbeat()
+            release_delayed_jobs(self.connection)
+
+            try:
+                result = self.queue_class.dequeue_any(
+                    self.queues,
+                    timeout,
+                    connection=self.connection,
+                    job_class=self.job_class
+                )
+                break
+            except DequeueTimeout:
+                pass
+
+        self.heartbeat()
+        return result
+
+
+def requeue_fair(job):
+    """
+    Put a job created by `enqueue_fair` back through the fair scheduler,
+    so a resumed job waits for a slot like any new chain. The jobs of
+    its chain that never ran, because it failed, go with it.
+
+    :param job: A job that isn't on any queue, e.g. one taken off the
+        failed queue.
+    :type job: :class:`rq.job.Job`
+    """
+    connection = job.connection
+    key = job.meta['fair_key']
+
+    rest = []
+    dependents_key = job.dependents_key
+    while True:
+        dependent_ids = connection.smembers(dependents_key)
+        if not dependent_ids:
+            break
+        dependent = Job.fetch(next(iter(dependent_ids)), connection=connection)
+        if dependent.get_status() != JobStatus.DEFERRED:
+            break
+        rest.append(dependent)
+        dependents_key = dependent.dependents_key
+
+    for dependent in rest:
+        dependent.meta['fair_unit'] = job.id
+        dependent.save_meta()
 
+    job.meta.update({
+        'fair_unit': job.id,
+        'fair_chain_length': 1 + len(rest),
+        'fair_release': not rest
+    })
+    job.set_status(JobStatus.DEFERRED)
     job.save()
+
+    # The job isn't running, so any slot it held is no longer in use.
+    connection.hdel(FAIR_ACTIVE_KEY.format(key), job.id)
+    connection.rpush(FAIR_PENDING_KEY.format(key), job.id)
+    fill_fair_slots(Queue(job.origin, connection=connection), key)
+
+
+def fill_fair_slots(queue, key):
+    """
+    Move waiting job chains for `key` onto the queue while slots are free.
+
+    Abandoned slots (see `slot_abandoned`) are reclaimed first.
+
+    :param queue: The queue to run the jobs on.
+    :type queue: :class:`rq.Queue`
+    :param key: The fairness key, as returned by `fair_key`.
+    :type key: str
+    """
+    connection = queue.connection
+    active_key = FAIR_ACTIVE_KEY.format(key)
+    pending_key = FAIR_PENDING_KEY.format(key)
+
+    now = time()
+    for unit_id, expires in connection.hgetall(active_key).items():
+        if slot_abandoned(connection, unit_id, float(expires), now):
+            logger.warning('Reclaiming abandoned job slot {} for {}'.format(unit_id, key))
+            connection.hdel(active_key, unit_id)
+
+    def claim_slot(pipe):
+        if pipe.hlen(active_key) >= config.FAIR_MAX_ACTIVE_JOBS:
+            return None
+        job_id = pipe.lindex(pending_key, 0)
+        if job_id is None:
+            return None
+
+        pipe.multi()
+        pipe.lpop(pending_key)
+        # No time limit until the chain starts. See `start_fair_slot`.
+        pipe.hset(active_key, job_id, 0)
+        return job_id
+
+    while True:
+        job_id = connection.transaction(
+            claim_slot,
+            active_key,
+            pending_key,
+            value_from_callable=True
+        )
+        if job_id is None:
+            break
+
+        queue.enqueue_job(Job.fetch(job_id, connection=connection))
+
+
+def slot_abandoned(connection, unit_id, expires, now):
+    """
+    :param connection: The Redis connection the jobs are kept in.
+    :type connection: :class:`redis.StrictRedis`
+    :param unit_id: The ID of the first job of the chain holding a slot.
+    :type unit_id: str
+    :param expires: When the slot runs out, or 0 if the chain hasn't
+        started yet.
+    :type expires: float
+    :param now: The current time.
+    :type now: float
+    :rtype: bool
+    :returns: True if the chain has run for longer than its jobs are
+        allowed, so its worker must have died, or hasn't started but
+        never will.
+    """
+    if expires:
+        return now > expires
+
+    try:
+        status = Job.fetch(unit_id, connection=connection).get_status()
+    except NoSuchJobError:
+        return True
+    return status in (JobStatus.FINISHED, JobStatus.FAILED)
+
+
+def start_fair_slot(job):
+    """
+    Limit the slot held by a job's chain to as long as its jobs can
+    run, from now. Each job is allowed `config.JOB_DEADLINE` seconds,
+    and `JOB_TIMEOUT_GRACE` more before RQ stops it.
+
+    :param job: The first job of a chain created by `enqueue_fair`.
+    :type job: :class:`rq.job.Job`
+    """
+    active_key = FAIR_ACTIVE_KEY.format(job.meta['fair_key'])
+    expires = time() + job.meta.get('fair_chain_length', 1) * (
+        config.JOB_DEADLINE + JOB_TIMEOUT_GRACE
+    )
+
+    def set_expiry(pipe):
+        # Unless the slot has already been reclaimed.
+        if pipe.hexists(active_key, job.id):
+            pipe.multi()
+            pipe.hset(active_key, job.id, expires)
+
+    job.connection.transaction(set_expiry, active_key)
+
+
+def reclaim_fair_slots(queue):
+    """
+    Reclaim abandoned slots for every key, and start the chains that
+    were waiting on them. Called by the refresh scheduler, so chains
+    don't wait on a dead worker until another job is queued.
+
+    :param queue: The queue to run the jobs on.
+    :type queue: :class:`rq.Queue`
+    """
+    prefix, suffix = FAIR_ACTIVE_KEY.split('{}')
+    for active_key in queue.connection.scan_iter(FAIR_ACTIVE_KEY.format('*')):
+        if isinstance(active_key, bytes):
+            active_key = active_key.decode('utf-8')
+        fill_fair_slots(queue, active_key[len(prefix):-len(suffix)])
+
+
+def fair_job(func):
+    """
+    Decorator for job functions enqueued with `enqueue_fair`.
+
+    Frees the chain's slot once its last job is done, or as soon as any
+    job in it raises, since the rest of the chain will never run.
+    """
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        job = get_current_job()
+        if job and job.meta.get('fair_key') and job.meta.get('fair_unit') == job.id:
+            start_fair_slot(job)
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            release_fair_slot(job)
+            raise
+
+        if job and job.meta.get('fair_release'):
+            release_fair_slot(job)
+        return result
+
+    return decorated_function
+
+
+def release_fair_slot(job):
+    """
+    Free the slot held by a job's chain and let the next chain in.
+
+    :param job: A job created by `enqueue_fair`. Other jobs are ignored.
+    :type job: :class:`rq.job.Job`
+    """
+    key = job.meta.get('fair_key') if job else None
+    if not key:
+        return
+
+    job.connection.hdel(FAIR_ACTIVE_KEY.format(key), job.meta['fair_unit'])
+    fill_fair_slots(Queue(job.origin, connection=job.connection), key)
+    release_delayed_jobs(job.connection)
@@ -7,29 +7,38 @@ from functools import wraps
 import logging
 from logging.config import dictConfig
 import json
+import random
 from subprocess import call
-from time import time
+from time import sleep, time
+from uuid import uuid4
 
+import click
 from flask import (
-    Flask, render_template, session, request, redirect, url_for, Response,
+    Flask, g, render_template, session, request, redirect, url_for, Response,
 )
 from flask_migrate import Migrate
 from ims_lti_py import ToolProvider
 import requests
-import redis
 from redis.exceptions import ConnectionError
-from rq import get_current_job, Queue
+from rq import get_current_job, get_failed_queue, Queue
 from rq.job import Job
 from rq.exceptions import NoSuchJobError
 
 import config
 from models import db, Course, Extension, Quiz, User
 from utils import (
-    extend_quiz, get_course, get_or_create, get_quizzes, get_user,
-    missing_quizzes, search_students, update_job
+    accommodate_students, canvas_metrics, canvas_request,
+    CanvasUnavailable, catalog_fingerprint, clear_checkpoint, conn,
+    deadline, DeadlineExceeded, enqueue_fair, execute_operations, fair_job,
+    fair_key, get_checkpoint, get_course, get_new_quizzes, get_or_create,
+    get_quizzes, get_roster, get_sections, get_user, import_format,
+    invalidate_cache, iter_import_rows, longest_time_limit,
+    missing_quizzes, parse_canvas_time, plan_extensions, quiz_hash,
+    reclaim_fair_slots, release_delayed_jobs, requeue_fair, reset_deadline,
+    save_checkpoint, search_students, set_deadline, to_timestamp,
+    update_job, uses_new_quizzes
 )
 
-conn = redis.from_url(config.REDIS_URL)
 q = Queue('quizext', connection=conn)
 
 app = Flask(__name__)
@@ -46,9 +55,42 @@ migrate = Migrate(app, db)
 
 oauth_creds = {config.LTI_KEY: config.LTI_SECRET}
 
-json_headers = {
-    'Authorization': 'Bearer ' + config.API_KEY,
-    'Content-type': 'application/json'
+json_headers = {'Content-type': 'application/json'}
+
+BULK_KEY = 'quizext:bulk:{}'
+BULK_PENDING_KEY = 'quizext:bulk:{}:pending'
+BULK_ACTIVE_KEY = 'quizext:bulk:{}:active'
+BULK_FAILURES_KEY = 'quizext:bulk:{}:failures'
+BULK_DONE_KEY = 'quizext:bulk:{}:done'
+SWEEP_SCHEDULE_KEY = 'quizext:sweep:schedule'
+SWEEP_FINGERPRINT_KEY = 'quizext:sweep:fingerprints'
+SWEEP_UNLOCKS_KEY = 'quizext:sweep:unlocks'
+IMPORT_LINES_KEY = 'quizext:import:{}:lines'
+# The courses an import has saved students for, and the Canvas IDs of
+# the students saved for each course.
+IMPORT_COURSES_KEY = 'quizext:import:{}:courses'
+IMPORT_STUDENTS_KEY = 'quizext:import:{}:course:{}'
+# Imports are queued one at a time, like the jobs of a single course.
+IMPORT_FAIR_KEY = 'import'
+# Errors that failed jobs can be resumed after: Canvas being unavailable,
+# slow or sending an HTTP error, and the worker cutting the job short.
+RETRYABLE_ERRORS = (
+    'CanvasUnavailable',
+    'DeadlineExceeded',
+    'HTTPError',
+    'ConnectionError',
+    'Timeout',
+    'JobTimeoutException',
+    'Work-horse process was terminated unexpectedly'
+)
+# Jobs that are for a single course, and which of their arguments is
+# the course's Canvas ID.
+COURSE_JOBS = {
+    'update_background': 0,
+    'refresh_background': 0,
+    'retry_background': 0,
+    'sweep_background': 0,
+    'bulk_refresh_background': 1
 }
 
 
@@ -75,42 +117,126 @@ def check_valid_user(f):
             )
         course_id = int(kwargs.get('course_id'))
 
-        if not session.get('is_admin', False):
-            enrollments_url = "{}courses/{}/enrollments".format(
-                config.API_URL,
-                course_id
+        if not session.get('is_admin', False) and not is_course_staff(canvas_user_id, course_id):
+            message = (
+                'You are not enrolled in this course as a Teacher, '
+                'TA, or Designer.'
+            )
+            return render_template(
+                'error.html',
+                message=message
             )
 
-            payload = {
-                'user_id': canvas_user_id,
-                'type': [
-                    'TeacherEnrollment',
-                    'TaEnrollment',
-                    'DesignerEnrollment'
-                ]
-            }
+        return f(*args, **kwargs)
+    return decorated_function
 
-            user_enrollments_response = requests.get(
-                enrollments_url,
-                data=json.dumps(payload),
-                headers=json_headers
-            )
-            user_enrollments = user_enrollments_response.json()
 
-            if not user_enrollments or 'errors' in user_enrollments:
-                message = (
-                    'You are not enrolled in this course as a Teacher, '
-                    'TA, or Designer.'
-                )
-                return render_template(
-                    'error.html',
-                    message=message
-                )
+def is_course_staff(canvas_user_id, course_id):
+    """
+    Check whether a user teaches, assists with or designs a course.
+
+    :param canvas_user_id: The Canvas ID of the user.
+    :type canvas_user_id: int
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :rtype: bool
+    """
+    enrollments_url = "{}courses/{}/enrollments".format(
+        config.API_URL,
+        course_id
+    )
+
+    payload = {
+        'user_id': canvas_user_id,
+        'type': [
+            'TeacherEnrollment',
+            'TaEnrollment',
+            'DesignerEnrollment'
+        ]
+    }
+
+    user_enrollments_response = canvas_request(
+        'GET',
+        enrollments_url,
+        data=json.dumps(payload),
+        headers=json_headers
+    )
+    user_enrollments = user_enrollments_response.json()
+
+    return bool(user_enrollments) and 'errors' not in user_enrollments
+
+
+def check_admin(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        """
+        Decorator to only allow Canvas administrators access.
+
+        If the user is an administrator, return the decorated function.
+        Otherwise, return an error page with corresponding message.
+        """
+        if not session.get('lti_logged_in', False) or not session.get('is_admin', False):
+            return render_template(
+                'error.html',
+                message='Not allowed!'
+            ), 403
 
         return f(*args, **kwargs)
     return decorated_function
 
 
+def canvas_job(f):
+    """
+    Decorator for background jobs that talk to Canvas.
+
+    Limits the job to `config.JOB_DEADLINE` seconds of Canvas requests,
+    and fails the job with a clear message, instead of an error, if
+    Canvas is unavailable or the deadline runs out. Progress is
+    checkpointed, so the job can be resumed later.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        try:
+            with deadline(config.JOB_DEADLINE):
+                return f(*args, **kwargs)
+        except CanvasUnavailable as e:
+            job = get_current_job()
+            update_job(
+                job,
+                job.meta.get('percent', 0),
+                '{}'.format(e),
+                'failed',
+                error=True,
+                retryable=True
+            )
+            logger.warning('Job {} stopped: {}'.format(job.get_id(), e))
+            return job.meta
+    return decorated_function
+
+
+@app.before_request
+def start_request_deadline():
+    g.previous_deadline = set_deadline(config.REQUEST_DEADLINE)
+
+
+@app.teardown_request
+def end_request_deadline(exception=None):
+    reset_deadline(g.get('previous_deadline'))
+
+
+@app.errorhandler(CanvasUnavailable)
+def canvas_unavailable(error):
+    """
+    Tell the user Canvas is unavailable rather than waiting on it.
+
+    Requests made by the page's scripts get just the message, so it can
+    be shown in place of the content that couldn't be loaded.
+    """
+    if request.is_xhr:
+        return Response('{}'.format(error), status=503, mimetype='text/plain')
+    return render_template('error.html', message='{}'.format(error)), 503
+
+
 @app.context_processor
 def add_google_analytics_id():
     return dict(GOOGLE_ANALYTICS=config.GOOGLE_ANALYTICS)
@@ -147,14 +273,14 @@ def status():  # pragma: no cover
 
     # Check index
     try:
-        response = requests.get(url_for('index', _external=True), verify=False)
+        response = requests.get(url_for('index', _external=True), verify=False, timeout=5)
         status['checks']['index'] = response.text == 'Please contact your System Administrator.'
     except Exception as e:
         logger.exception('Index check failed.')
 
     # Check xml
     try:
-        response = requests.get(url_for('xml', _external=True), verify=False)
+        response = requests.get(url_for('xml', _external=True), verify=False, timeout=5)
         status['checks']['xml'] = 'application/xml' in response.headers.get('Content-Type')
     except Exception as e:
         logger.exception('XML check failed.')
@@ -163,7 +289,8 @@ def status():  # pragma: no cover
     try:
         response = requests.get(
             '{}users/self'.format(config.API_URL),
-            headers={'Authorization': 'Bearer ' + config.API_KEY}
+            headers={'Authorization': 'Bearer ' + config.API_KEY},
+            timeout=(config.CANVAS_CONNECT_TIMEOUT, config.CANVAS_READ_TIMEOUT)
         )
         status['checks']['api_key'] = response.status_code == 200
     except Exception as e:
@@ -198,6 +325,17 @@ def status():  # pragma: no cover
     )
 
 
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """
+    Reports metrics about this process's use of the Canvas API.
+    """
+    return Response(
+        json.dumps({'canvas': canvas_metrics()}),
+        mimetype='application/json'
+    )
+
+
 @app.route("/lti.xml", methods=['GET'])
 def xml():
     """
@@ -225,25 +363,36 @@ def quiz(course_id=None):
     Displays a page to the user that allows them to select students
     to moderate quizzes for.
     """
+    try:
+        sections = get_sections(course_id)
+    except requests.exceptions.HTTPError:
+        logger.exception('Unable to get sections for course #{}'.format(course_id))
+        sections = []
+
     return render_template(
         'userselect.html',
         course_id=course_id,
-        current_page_number=1
+        current_page_number=1,
+        sections=sections
     )
 
 
 @app.route('/refresh/<course_id>/', methods=['POST'])
 def refresh(course_id=None):
     """
-    Creates a new `refresh_background` job.
+    Creates a new `refresh_background` job. Set the `force` parameter
+    to post extensions the ledger shows are already applied.
 
     :param course_id: The Canvas ID of the Course.
     :type course_id: int
     :rtype: flask.Response
     :returns: A JSON-formatted response containing a url for the started job.
     """
-    job = q.enqueue_call(
-        func=refresh_background, args=(course_id,)
+    force = request.values.get('force', '').lower() in ('1', 'true')
+    job, = enqueue_fair(
+        q,
+        fair_key(course_id, session.get('canvas_user_id')),
+        [(refresh_background, (course_id, force))]
     )
     return Response(
         json.dumps({
@@ -254,6 +403,169 @@ def refresh(course_id=None):
     )
 
 
+def extension_groups(extension_dict):
+    """
+    :param extension_dict: The JSON posted to `update` or `plan_update`.
+    :type extension_dict: dict
+    :rtype: list
+    :returns: A list of (percent, user IDs) pairs, one for each group of
+        students. A request with a single `percent` and `user_ids` is
+        one group. Groups that select a section or every student have
+        no user IDs until `resolve_selection` fills them in.
+    """
+    groups = extension_dict.get('groups')
+    if groups is None:
+        groups = [extension_dict]
+    return [(group.get('percent'), group.get('user_ids', [])) for group in groups]
+
+
+def selection_rank(group):
+    """
+    :param group: A group from the JSON posted to `update`.
+    :type group: dict
+    :rtype: int
+    :returns: 0 for a group that lists its students, 1 for a section
+        and 2 for every student, so the most specific group can claim
+        a student first.
+    """
+    if group.get('section_id') is not None:
+        return 1
+    if group.get('all_students'):
+        return 2
+    return 0
+
+
+def sections_error(course_id, extension_dict):
+    """
+    Check that the sections groups select are in the course, since
+    their rosters are fetched with the tool's own token.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param extension_dict: The JSON posted to `update` or `plan_update`.
+    :type extension_dict: dict
+    :rtype: str
+    :returns: What is wrong with the sections, or None if nothing is.
+    :raises requests.exceptions.HTTPError: If Canvas could not return
+        the course's sections.
+    """
+    groups = extension_dict.get('groups')
+    if groups is None:
+        groups = [extension_dict]
+    section_ids = set(
+        str(group['section_id']) for group in groups if group.get('section_id') is not None
+    )
+    if not section_ids:
+        return None
+
+    course_section_ids = set(str(section['id']) for section in get_sections(course_id))
+    if not section_ids <= course_section_ids:
+        return 'Section not found in this course.'
+    return None
+
+
+def resolve_selection(course_id, extension_dict):
+    """
+    Fill in the students of groups that give a `section_id`, or
+    `'all_students': True`, instead of a list of `user_ids`.
+
+    A student in more than one group gets the percent of the most
+    specific one: a group that lists them, then a section, then every
+    student. This way a whole course can be given time and a half
+    while a few students are given double time in the same request.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param extension_dict: The JSON posted to `update`.
+    :type extension_dict: dict
+    :rtype: tuple
+    :returns: The JSON with every group's `user_ids` filled in, and a
+        dictionary of the Canvas users on the rosters fetched, by ID.
+    :raises requests.exceptions.HTTPError: If Canvas could not return a
+        roster.
+    """
+    groups = extension_dict.get('groups')
+    if groups is None:
+        groups = [extension_dict]
+    if not any(selection_rank(group) for group in groups):
+        return extension_dict, {}
+
+    groups = [dict(group) for group in groups]
+    claimed = set(
+        str(user_id)
+        for group in groups if not selection_rank(group)
+        for user_id in group.get('user_ids', [])
+    )
+    roster_users = {}
+    for group in sorted(groups, key=selection_rank):
+        if not selection_rank(group):
+            continue
+
+        roster = get_roster(course_id, section_id=group.get('section_id'))
+        group['user_ids'] = []
+        for user in roster:
+            user_id = str(user['id'])
+            roster_users[user_id] = user
+            if user_id not in claimed:
+                claimed.add(user_id)
+                group['user_ids'].append(user_id)
+
+    return dict(extension_dict, groups=groups), roster_users
+
+
+def update_lookups(course_id, extension_dict, roster_users, num_quizzes):
+    """
+    Count the requests `update_background` makes before it posts any
+    extensions: the course, a page of each roster a group selects for
+    every `config.MAX_PER_PAGE` students, each student not on those
+    rosters, and the pages of quizzes.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param extension_dict: The JSON from `resolve_selection`.
+    :type extension_dict: dict
+    :param roster_users: The Canvas users from `resolve_selection`.
+    :type roster_users: dict
+    :param num_quizzes: The number of quizzes in the course.
+    :type num_quizzes: int
+    :rtype: int
+    """
+    def pages(num_items):
+        return max(1, -(-num_items // config.MAX_PER_PAGE))
+
+    groups = extension_dict.get('groups')
+    if groups is None:
+        groups = [extension_dict]
+
+    lookups = 1 + pages(num_quizzes)
+    for group in groups:
+        if selection_rank(group):
+            # Already cached by `resolve_selection`.
+            roster = get_roster(course_id, section_id=group.get('section_id'))
+            lookups += pages(len(roster))
+    lookups += len(set(
+        str(user_id)
+        for percent, user_ids in extension_groups(extension_dict) for user_id in user_ids
+    ) - set(roster_users))
+    return lookups
+
+
+def groups_error(groups):
+    """
+    :param groups: The groups from `extension_groups`.
+    :type groups: list
+    :rtype: str
+    :returns: What is wrong with the groups, or None if nothing is.
+    """
+    if not groups or not all(percent for percent, user_ids in groups):
+        return '`percent` field required.'
+
+    user_ids = [str(user_id) for percent, group_user_ids in groups for user_id in group_user_ids]
+    if len(set(user_ids)) < len(user_ids):
+        return 'Each student can only be given one percent of time.'
+    return None
+
+
 @app.route("/update/<course_id>/", methods=['POST'])
 @check_valid_user
 def update(course_id=None):
@@ -265,13 +577,39 @@ def update(course_id=None):
     :rtype: flask.Response
     :returns: A JSON-formatted response containing urls for the started jobs.
     """
-    refresh_job = q.enqueue_call(
-        func=refresh_background, args=(course_id,)
-    )
-    update_job = q.enqueue_call(
-        func=update_background,
-        args=(course_id, request.get_json()),
-        depends_on=refresh_job
+    extension_dict = request.get_json()
+    error_message = groups_error(extension_groups(extension_dict or {}))
+    if error_message:
+        return Response(
+            json.dumps({'error': True, 'status_msg': error_message}),
+            mimetype='application/json',
+            status=400
+        )
+    try:
+        error_message = sections_error(course_id, extension_dict)
+    except requests.exceptions.HTTPError:
+        logger.exception('Unable to get sections for course #{}'.format(course_id))
+        return Response(
+            json.dumps({'error': True, 'status_msg': 'Unable to get sections from Canvas.'}),
+            mimetype='application/json',
+            status=502
+        )
+    if error_message:
+        return Response(
+            json.dumps({'error': True, 'status_msg': error_message}),
+            mimetype='application/json',
+            status=400
+        )
+    # Only imports, which have already saved the students, give `saved`.
+    extension_dict.pop('saved', None)
+
+    refresh_job, update_job = enqueue_fair(
+        q,
+        fair_key(course_id, session.get('canvas_user_id')),
+        [
+            (refresh_background, (course_id,)),
+            (update_background, (course_id, extension_dict))
+        ]
     )
     return Response(
         json.dumps({
@@ -283,6 +621,85 @@ def update(course_id=None):
     )
 
 
+@app.route("/plan/<course_id>/", methods=['POST'])
+@check_valid_user
+def plan_update(course_id=None):
+    """
+    Work out what an update would do, without posting anything.
+
+    Takes the same JSON as `update`.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :rtype: flask.Response
+    :returns: A JSON-formatted response with each extension that would
+        be posted, the number of Canvas API calls the update would take,
+        counting the lookups before posting (see `update_lookups`), and
+        an estimate of how many seconds they would take.
+    """
+    extension_dict = request.get_json() or {}
+    groups = extension_groups(extension_dict)
+    error_message = groups_error(groups)
+    if error_message:
+        return Response(
+            json.dumps({'error': True, 'status_msg': error_message}),
+            mimetype='application/json',
+            status=400
+        )
+    try:
+        error_message = sections_error(course_id, extension_dict)
+    except requests.exceptions.HTTPError:
+        logger.exception('Unable to get sections for course #{}'.format(course_id))
+        return Response(
+            json.dumps({'error': True, 'status_msg': 'Unable to get sections from Canvas.'}),
+            mimetype='application/json',
+            status=502
+        )
+    if error_message:
+        return Response(
+            json.dumps({'error': True, 'status_msg': error_message}),
+            mimetype='application/json',
+            status=400
+        )
+
+    try:
+        quizzes = get_quizzes(course_id)
+    except requests.exceptions.HTTPError:
+        logger.exception('Unable to get quizzes for course #{}'.format(course_id))
+        return Response(
+            json.dumps({'error': True, 'status_msg': 'Unable to get quizzes from Canvas.'}),
+            mimetype='application/json',
+            status=502
+        )
+
+    try:
+        extension_dict, roster_users = resolve_selection(course_id, extension_dict)
+    except requests.exceptions.HTTPError:
+        logger.exception('Unable to get the roster for course #{}'.format(course_id))
+        return Response(
+            json.dumps({'error': True, 'status_msg': 'Unable to get students from Canvas.'}),
+            mimetype='application/json',
+            status=502
+        )
+    groups = extension_groups(extension_dict)
+
+    percent_user_map = defaultdict(list)
+    for percent, user_ids in groups:
+        percent_user_map[percent].extend(user_ids)
+
+    extension_plan = plan_extensions(
+        course_id,
+        quizzes,
+        percent_user_map,
+        force=extension_dict.get('force', False),
+        lookups=update_lookups(course_id, extension_dict, roster_users, len(quizzes))
+    )
+    return Response(
+        json.dumps(extension_plan.as_dict()),
+        mimetype='application/json'
+    )
+
+
 @app.route('/jobs/<job_key>/', methods=['GET'])
 def job_status(job_key):
     try:
@@ -298,18 +715,26 @@ def job_status(job_key):
         )
 
     if job.is_finished:
+        result = job.result
+        if isinstance(result, dict) and result.get('status') == 'failed' and is_retryable(job):
+            result['resume_job_url'] = url_for('resume_job', job_key=job_key)
+        if isinstance(result, dict) and result.get('retry_job_key'):
+            result['retry_job_url'] = url_for('job_status', job_key=result['retry_job_key'])
         return Response(
-            json.dumps(job.result),
+            json.dumps(result),
             mimetype='application/json',
             status=200
         )
     elif job.is_failed:
         logger.error("Job {} failed.\n{}".format(job_key, job.exc_info))
+        result = {
+            'error': True,
+            'status_msg': 'Job {} failed to complete.'.format(job_key)
+        }
+        if is_retryable(job):
+            result['resume_job_url'] = url_for('resume_job', job_key=job_key)
         return Response(
-            json.dumps({
-                'error': True,
-                'status_msg': 'Job {} failed to complete.'.format(job_key)
-            }),
+            json.dumps(result),
             mimetype='application/json',
             status=500
         )
@@ -321,6 +746,912 @@ def job_status(job_key):
         )
 
 
+@app.route('/jobs/<job_key>/resume/', methods=['POST'])
+def resume_job(job_key):
+    """
+    Run a failed job again, starting from where it left off. Only
+    admins and staff of the job's course may resume it.
+
+    :param job_key: The ID of the job to resume.
+    :type job_key: str
+    :rtype: flask.Response
+    :returns: A JSON-formatted response containing the url of the job.
+    """
+    canvas_user_id = session.get('canvas_user_id')
+    if not session.get('lti_logged_in', False) or not canvas_user_id:
+        return Response(
+            json.dumps({'error': True, 'status_msg': 'Not allowed!'}),
+            mimetype='application/json',
+            status=403
+        )
+
+    try:
+        job = Job.fetch(job_key, connection=conn)
+    except NoSuchJobError:
+        return Response(
+            json.dumps({
+                'error': True,
+                'status_msg': '{} is not a valid job key.'.format(job_key)
+            }),
+            mimetype='application/json',
+            status=404
+        )
+
+    if not session.get('is_admin', False):
+        course_id = job_course_id(job)
+        if course_id is None or not is_course_staff(canvas_user_id, course_id):
+            return Response(
+                json.dumps({'error': True, 'status_msg': 'Not allowed!'}),
+                mimetype='application/json',
+                status=403
+            )
+
+    if job.meta.get('status') == 'failed' and not is_retryable(job):
+        return Response(
+            json.dumps({
+                'error': True,
+                'status_msg': 'Job {} can\'t be resumed.'.format(job_key)
+            }),
+            mimetype='application/json',
+            status=409
+        )
+
+    if not requeue_job(job):
+        return Response(
+            json.dumps({
+                'error': True,
+                'status_msg': 'Job {} has not failed.'.format(job_key)
+            }),
+            mimetype='application/json',
+            status=409
+        )
+
+    return Response(
+        json.dumps({'job_url': url_for('job_status', job_key=job_key)}),
+        mimetype='application/json',
+        status=202
+    )
+
+
+@app.cli.command('resume-jobs')
+def resume_jobs():
+    """
+    Resume every extension job that was cut short, e.g. by a worker
+    being restarted.
+    """
+    failed_queue = get_failed_queue(connection=conn)
+    for job in failed_queue.jobs:
+        if job.origin == q.name and requeue_job(job):
+            logger.info('Resumed job {}'.format(job.id))
+
+
+def job_course_id(job):
+    """
+    :param job: A background job.
+    :type job: :class:`rq.job.Job`
+    :rtype: int
+    :returns: The Canvas ID of the Course the job is for, or None if it
+        isn't for a single course, e.g. an import.
+    """
+    func_name = job.func_name.rsplit('.', 1)[-1]
+    if func_name in COURSE_JOBS:
+        return int(job.args[COURSE_JOBS[func_name]])
+    return None
+
+
+def is_retryable(job):
+    """
+    :param job: A failed background job.
+    :type job: :class:`rq.job.Job`
+    :rtype: bool
+    :returns: True if the job failed because of Canvas, or was cut
+        short by the worker, so resuming it may succeed. False if it
+        failed because of what it was asked to do, e.g. an invalid
+        request, or a bug.
+    """
+    if job.is_failed:
+        return any(error in (job.exc_info or '') for error in RETRYABLE_ERRORS)
+    return job.meta.get('retryable', False)
+
+
+def requeue_job(job):
+    """
+    Put a failed job back on the queue under the same ID, so it picks up
+    the checkpoint saved by its earlier attempt. Jobs created by
+    `enqueue_fair` wait for a slot again rather than jumping the queue.
+
+    :param job: The job to requeue.
+    :type job: :class:`rq.job.Job`
+    :rtype: bool
+    :returns: True if the job was requeued, False if it had not failed.
+    """
+    if job.is_failed:
+        update_job(job, job.meta.get('percent', 0), 'Resuming...', 'queued')
+        if job.meta.get('fair_key'):
+            get_failed_queue(connection=job.connection).remove(job)
+            job.exc_info = None
+            requeue_fair(job)
+        else:
+            get_failed_queue(connection=job.connection).requeue(job.id)
+    elif job.is_finished and job.meta.get('status') == 'failed':
+        update_job(job, job.meta.get('percent', 0), 'Resuming...', 'queued')
+        if job.meta.get('fair_key'):
+            requeue_fair(job)
+        else:
+            Queue(job.origin, connection=job.connection).enqueue_job(job)
+    else:
+        return False
+
+    return True
+
+
+@app.route('/bulk_refresh/', methods=['POST'])
+@check_admin
+def bulk_refresh():
+    """
+    Start refreshing every course that has active extensions.
+
+    :rtype: flask.Response
+    :returns: A JSON-formatted response containing the url of the run.
+    """
+    run_id = start_bulk_refresh()
+    return Response(
+        json.dumps({
+            'run_id': run_id,
+            'run_url': url_for('bulk_refresh_status', run_id=run_id)
+        }),
+        mimetype='application/json',
+        status=202
+    )
+
+
+@app.route('/bulk_refresh/<run_id>/', methods=['GET'])
+@check_admin
+def bulk_refresh_status(run_id):
+    """
+    :param run_id: The ID of the bulk refresh run.
+    :type run_id: str
+    :rtype: flask.Response
+    :returns: A JSON-formatted response with the run's progress.
+    """
+    progress = bulk_refresh_progress(run_id)
+    if progress is None:
+        return Response(
+            json.dumps({
+                'error': True,
+                'status_msg': '{} is not a valid bulk refresh.'.format(run_id)
+            }),
+            mimetype='application/json',
+            status=404
+        )
+
+    return Response(
+        json.dumps(progress),
+        mimetype='application/json',
+        status=200
+    )
+
+
+@app.route('/bulk_refresh/<run_id>/resume/', methods=['POST'])
+@check_admin
+def bulk_refresh_resume(run_id):
+    """
+    Carry on with a bulk refresh that was interrupted.
+
+    :param run_id: The ID of the bulk refresh run.
+    :type run_id: str
+    :rtype: flask.Response
+    :returns: A JSON-formatted response with the run's progress.
+    """
+    if bulk_refresh_progress(run_id) is None:
+        return Response(
+            json.dumps({
+                'error': True,
+                'status_msg': '{} is not a valid bulk refresh.'.format(run_id)
+            }),
+            mimetype='application/json',
+            status=404
+        )
+
+    resume_bulk_refresh(run_id)
+    return Response(
+        json.dumps(bulk_refresh_progress(run_id)),
+        mimetype='application/json',
+        status=202
+    )
+
+
+@app.cli.command('bulk-refresh')
+@click.option('--resume', 'run_id', help='Resume an earlier run instead of starting a new one.')
+@click.option('--wait/--no-wait', default=True, help='Report progress until the run is complete.')
+def bulk_refresh_command(run_id, wait):
+    """
+    Refresh every course that has active extensions, e.g. after a term's
+    quizzes have been copied in.
+    """
+    if run_id:
+        if bulk_refresh_progress(run_id) is None:
+            raise click.ClickException('{} is not a valid bulk refresh.'.format(run_id))
+        resume_bulk_refresh(run_id)
+    else:
+        run_id = start_bulk_refresh()
+    click.echo('Bulk refresh {}'.format(run_id))
+
+    while True:
+        progress = bulk_refresh_progress(run_id)
+        click.echo('{done}/{total} courses refreshed, {failed} failed, '
+                   '{quizzes_updated} quizzes updated.'.format(**progress))
+        if not wait or progress['status'] == 'complete':
+            break
+        sleep(5)
+
+    for course_id, message in sorted(progress['failures'].items()):
+        click.echo('Course {} failed: {}'.format(course_id, message))
+
+
+def start_bulk_refresh():
+    """
+    Refresh every course that has active extensions.
+
+    Courses are refreshed at most `config.BULK_REFRESH_CONCURRENCY` at
+    a time. The run's progress is kept in Redis, so it can be followed
+    with `bulk_refresh_progress` and resumed with `resume_bulk_refresh`.
+
+    :rtype: str
+    :returns: The ID of the new run.
+    """
+    course_ids = [
+        course.canvas_id for course in Course.query.filter(
+            Course.extensions.any(Extension.active.is_(True))
+        ).order_by(Course.id)
+    ]
+
+    run_id = uuid4().hex
+    pipe = conn.pipeline()
+    pipe.hmset(BULK_KEY.format(run_id), {
+        'status': 'running' if course_ids else 'complete',
+        'total': len(course_ids),
+        'done': 0,
+        'failed': 0,
+        'quizzes_updated': 0,
+        'started': time()
+    })
+    if course_ids:
+        pipe.rpush(BULK_PENDING_KEY.format(run_id), *course_ids)
+    pipe.execute()
+
+    logger.info('Started bulk refresh {} of {} courses.'.format(run_id, len(course_ids)))
+    fill_bulk_slots(run_id)
+    return run_id
+
+
+def fill_bulk_slots(run_id):
+    """
+    Start courses waiting in a bulk refresh while there is room.
+
+    :param run_id: The ID of the bulk refresh run.
+    :type run_id: str
+    """
+    active_key = BULK_ACTIVE_KEY.format(run_id)
+    pending_key = BULK_PENDING_KEY.format(run_id)
+
+    def claim_slot(pipe):
+        if pipe.hlen(active_key) >= config.BULK_REFRESH_CONCURRENCY:
+            return None
+        course_id = pipe.lindex(pending_key, 0)
+        if course_id is None:
+            return None
+
+        pipe.multi()
+        pipe.lpop(pending_key)
+        pipe.hset(active_key, course_id, '')
+        return course_id
+
+    while True:
+        course_id = conn.transaction(
+            claim_slot,
+            active_key,
+            pending_key,
+            value_from_callable=True
+        )
+        if course_id is None:
+            break
+
+        job, = enqueue_fair(
+            q,
+            fair_key(int(course_id)),
+            [(bulk_refresh_background, (run_id, int(course_id)))]
+        )
+
+        def save_job_id(pipe):
+            # Unless the job has already finished and given up its slot.
+            if pipe.hexists(active_key, course_id):
+                pipe.multi()
+                pipe.hset(active_key, course_id, job.get_id())
+
+        conn.transaction(save_job_id, active_key)
+
+
+def finish_bulk_course(run_id, course_id, result):
+    """
+    Record the result of refreshing one course in a bulk refresh.
+
+    :param run_id: The ID of the bulk refresh run.
+    :type run_id: str
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param result: The refresh job's meta.
+    :type result: dict
+    """
+    run_key = BULK_KEY.format(run_id)
+
+    # A resumed job finishes its course again; only count it once.
+    if not conn.sadd(BULK_DONE_KEY.format(run_id), course_id):
+        conn.hdel(BULK_ACTIVE_KEY.format(run_id), course_id)
+        return
+
+    pipe = conn.pipeline()
+    pipe.hdel(BULK_ACTIVE_KEY.format(run_id), course_id)
+    pipe.hincrby(run_key, 'done', 1)
+    pipe.hincrby(run_key, 'quizzes_updated', result.get('quizzes_updated', 0))
+    if result.get('status') == 'failed':
+        pipe.hincrby(run_key, 'failed', 1)
+        pipe.hset(BULK_FAILURES_KEY.format(run_id), course_id, result.get('status_msg', ''))
+    pipe.execute()
+
+    progress = bulk_refresh_progress(run_id)
+    if progress['done'] >= progress['total']:
+        conn.hset(run_key, 'status', 'complete')
+        logger.info('Bulk refresh {} complete: {}'.format(run_id, progress))
+    else:
+        fill_bulk_slots(run_id)
+
+
+def resume_bulk_refresh(run_id):
+    """
+    Carry on with a bulk refresh that was interrupted.
+
+    Courses whose refresh job was lost or failed outright are put back
+    at the front of the run, then waiting courses are started.
+
+    :param run_id: The ID of the bulk refresh run.
+    :type run_id: str
+    :rtype: int
+    :returns: The number of courses put back.
+    """
+    active_key = BULK_ACTIVE_KEY.format(run_id)
+    requeued = 0
+
+    for course_id, job_id in conn.hgetall(active_key).items():
+        try:
+            job = Job.fetch(job_id, connection=conn) if job_id else None
+        except NoSuchJobError:
+            job = None
+
+        if job is not None and job.get_status() in ('queued', 'started', 'deferred'):
+            continue
+
+        pipe = conn.pipeline()
+        pipe.hdel(active_key, course_id)
+        pipe.lpush(BULK_PENDING_KEY.format(run_id), course_id)
+        pipe.execute()
+        requeued += 1
+
+    fill_bulk_slots(run_id)
+    return requeued
+
+
+def bulk_refresh_progress(run_id):
+    """
+    :param run_id: The ID of the bulk refresh run.
+    :type run_id: str
+    :rtype: dict
+    :returns: The run's status, the number of courses in it, done and
+        failed, the number of quizzes updated, and the reason each
+        failed course failed. None if there is no such run.
+    """
+    run = conn.hgetall(BULK_KEY.format(run_id))
+    if not run:
+        return None
+
+    def text(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    run = {text(field): text(value) for field, value in run.items()}
+    return {
+        'run_id': run_id,
+        'status': run['status'],
+        'total': int(run['total']),
+        'done': int(run['done']),
+        'failed': int(run['failed']),
+        'quizzes_updated': int(run['quizzes_updated']),
+        'failures': {
+            text(course_id): text(message)
+            for course_id, message in conn.hgetall(BULK_FAILURES_KEY.format(run_id)).items()
+        }
+    }
+
+
+@app.route('/import/', methods=['POST'])
+@check_admin
+def import_route():
+    """
+    Import accommodations from an uploaded CSV or JSON lines file. See
+    `start_import`.
+
+    The format is taken from the `format` parameter, or else the file's
+    extension.
+
+    :rtype: flask.Response
+    :returns: A JSON-formatted response containing the url of the
+        import job.
+    """
+    upload = request.files.get('file')
+    fmt = import_format(upload.filename if upload else None, request.values.get('format'))
+    if not upload or not fmt:
+        return Response(
+            json.dumps({
+                'error': True,
+                'status_msg': 'Upload a `file` in CSV or JSON lines format.'
+            }),
+            mimetype='application/json',
+            status=400
+        )
+
+    job = start_import(upload.stream, fmt)
+    return Response(
+        json.dumps({'import_job_url': url_for('job_status', job_key=job.get_id())}),
+        mimetype='application/json',
+        status=202
+    )
+
+
+@app.cli.command('import-accommodations')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='The file format. Taken from the extension if not given.')
+@click.option('--wait/--no-wait', default=True, help='Report the result once imported.')
+def import_command(path, fmt, wait):
+    """
+    Import accommodations from a CSV or JSON lines file, with a row for
+    each student giving their `sis_user_id`, `course_id` and `percent`.
+    """
+    fmt = import_format(path, fmt)
+    if not fmt:
+        raise click.ClickException('Unable to tell the format of {}.'.format(path))
+
+    with open(path, 'rb') as import_file:
+        job = start_import(import_file, fmt)
+    click.echo('Import {}'.format(job.get_id()))
+
+    if not wait:
+        return
+    job.refresh()
+    while job.meta.get('status') not in ('complete', 'failed'):
+        sleep(5)
+        job.refresh()
+
+    click.echo(job.meta['status_msg'])
+    for row_error in job.meta.get('errors', []):
+        click.echo('Line {line}: {error}'.format(**row_error))
+    if job.meta.get('errors_omitted'):
+        click.echo('{} more rows had errors.'.format(job.meta['errors_omitted']))
+    for course_id, job_id in sorted(job.meta.get('jobs', {}).items()):
+        click.echo('Course {} is being updated by job {}'.format(course_id, job_id))
+
+
+def start_import(lines, fmt):
+    """
+    Queue an import of accommodations from a file. The file is kept in
+    Redis until the import is done, so any worker can run it and it
+    can be resumed if it is cut short.
+
+    :param lines: The file. See `iter_import_rows`.
+    :type lines: iterable
+    :param fmt: 'csv' or 'jsonl'.
+    :type fmt: str
+    :rtype: :class:`rq.job.Job`
+    :returns: The `import_background` job.
+    """
+    import_id = uuid4().hex
+    lines_key = IMPORT_LINES_KEY.format(import_id)
+
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= config.IMPORT_BATCH_SIZE:
+            conn.rpush(lines_key, *batch)
+            batch = []
+    if batch:
+        conn.rpush(lines_key, *batch)
+    conn.expire(lines_key, config.CHECKPOINT_TTL)
+
+    job, = enqueue_fair(q, IMPORT_FAIR_KEY, [(import_background, (import_id, fmt))])
+    return job
+
+
+def stored_lines(import_id):
+    """
+    :param import_id: The ID of the import.
+    :type import_id: str
+    :rtype: generator
+    :returns: The lines of the file saved by `start_import`, read from
+        Redis a batch at a time.
+    """
+    lines_key = IMPORT_LINES_KEY.format(import_id)
+    start = 0
+    while True:
+        lines = conn.lrange(lines_key, start, start + config.IMPORT_BATCH_SIZE - 1)
+        if not lines:
+            return
+        for line in lines:
+            yield line
+        start += len(lines)
+
+
+@fair_job
+@canvas_job
+def import_background(import_id, fmt):
+    """
+    Import accommodations from a file saved by `start_import`, saving
+    each student's percent for their course and then queueing one
+    `update_background` job for each course.
+
+    Rows are read and saved `config.IMPORT_BATCH_SIZE` at a time, and
+    SIS IDs are found on each course's cached roster, so a large file
+    costs one roster per course rather than one request per row. Each
+    batch is checkpointed, so a resumed import carries on after the
+    last one saved.
+
+    Only the Canvas IDs of the students saved for each course are kept,
+    in Redis, so memory stays flat however big the file is. Each
+    course's percents are read back from the database when its job is
+    queued, and that job is told they are already saved.
+
+    The job's result has the number of `rows` read and `imported`, the
+    first `config.IMPORT_MAX_ERRORS` rows with errors and how many more
+    were left out, and the ID of the update job for each course.
+
+    :param import_id: The ID of the import.
+    :type import_id: str
+    :param fmt: 'csv' or 'jsonl'.
+    :type fmt: str
+    """
+    job = get_current_job()
+    update_job(job, 0, 'Starting...', 'started')
+
+    with app.app_context():
+        checkpoint = get_checkpoint(job)
+        num_lines = conn.llen(IMPORT_LINES_KEY.format(import_id)) or 1
+
+        summary = {'rows': 0, 'imported': 0, 'errors': [], 'errors_omitted': 0, 'jobs': {}}
+        courses_key = IMPORT_COURSES_KEY.format(import_id)
+
+        def row_error(line_number, error):
+            if len(summary['errors']) < config.IMPORT_MAX_ERRORS:
+                summary['errors'].append({'line': line_number, 'error': error})
+            else:
+                summary['errors_omitted'] += 1
+
+        def save_batch(batch_number, batch):
+            step = 'batch:{}'.format(batch_number)
+            if step in checkpoint:
+                result = checkpoint[step]
+            else:
+                result = import_batch(batch)
+                save_checkpoint(job, step, result)
+
+            # Sets, so a batch saved again on resume isn't counted twice.
+            pipe = conn.pipeline()
+            for course_id, user_ids in result['courses'].items():
+                students_key = IMPORT_STUDENTS_KEY.format(import_id, course_id)
+                pipe.sadd(courses_key, course_id)
+                pipe.sadd(students_key, *user_ids)
+                pipe.expire(students_key, config.CHECKPOINT_TTL)
+            pipe.expire(courses_key, config.CHECKPOINT_TTL)
+            pipe.execute()
+            for line_number, error in result['errors']:
+                row_error(line_number, error)
+
+            update_job(
+                job,
+                min(99, 100 * batch[-1][0] // num_lines),
+                'Imported {} rows.'.format(summary['rows']),
+                'processing',
+                False
+            )
+
+        batch = []
+        batch_number = 0
+        for line_number, row, error in iter_import_rows(stored_lines(import_id), fmt):
+            summary['rows'] += 1
+            if error:
+                row_error(line_number, error)
+                continue
+
+            batch.append((line_number, row))
+            if len(batch) >= config.IMPORT_BATCH_SIZE:
+                save_batch(batch_number, batch)
+                batch = []
+                batch_number += 1
+        if batch:
+            save_batch(batch_number, batch)
+
+        course_ids = sorted(int(course_id) for course_id in conn.smembers(courses_key))
+        for course_id in course_ids:
+            user_ids = [
+                int(user_id) for user_id in
+                conn.smembers(IMPORT_STUDENTS_KEY.format(import_id, course_id))
+            ]
+            summary['imported'] += len(user_ids)
+
+            step = 'job:{}'.format(course_id)
+            if step in checkpoint:
+                summary['jobs'][course_id] = checkpoint[step]
+                continue
+
+            # The last row for a student won when it was saved.
+            percent_user_map = defaultdict(list)
+            user_percents = db.session.query(User.canvas_id, Extension.percent).join(
+                Extension, Extension.user_id == User.id
+            ).join(
+                Course, Course.id == Extension.course_id
+            ).filter(
+                Course.canvas_id == course_id,
+                User.canvas_id.in_(user_ids)
+            )
+            for user_id, percent in user_percents:
+                percent_user_map[percent].append('{}'.format(user_id))
+            extension_dict = {
+                'groups': [
+                    {'percent': percent, 'user_ids': sorted(group_ids)}
+                    for percent, group_ids in sorted(percent_user_map.items())
+                ],
+                # Already saved by `import_batch`, so the job needn't again.
+                'saved': True
+            }
+
+            course_job, = enqueue_fair(
+                q,
+                fair_key(course_id),
+                [(update_background, (course_id, extension_dict))]
+            )
+            summary['jobs'][course_id] = course_job.get_id()
+            save_checkpoint(job, step, course_job.get_id())
+
+        summary['errors'].sort(key=lambda row_error: row_error['line'])
+        job.meta.update(summary)
+        update_job(
+            job,
+            100,
+            'Imported {} of {} rows.'.format(summary['imported'], summary['rows']),
+            'complete',
+            False
+        )
+        clear_checkpoint(job)
+        conn.delete(
+            IMPORT_LINES_KEY.format(import_id),
+            courses_key,
+            *[IMPORT_STUDENTS_KEY.format(import_id, course_id) for course_id in course_ids]
+        )
+
+    return job.meta
+
+
+def import_batch(batch):
+    """
+    Save one batch of imported rows as `User` and `Extension` rows,
+    loading the rows that already exist for the whole batch at once.
+
+    :param batch: (line number, row) pairs from `iter_import_rows`.
+    :type batch: list
+    :rtype: dict
+    :returns: The Canvas user IDs saved, by course, and a (line number,
+        error) pair for each row that couldn't be imported.
+    """
+    result = {'courses': defaultdict(list), 'errors': []}
+
+    course_rows = defaultdict(list)
+    for line_number, (sis_user_id, course_id, percent) in batch:
+        course_rows[course_id].append((line_number, sis_user_id, percent))
+
+    # (course ID, Canvas user, percent) for each row found on a roster.
+    found = []
+    for course_id, rows in course_rows.items():
+        try:
+            roster = get_roster(course_id)
+        except requests.exceptions.HTTPError:
+            logger.exception('Unable to get the roster for course #{}'.format(course_id))
+            result['errors'].extend(
+                (line_number, 'Unable to get students in course #{}.'.format(course_id))
+                for line_number, sis_user_id, percent in rows
+            )
+            continue
+
+        students = dict((user['sis_user_id'], user) for user in roster if user['sis_user_id'])
+        for line_number, sis_user_id, percent in rows:
+            canvas_user = students.get(sis_user_id)
+            if canvas_user is None:
+                result['errors'].append((
+                    line_number,
+                    'No active student with SIS ID {} in course #{}.'.format(
+                        sis_user_id,
+                        course_id
+                    )
+                ))
+                continue
+            found.append((course_id, canvas_user, percent))
+
+    if not found:
+        return result
+
+    course_ids = set(course_id for course_id, canvas_user, percent in found)
+    courses = dict(
+        (course.canvas_id, course)
+        for course in Course.query.filter(Course.canvas_id.in_(course_ids))
+    )
+    user_ids = set(canvas_user['id'] for course_id, canvas_user, percent in found)
+    users = dict(
+        (user.canvas_id, user)
+        for user in User.query.filter(User.canvas_id.in_(user_ids))
+    )
+
+    for course_id in course_ids - set(courses):
+        courses[course_id] = Course(course_id)
+        db.session.add(courses[course_id])
+    for course_id, canvas_user, percent in found:
+        user = users.get(canvas_user['id'])
+        if user is None:
+            user = users[canvas_user['id']] = User(canvas_user['id'])
+            db.session.add(user)
+        user.sortable_name = canvas_user.get('sortable_name') or '<MISSING NAME>'
+        user.sis_id = canvas_user['sis_user_id']
+    db.session.flush()
+
+    extensions = dict(
+        ((extension.course_id, extension.user_id), extension)
+        for extension in Extension.query.filter(
+            Extension.course_id.in_([course.id for course in courses.values()]),
+            Extension.user_id.in_([user.id for user in users.values()])
+        )
+    )
+    for course_id, canvas_user, percent in found:
+        key = (courses[course_id].id, users[canvas_user['id']].id)
+        extension = extensions.get(key)
+        if extension is None:
+            extension = extensions[key] = Extension(key[0], key[1], percent)
+            db.session.add(extension)
+        extension.percent = percent
+        extension.active = True
+
+        result['courses'][course_id].append(canvas_user['id'])
+
+    db.session.commit()
+    return result
+
+
+@app.cli.command('refresh-scheduler')
+def refresh_scheduler():
+    """
+    Keep checking courses with active extensions for new or changed
+    quizzes. Run alongside the RQ worker.
+    """
+    logger.info('Refresh scheduler started.')
+    while True:
+        scheduler_tick()
+        sleep(config.REFRESH_SWEEP_TICK)
+
+
+def scheduler_tick():
+    """
+    Run one pass of the refresh scheduler, also starting any delayed
+    jobs that are now due and reclaiming abandoned job slots. Errors
+    are logged rather than stopping the scheduler, and the database
+    session is ended afterwards so the next pass sees courses and
+    quizzes added since.
+    """
+    try:
+        schedule_sweeps()
+        release_delayed_jobs(conn)
+        reclaim_fair_slots(q)
+    except Exception:
+        logger.exception('Unable to schedule refresh sweeps.')
+        db.session.rollback()
+    finally:
+        db.session.remove()
+
+
+def next_sweep(now, first=False):
+    """
+    :param now: The current time.
+    :type now: float
+    :param first: True if the course has not been scheduled before.
+    :type first: bool
+    :rtype: float
+    :returns: When a course should next be checked. Courses seen for
+        the first time are spread over a whole interval.
+    """
+    interval = config.REFRESH_SWEEP_INTERVAL
+    if first:
+        return now + random.uniform(0, interval)
+
+    jitter = interval * config.REFRESH_SWEEP_JITTER
+    return now + interval + random.uniform(-jitter, jitter)
+
+
+def schedule_sweeps():
+    """
+    Bring the sweep schedule up to date with the courses that have
+    active extensions, and queue a sweep for each course that is due.
+    Courses are also due `config.REFRESH_UNLOCK_LEAD` seconds before
+    each of their timed quizzes unlocks, as last seen by a sweep.
+
+    :rtype: list
+    :returns: The Canvas IDs of the courses queued.
+    """
+    course_ids = {
+        str(course.canvas_id) for course in Course.query.filter(
+            Course.extensions.any(Extension.active.is_(True))
+        )
+    }
+    now = time()
+
+    scheduled = {
+        (course_id.decode('utf-8') if isinstance(course_id, bytes) else course_id): due
+        for course_id, due in conn.zrange(SWEEP_SCHEDULE_KEY, 0, -1, withscores=True)
+    }
+    due_times = {
+        course_id: next_sweep(now, first=True)
+        for course_id in course_ids - set(scheduled)
+    }
+
+    # Check again a little before each timed quiz unlocks, in case
+    # anything has changed since the last sweep.
+    lead = config.REFRESH_UNLOCK_LEAD
+    for course_id, unlocks in conn.hgetall(SWEEP_UNLOCKS_KEY).items():
+        course_id = course_id.decode('utf-8') if isinstance(course_id, bytes) else course_id
+        upcoming = [unlock for unlock in json.loads(unlocks) if unlock > now + lead]
+        if course_id not in course_ids or not upcoming:
+            continue
+        pre_unlock = min(upcoming) - lead
+        if pre_unlock < due_times.get(course_id, scheduled.get(course_id, float('inf'))):
+            due_times[course_id] = pre_unlock
+
+    pipe = conn.pipeline()
+    for course_id, due in due_times.items():
+        pipe.zadd(SWEEP_SCHEDULE_KEY, **{course_id: due})
+    for course_id in set(scheduled) - course_ids:
+        pipe.zrem(SWEEP_SCHEDULE_KEY, course_id)
+        pipe.hdel(SWEEP_FINGERPRINT_KEY, course_id)
+        pipe.hdel(SWEEP_UNLOCKS_KEY, course_id)
+    pipe.execute()
+
+    queued = []
+    for course_id in conn.zrangebyscore(SWEEP_SCHEDULE_KEY, '-inf', now):
+        def claim(pipe):
+            # Another scheduler may have moved the course along since it
+            # was read; the transaction is retried if it does so now.
+            due = pipe.zscore(SWEEP_SCHEDULE_KEY, course_id)
+            if due is None or due > now:
+                return False
+            pipe.multi()
+            pipe.zadd(SWEEP_SCHEDULE_KEY, **{course_id: next_sweep(now)})
+            return True
+
+        if not conn.transaction(claim, SWEEP_SCHEDULE_KEY, value_from_callable=True):
+            continue
+
+        course_id = int(course_id)
+        enqueue_fair(q, fair_key(course_id), [(sweep_background, (course_id,))])
+        queued.append(course_id)
+
+    if queued:
+        logger.info('Queued refresh sweeps for courses {}'.format(queued))
+    return queued
+
+
+@fair_job
+@canvas_job
 def update_background(course_id, extension_dict):
     """
     Update time on selected students' quizzes to a specified percentage.
@@ -340,6 +1671,26 @@ def update_background(course_id, extension_dict):
                 '5555555'
             ]
         }
+
+        Several percents can be given at once as a list of groups, and
+        each quiz is still only posted to once:
+        {
+            'groups': [
+                {'percent': '150', 'user_ids': ['0123456', '1234567']},
+                {'percent': '200', 'user_ids': ['9867543']}
+            ]
+        }
+
+        A group can give a `section_id`, or `'all_students': True`,
+        instead of `user_ids`. Its students are then looked up from the
+        course roster (see `resolve_selection`).
+
+        Jobs queued by `import_background` also give `'saved': True`,
+        as the students and their percents are already saved, so they
+        aren't looked up and saved again.
+
+        If it includes `'force': True`, the extension is posted even
+        to students who already have it.
     :type extension_dict: dict
     """
     job = get_current_job()
@@ -366,36 +1717,55 @@ def update_background(course_id, extension_dict):
                 0,
                 'Course not found.',
                 'failed',
-                error=True
+                error=True,
+                retryable=True
             )
             logger.exception('Unable to find course #{}'.format(course_id))
             return job.meta
 
         course_name = course_json.get('name', '<UNNAMED COURSE>')
 
-        user_ids = extension_dict.get('user_ids', [])
-        percent = extension_dict.get('percent', None)
+        try:
+            extension_dict, roster_users = resolve_selection(course_id, extension_dict)
+        except requests.exceptions.HTTPError:
+            update_job(
+                job,
+                0,
+                'Unable to get students from Canvas.',
+                'failed',
+                error=True,
+                retryable=True
+            )
+            logger.exception('Unable to get the roster for course #{}'.format(course_id))
+            return job.meta
+
+        groups = extension_groups(extension_dict)
+        error_message = groups_error(groups)
 
-        if not percent:
+        if error_message:
             update_job(
                 job,
                 0,
-                '`percent` field required.',
+                error_message,
                 'failed',
                 error=True
             )
-            logger.warning('Percent field not provided. Request: {}'.format(
-                extension_dict
-            ))
+            logger.warning('{} Request: {}'.format(error_message, extension_dict))
             return job.meta
 
         course, created = get_or_create(db.session, Course, canvas_id=course_id)
         course.course_name = course_name
         db.session.commit()
 
-        for user_id in user_ids:
+        user_percents = [
+            (user_id, percent) for percent, user_ids in groups for user_id in user_ids
+        ]
+        if extension_dict.get('saved'):
+            # Imports have already saved their students and percents.
+            user_percents = []
+        for user_id, percent in user_percents:
             try:
-                canvas_user = get_user(course_id, user_id)
+                canvas_user = roster_users.get(str(user_id)) or get_user(course_id, user_id)
 
                 sortable_name = canvas_user.get('sortable_name', '<MISSING NAME>')
                 sis_id = canvas_user.get('sis_user_id')
@@ -428,10 +1798,56 @@ def update_background(course_id, extension_dict):
 
             db.session.commit()
 
-        quizzes = get_quizzes(course_id)
+        percent_user_map = defaultdict(list)
+        for percent, user_ids in groups:
+            percent_user_map[percent].extend(user_ids)
+
+        try:
+            accommodations = apply_accommodations(
+                job,
+                course_id,
+                percent_user_map,
+                force=extension_dict.get('force', False)
+            )
+        except requests.exceptions.HTTPError:
+            update_job(
+                job,
+                0,
+                'Unable to get New Quizzes from Canvas.',
+                'failed',
+                error=True,
+                retryable=True
+            )
+            logger.exception('Unable to get New Quizzes for course #{}'.format(course_id))
+            return job.meta
+
+        # Quizzes may have been added since they were cached.
+        invalidate_cache(get_quizzes, course_id)
+        try:
+            quizzes = get_quizzes(course_id)
+        except requests.exceptions.HTTPError:
+            update_job(
+                job,
+                0,
+                'Unable to get quizzes from Canvas.',
+                'failed',
+                error=True,
+                retryable=True
+            )
+            logger.exception('Unable to get quizzes for course #{}'.format(course_id))
+            return job.meta
+
         num_quizzes = len(quizzes)
-        quiz_time_list = []
-        unchanged_quiz_time_list = []
+
+        if num_quizzes < 1 and accommodations is not None:
+            update_job(
+                job,
+                100,
+                ''.join(accommodation_message(result) for result in accommodations).strip(),
+                'complete',
+                error=False
+            )
+            return job.meta
 
         if num_quizzes < 1:
             update_job(
@@ -448,90 +1864,179 @@ def update_background(course_id, extension_dict):
             )
             return job.meta
 
-        for index, quiz in enumerate(quizzes):
-            quiz_id = quiz.get('id', None)
-            quiz_title = quiz.get('title', "[UNTITLED QUIZ]")
+        plan = plan_extensions(
+            course_id,
+            quizzes,
+            percent_user_map,
+            force=extension_dict.get('force', False)
+        )
+        quiz_time_list, unchanged_quiz_time_list, failed_quiz_list = extend_quizzes(
+            job,
+            course,
+            plan,
+            'Updating quiz #{} - {} [{} of {}]'
+        )
 
-            comp_perc = int(((float(index)) / float(num_quizzes)) * 100)
-            updating_str = 'Updating quiz #{} - {} [{} of {}]'
+        if failed_quiz_list and not config.CONTINUE_ON_QUIZ_FAILURE:
             update_job(
                 job,
-                comp_perc,
-                updating_str.format(quiz_id, quiz_title, index + 1, num_quizzes),
-                'processing',
-                error=False
+                job.meta['percent'],
+                failed_quiz_list[0]['message'],
+                'failed',
+                error=True,
+                retryable=True
             )
-
-            extension_response = extend_quiz(course_id, quiz, percent, user_ids)
-
-            if extension_response.get('success', False) is True:
-                # add/update quiz
-                quiz_obj, created = get_or_create(
-                    db.session,
-                    Quiz,
-                    canvas_id=quiz_id,
-                    course_id=course.id
-                )
-                quiz_obj.title = quiz_title
-
-                db.session.commit()
-
-                added_time = extension_response.get('added_time', None)
-                if added_time is not None:
-                    quiz_time_list.append({
-                        "title": quiz_title,
-                        "added_time": added_time
-                    })
-                else:
-                    unchanged_quiz_time_list.append({"title": quiz_title})
-            else:
-                update_job(
-                    job,
-                    comp_perc,
-                    extension_response.get(
-                        'message',
-                        'An unknown error occured.'
-                    ),
-                    'failed',
-                    error=True
-                )
-                logger.error("Extension failed: {}".format(extension_response))
-                return job.meta
+            logger.error("Extension failed: {}".format(failed_quiz_list[0]))
+            return job.meta
 
         msg_str = (
-            'Success! {} {} been updated for {} student(s) to have {}% time. '
+            'Success! {} {} been updated for {}. '
             '{} {} no time limit and were left unchanged.'
         )
 
+        num_updated = len(plan.quizzes) - len(unchanged_quiz_time_list) - len(failed_quiz_list)
         message = msg_str.format(
-            len(quiz_time_list),
-            "quizzes have" if len(quiz_time_list) != 1 else "quiz has",
-            len(user_ids),
-            percent,
+            num_updated,
+            "quizzes have" if num_updated != 1 else "quiz has",
+            ', '.join(
+                '{} student(s) to have {}% time'.format(len(user_ids), percent)
+                for percent, user_ids in groups
+            ),
             len(unchanged_quiz_time_list),
             "quizzes have" if len(unchanged_quiz_time_list) != 1 else "quiz has"
         )
+        message += skipped_message(plan.skipped)
+        for result in accommodations or []:
+            message += accommodation_message(result)
+        message += retry_failed_quizzes(job, course_id, failed_quiz_list, percent_user_map)
 
         update_job(job, 100, message, 'complete', error=False)
         job.meta['quiz_list'] = quiz_time_list
         job.meta['unchanged_list'] = unchanged_quiz_time_list
+        job.meta['failed_list'] = failed_quiz_list
+        job.meta['skipped_list'] = plan.skipped
         job.save()
+        clear_checkpoint(job)
 
         return job.meta
 
 
-def refresh_background(course_id):
+@fair_job
+def refresh_background(course_id, force=False):
     """
-    Look up existing extensions and apply them to new quizzes.
+    Look up existing extensions and apply them to new quizzes, and to
+    quizzes whose time limit has changed since they were last updated.
 
     :param course_id: The Canvas ID of the Course.
     :type course_id: int
+    :param force: Post every extension, even to students the ledger
+        shows already have it.
+    :type force: bool
     :rtype: dict
     :returns: A dictionary containing two parts:
 
         - success `bool` False if there was an error, True otherwise.
         - message `str` A long description of success or failure.
     """
+    return refresh_course(course_id, force)
+
+
+@fair_job
+def bulk_refresh_background(run_id, course_id):
+    """
+    Refresh one course as part of a bulk refresh, then record how it
+    went and start the next course waiting in the run.
+
+    :param run_id: The ID of the bulk refresh run.
+    :type run_id: str
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :rtype: dict
+    :returns: The same as `refresh_background`.
+    """
+    try:
+        result = refresh_course(course_id)
+    except Exception:
+        finish_bulk_course(run_id, course_id, {
+            'status': 'failed',
+            'status_msg': 'An unexpected error occurred.'
+        })
+        raise
+
+    finish_bulk_course(run_id, course_id, result)
+    return result
+
+
+def record_unlocks(course_id, quizzes):
+    """
+    Remember when a course's timed quizzes unlock, so `schedule_sweeps`
+    can check the course again shortly before each one does. This
+    covers every timed quiz in Canvas, including ones that haven't been
+    extended yet.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param quizzes: Every quiz in the course, from `get_quizzes`.
+    :type quizzes: list
+    """
+    now = time()
+    unlocks = sorted(set(
+        to_timestamp(parse_canvas_time(quiz.get('unlock_at')))
+        for quiz in quizzes
+        if quiz.get('time_limit') and quiz.get('unlock_at')
+    ))
+    unlocks = [unlock for unlock in unlocks if unlock > now]
+
+    if unlocks:
+        conn.hset(SWEEP_UNLOCKS_KEY, course_id, json.dumps(unlocks))
+    else:
+        conn.hdel(SWEEP_UNLOCKS_KEY, course_id)
+
+
+@fair_job
+@canvas_job
+def sweep_background(course_id):
+    """
+    Refresh a course for the scheduler, unless none of its quizzes have
+    changed since it was last refreshed this way.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :rtype: dict
+    :returns: The same as `refresh_background`.
+    """
+    job = get_current_job()
+
+    invalidate_cache(get_quizzes, course_id)
+    try:
+        quizzes = get_quizzes(course_id)
+        record_unlocks(course_id, quizzes)
+        fingerprint = catalog_fingerprint(quizzes)
+        if config.NEW_QUIZZES_ACCOMMODATIONS and uses_new_quizzes(course_id):
+            # Accommodations only depend on the longest New Quiz.
+            fingerprint += ':{}'.format(longest_time_limit(get_new_quizzes(course_id)))
+    except requests.exceptions.HTTPError:
+        # Let the refresh report what went wrong.
+        fingerprint = None
+
+    previous = conn.hget(SWEEP_FINGERPRINT_KEY, course_id)
+    if fingerprint and previous is not None and previous.decode('utf-8') == fingerprint:
+        update_job(job, 100, 'Complete. No quizzes have changed.', 'complete', error=False)
+        return job.meta
+
+    result = refresh_course(course_id)
+    # Quizzes that still failed have to be swept again.
+    if fingerprint and result.get('status') == 'complete' and not result.get('failed_list'):
+        conn.hset(SWEEP_FINGERPRINT_KEY, course_id, fingerprint)
+    return result
+
+
+@canvas_job
+def refresh_course(course_id, force=False):
+    """
+    Refresh a course's extensions in the current job. See
+    `refresh_background`.
+    """
     job = get_current_job()
 
     update_job(job, 0, 'Starting...', 'started')
@@ -556,14 +2061,50 @@ def refresh_background(course_id):
                 0,
                 'Course not found.',
                 'failed',
-                error=True
+                error=True,
+                retryable=True
             )
             logger.exception('Unable to find course #{}'.format(course_id))
 
             return job.meta
 
+        # New Quizzes share one accommodation per student, which has to
+        # change whenever a longer New Quiz is added.
+        active_percents = defaultdict(list)
+        for extension in course.extensions.filter_by(active=True):
+            active_percents[extension.percent].append(extension.user.canvas_id)
+        try:
+            accommodations = apply_accommodations(job, course_id, active_percents, force=force)
+        except requests.exceptions.HTTPError:
+            update_job(
+                job,
+                0,
+                'Unable to get New Quizzes from Canvas.',
+                'failed',
+                error=True,
+                retryable=True
+            )
+            logger.exception('Unable to get New Quizzes for course #{}'.format(course_id))
+            return job.meta
+        accommodations_msg = ''.join(
+            accommodation_message(accommodation) for accommodation in accommodations or []
+        )
+
         # quiz stuff
-        quizzes = missing_quizzes(course_id)
+        invalidate_cache(get_quizzes, course_id)
+        try:
+            quizzes = missing_quizzes(course_id, changed=True, filtered=True)
+        except requests.exceptions.HTTPError:
+            update_job(
+                job,
+                0,
+                'Unable to get quizzes from Canvas.',
+                'failed',
+                error=True,
+                retryable=True
+            )
+            logger.exception('Unable to get quizzes for course #{}'.format(course_id))
+            return job.meta
 
         num_quizzes = len(quizzes)
 
@@ -571,7 +2112,7 @@ def refresh_background(course_id):
             update_job(
                 job,
                 100,
-                'Complete. No quizzes required updates.',
+                'Complete. No quizzes required updates.' + accommodations_msg,
                 'complete',
                 error=False
             )
@@ -583,6 +2124,25 @@ def refresh_background(course_id):
         inactive_list = []
 
         update_job(job, 0, 'Getting past extensions.', 'processing', False)
+
+        # One roster of active students answers whether each extension's
+        # student is still in the course, instead of a request per student.
+        invalidate_cache(get_roster, course_id)
+        try:
+            roster_ids = set(str(student['id']) for student in get_roster(course_id))
+        except requests.exceptions.HTTPError:
+            update_job(
+                job,
+                0,
+                'Unable to get the course roster from Canvas.',
+                'failed',
+                error=True,
+                retryable=True
+            )
+            logger.exception('Unable to get the roster for course #{}'.format(course_id))
+            return job.meta
+
+        deactivated = False
         for extension in course.extensions:
             # If extension is inactive, ignore.
             if not extension.active:
@@ -592,48 +2152,27 @@ def refresh_background(course_id):
                 ))
                 continue
 
-            user_canvas_id = User.query.filter_by(
-                id=extension.user_id
-            ).first().canvas_id
-
-            # Check if user is in course. If not, deactivate extension.
-            try:
-                canvas_user = get_user(course_id, user_canvas_id)
-
-                # Skip user if not a student. Fixes an edge case where a
-                # student that previously recieved an extension changes roles.
-                enrolls = canvas_user.get('enrollments', [])
-                type_list = [e['type'] for e in enrolls if e['enrollment_state'] == 'active']
-                if not any(t == 'StudentEnrollment' for t in type_list):
-                    logger.info((
-                        "User #{} was found in course #{}, but is not an "
-                        "active student. Deactivating extension #{}. Roles "
-                        "found: {}"
-                    ).format(
-                        user_canvas_id,
-                        course_id,
-                        extension.id,
-                        ", ".join(type_list) if len(enrolls) > 0 else None
-                    ))
-                    extension.active = False
-                    db.session.commit()
-                    inactive_list.append(extension.user.sortable_name)
-                    continue
+            user_canvas_id = extension.user.canvas_id
 
-            except requests.exceptions.HTTPError:
-                log_str = (
-                    'User #{} not in course #{}. Deactivating extension #{}.'
-                )
+            # Deactivate the extension if the user is no longer an active
+            # student in the course, e.g. they dropped or changed roles.
+            if str(user_canvas_id) not in roster_ids:
                 logger.info(
-                    log_str.format(user_canvas_id, course_id, extension.id)
+                    'User #{} is not an active student in course #{}. '
+                    'Deactivating extension #{}.'.format(
+                        user_canvas_id, course_id, extension.id
+                    )
                 )
                 extension.active = False
-                db.session.commit()
+                deactivated = True
                 inactive_list.append(extension.user.sortable_name)
                 continue
 
             percent_user_map[extension.percent].append(user_canvas_id)
 
+        if deactivated:
+            db.session.commit()
+
         if len(percent_user_map) < 1:
             msg_str = 'No active extensions were found.<br>'
 
@@ -650,71 +2189,414 @@ def refresh_background(course_id):
             )
             return job.meta
 
-        for index, quiz in enumerate(quizzes):
-            quiz_id = quiz.get('id', None)
-            quiz_title = quiz.get('title', '[UNTITLED QUIZ]')
+        plan = plan_extensions(course_id, quizzes, percent_user_map, force=force)
+        quiz_time_list, unchanged_quiz_time_list, failed_quiz_list = extend_quizzes(
+            job,
+            course,
+            plan,
+            'Refreshing quiz #{} - {} [{} of {}]'
+        )
 
-            comp_perc = int(((float(index)) / float(num_quizzes)) * 100)
-            refreshing_str = 'Refreshing quiz #{} - {} [{} of {}]'
+        if failed_quiz_list and not config.CONTINUE_ON_QUIZ_FAILURE:
+            error_message = 'Some quizzes couldn\'t be updated. '
+            error_message += failed_quiz_list[0]['message']
             update_job(
                 job,
-                comp_perc,
-                refreshing_str.format(
-                    quiz_id,
-                    quiz_title,
-                    index + 1,
-                    num_quizzes
-                ),
-                'processing',
-                error=False
+                job.meta['percent'],
+                error_message,
+                'failed',
+                error=True,
+                retryable=True
             )
+            return job.meta
 
-            for percent, user_list in percent_user_map.iteritems():
-                extension_response = extend_quiz(
-                    course_id,
-                    quiz,
-                    percent,
-                    user_list
-                )
+        msg = '{} quizzes have been updated.'.format(
+            len(plan.quizzes) - len(failed_quiz_list)
+        )
+        msg += skipped_message(plan.skipped)
+        msg += accommodations_msg
+        msg += retry_failed_quizzes(job, course_id, failed_quiz_list, percent_user_map)
+        update_job(job, 100, msg, 'complete', error=False)
+        # Only quizzes that needed extensions posted, not untimed quizzes
+        # or those the ledger shows are already extended.
+        failed_ids = set(quiz['id'] for quiz in failed_quiz_list)
+        job.meta['quizzes_updated'] = len([
+            quiz for quiz, operations in plan.steps
+            if quiz.get('id') not in failed_ids and
+            any(operation.api_calls for operation in operations)
+        ])
+        job.meta['quiz_list'] = quiz_time_list
+        job.meta['unchanged_list'] = unchanged_quiz_time_list
+        job.meta['failed_list'] = failed_quiz_list
+        job.meta['skipped_list'] = plan.skipped
+        job.save()
+        clear_checkpoint(job)
+        return job.meta
 
-                if extension_response.get('success', False) is True:
-                    # add/update quiz
-                    quiz_obj, created = get_or_create(
-                        db.session,
-                        Quiz,
-                        canvas_id=quiz_id,
-                        course_id=course.id
-                    )
-                    quiz_obj.title = quiz_title
-
-                    db.session.commit()
-                else:
-                    error_message = 'Some quizzes couldn\'t be updated. '
-                    error_message += extension_response.get('message', '')
-                    update_job(
-                        job,
-                        comp_perc,
-                        error_message,
-                        'failed',
-                        error=True,
-                    )
-                    return job.meta
 
-        msg = '{} quizzes have been updated.'.format(len(quizzes))
+@fair_job
+@canvas_job
+def retry_background(course_id, quiz_ids, percent_user_map, attempt=1):
+    """
+    Retry extensions for quizzes that failed in an earlier job.
+
+    Quizzes that still fail are retried again until
+    `config.QUIZ_RETRY_ATTEMPTS` attempts have been made. See
+    `retry_failed_quizzes` for the wait between attempts.
+
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param quiz_ids: The Canvas IDs of the quizzes to retry.
+    :type quiz_ids: list
+    :param percent_user_map: A dictionary mapping each percent of time
+        to the list of Canvas user IDs that should get it.
+    :type percent_user_map: dict
+    :param attempt: The number of this attempt, starting from 1.
+    :type attempt: int
+    :rtype: dict
+    :returns: The job's meta, with lists of the updated, unchanged and
+        failed quizzes.
+    """
+    job = get_current_job()
+
+    update_job(job, 0, 'Retrying {} quizzes.'.format(len(quiz_ids)), 'started')
+
+    with app.app_context():
+        course, created = get_or_create(db.session, Course, canvas_id=course_id)
+
+        try:
+            quizzes = [quiz for quiz in get_quizzes(course_id) if quiz.get('id') in quiz_ids]
+        except requests.exceptions.HTTPError:
+            update_job(
+                job,
+                0,
+                'Unable to get quizzes from Canvas.',
+                'failed',
+                error=True,
+                retryable=True
+            )
+            logger.exception('Unable to get quizzes for course #{}'.format(course_id))
+            return job.meta
+
+        plan = plan_extensions(course_id, quizzes, percent_user_map)
+        quiz_time_list, unchanged_quiz_time_list, failed_quiz_list = extend_quizzes(
+            job,
+            course,
+            plan,
+            'Retrying quiz #{} - {} [{} of {}]'
+        )
+
+        msg = '{} quizzes have been updated.'.format(
+            len(plan.quizzes) - len(failed_quiz_list)
+        )
+        if attempt < config.QUIZ_RETRY_ATTEMPTS:
+            msg += retry_failed_quizzes(
+                job,
+                course_id,
+                failed_quiz_list,
+                percent_user_map,
+                attempt + 1
+            )
+        elif failed_quiz_list:
+            msg += ' {} quizzes could not be updated.'.format(len(failed_quiz_list))
+            logger.error('Giving up on quizzes in course #{}: {}'.format(
+                course_id,
+                failed_quiz_list
+            ))
+
         update_job(job, 100, msg, 'complete', error=False)
+        job.meta['quiz_list'] = quiz_time_list
+        job.meta['unchanged_list'] = unchanged_quiz_time_list
+        job.meta['failed_list'] = failed_quiz_list
+        job.save()
+        clear_checkpoint(job)
         return job.meta
 
 
+def extend_quizzes(job, course, plan, status_str):
+    """
+    Carry out an extension plan and record the quizzes.
+
+    Stops at the first quiz that can't be extended, unless
+    `config.CONTINUE_ON_QUIZ_FAILURE` is set, in which case the failure
+    is recorded and the remaining quizzes are still extended. If the
+    job's deadline runs out, the quizzes left are recorded as failed.
+
+    :param job: The job being run, used to report progress.
+    :type job: :class:`rq.job.Job`
+    :param course: The Course the quizzes belong to.
+    :type course: :class:`models.Course`
+    :param plan: The extensions to post, from `plan_extensions`.
+    :type plan: :class:`utils.ExtensionPlan`
+    :param status_str: The progress message for each quiz. Formatted
+        with the quiz's ID and title, its position, and the number of
+        quizzes.
+    :type status_str: str
+    :rtype: tuple
+    :returns: Three lists of dictionaries: the time added to each quiz,
+        the quizzes with no time limit, and the quizzes that failed.
+    """
+    num_quizzes = len(plan.steps)
+    quiz_time_list = []
+    unchanged_quiz_time_list = []
+    failed_quiz_list = []
+
+    checkpoint = get_checkpoint(job)
+
+    for index, (quiz, operations) in enumerate(plan.steps):
+        quiz_id = quiz.get('id', None)
+        quiz_title = quiz.get('title', '[UNTITLED QUIZ]')
+
+        comp_perc = int(((float(index)) / float(num_quizzes)) * 100)
+        update_job(
+            job,
+            comp_perc,
+            status_str.format(quiz_id, quiz_title, index + 1, num_quizzes),
+            'processing',
+            error=False
+        )
+
+        # Don't post the same extension again if this job is resumed.
+        steps = ['quiz:{}:{}'.format(quiz_id, operation.percent) for operation in operations]
+        responses = [checkpoint.get(step) for step in steps]
+        pending = [
+            (step, operation)
+            for step, operation, response in zip(steps, operations, responses)
+            if response is None
+        ]
+
+        if pending:
+            # Every user is posted in one go, whatever their extra time.
+            try:
+                executed = execute_operations(
+                    course.canvas_id,
+                    [operation for step, operation in pending]
+                )
+            except DeadlineExceeded:
+                # Report this quiz and the rest as skipped rather than
+                # failing the whole job without saying which were done.
+                skipped_quizzes = plan.quizzes[index:]
+                logger.warning('Job {} ran out of time. Skipping {} quizzes.'.format(
+                    job.get_id(),
+                    len(skipped_quizzes)
+                ))
+                for skipped_quiz in skipped_quizzes:
+                    failed_quiz_list.append({
+                        'id': skipped_quiz.get('id', None),
+                        'title': skipped_quiz.get('title', '[UNTITLED QUIZ]'),
+                        'message': 'Ran out of time before this quiz could be updated.'
+                    })
+                return quiz_time_list, unchanged_quiz_time_list, failed_quiz_list
+
+            executed = dict(zip([step for step, operation in pending], executed))
+            for step, extension_response in executed.items():
+                if extension_response.get('success', False) is True:
+                    save_checkpoint(job, step, extension_response)
+            responses = [executed.get(step, response) for step, response in zip(steps, responses)]
+
+        added_times = []
+        for extension_response in responses:
+            if extension_response.get('success', False) is not True:
+                break
+            added_times.append(extension_response.get('added_time', None))
+        else:
+            # add/update quiz
+            quiz_obj, created = get_or_create(
+                db.session,
+                Quiz,
+                canvas_id=quiz_id,
+                course_id=course.id
+            )
+            quiz_obj.title = quiz_title
+            quiz_obj.time_limit = quiz.get('time_limit')
+            quiz_obj.content_hash = quiz_hash(quiz)
+
+            db.session.commit()
+
+            for added_time in added_times:
+                if added_time is not None:
+                    quiz_time_list.append({
+                        "title": quiz_title,
+                        "added_time": added_time
+                    })
+            if all(added_time is None for added_time in added_times):
+                unchanged_quiz_time_list.append({"title": quiz_title})
+            continue
+
+        logger.error("Extension failed: {}".format(extension_response))
+        failed_quiz_list.append({
+            'id': quiz_id,
+            'title': quiz_title,
+            'message': extension_response.get(
+                'message',
+                'An unknown error occured.'
+            )
+        })
+        if not config.CONTINUE_ON_QUIZ_FAILURE:
+            break
+
+    return quiz_time_list, unchanged_quiz_time_list, failed_quiz_list
+
+
+def apply_accommodations(job, course_id, percent_user_map, force=False):
+    """
+    Give students their percent of time on every New Quiz in a course,
+    if `config.NEW_QUIZZES_ACCOMMODATIONS` is set and the course uses
+    New Quizzes. The results are also saved in the job's meta.
+
+    :param job: The job being run.
+    :type job: :class:`rq.job.Job`
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param percent_user_map: A dictionary mapping each percent of time
+        to the list of Canvas user IDs that should get it.
+    :type percent_user_map: dict
+    :param force: Post every accommodation, even if it was already given.
+    :type force: bool
+    :rtype: list
+    :returns: The result of `accommodate_students` for each percent,
+        with the percent, or None if New Quizzes weren't updated.
+    :raises requests.exceptions.HTTPError: If Canvas could not return
+        the course's New Quizzes.
+    """
+    if not config.NEW_QUIZZES_ACCOMMODATIONS or not uses_new_quizzes(course_id):
+        return None
+
+    update_job(job, 0, 'Updating New Quizzes.', 'processing', False)
+    new_quizzes = get_new_quizzes(course_id)
+    accommodations = [
+        dict(
+            accommodate_students(
+                course_id,
+                percent,
+                user_ids,
+                force=force,
+                new_quizzes=new_quizzes
+            ),
+            percent=percent
+        )
+        for percent, user_ids in percent_user_map.items()
+    ]
+    job.meta['accommodations'] = accommodations
+    return accommodations
+
+
+def accommodation_message(accommodation):
+    """
+    :param accommodation: The result of `accommodate_students`, with
+        the percent of time given.
+    :type accommodation: dict
+    :rtype: str
+    :returns: A sentence describing the New Quizzes accommodations, to
+        add to a job's status message.
+    """
+    if accommodation['added_time'] is None:
+        return ' New Quizzes have no time limit and were left unchanged.'
+
+    msg = ' New Quizzes have been updated for {} student(s) to have {}% time ({} extra minutes).'
+    msg = msg.format(
+        len(accommodation['accommodated']) + len(accommodation['unchanged']),
+        accommodation['percent'],
+        accommodation['added_time']
+    )
+    if accommodation['failed']:
+        msg += ' Unable to update New Quizzes for {} student(s).'.format(
+            len(accommodation['failed'])
+        )
+    return msg
+
+
+def skipped_message(skipped):
+    """
+    :param skipped: The quizzes left out of a plan by the quiz filters.
+    :type skipped: list
+    :rtype: str
+    :returns: A sentence counting the skipped quizzes, to add to a job's
+        status message, or an empty string if none were skipped.
+    """
+    if not skipped:
+        return ''
+
+    reasons = defaultdict(int)
+    for quiz in skipped:
+        reasons[quiz['reason']] += 1
+
+    return ' {} {} skipped ({}).'.format(
+        len(skipped),
+        'quizzes were' if len(skipped) != 1 else 'quiz was',
+        ', '.join('{} {}'.format(count, reason) for reason, count in sorted(reasons.items()))
+    )
+
+
+def retry_failed_quizzes(job, course_id, failed_quiz_list, percent_user_map, attempt=1):
+    """
+    Queue a job that retries only the quizzes that failed.
+
+    The job is held back, without taking up a worker, for
+    `config.QUIZ_RETRY_BACKOFF` seconds, doubling with each attempt.
+
+    :param job: The job that the quizzes failed in.
+    :type job: :class:`rq.job.Job`
+    :param course_id: The Canvas ID of the Course.
+    :type course_id: int
+    :param failed_quiz_list: The failed quizzes, as returned by
+        `extend_quizzes`.
+    :type failed_quiz_list: list
+    :param percent_user_map: A dictionary mapping each percent of time
+        to the list of Canvas user IDs that should get it.
+    :type percent_user_map: dict
+    :param attempt: The number of the retry attempt to queue.
+    :type attempt: int
+    :rtype: str
+    :returns: A message to add to the job's status, or an empty string
+        if there was nothing to retry.
+    """
+    if not failed_quiz_list:
+        return ''
+
+    delay = min(
+        config.QUIZ_RETRY_BACKOFF * 2 ** (attempt - 1),
+        config.QUIZ_RETRY_MAX_BACKOFF
+    )
+    retry_job, = enqueue_fair(
+        Queue(job.origin, connection=job.connection),
+        job.meta.get('fair_key') or fair_key(course_id),
+        [(
+            retry_background,
+            (
+                course_id,
+                [quiz['id'] for quiz in failed_quiz_list],
+                percent_user_map,
+                attempt
+            )
+        )],
+        delay=delay
+    )
+    if delay > 0:
+        update_job(
+            retry_job,
+            0,
+            'Retrying {} quizzes in {} seconds.'.format(len(failed_quiz_list), delay),
+            'queued'
+        )
+    job.meta['retry_job_key'] = retry_job.get_id()
+
+    return ' {} quizzes couldn\'t be updated and will be retried.'.format(
+        len(failed_quiz_list)
+    )
+
+
 @app.route("/missing_quizzes/<course_id>/", methods=['GET'])
 def missing_quizzes_check(course_id):
     """
-    Check if there are missing quizzes.
+    Check if there are missing quizzes, or quizzes whose time limit has
+    changed.
 
     :param course_id: The Canvas ID of the Course.
     :type course_id: int
     :rtype: str
     :returns: A JSON-formatted string representation of a boolean.
-        "true" if there are missing quizzes, "false" if there are not.
+        "true" if there are quizzes to refresh, "false" if there are not.
     """
     course = Course.query.filter_by(canvas_id=course_id).first()
     if course is None:
@@ -726,7 +2608,11 @@ def missing_quizzes_check(course_id):
         # There are no extensions for this course yet. No need to update.
         return 'false'
 
-    missing = len(missing_quizzes(course_id, True)) > 0
+    try:
+        missing = len(missing_quizzes(course_id, True, changed=True, filtered=True)) > 0
+    except requests.exceptions.HTTPError:
+        logger.exception('Unable to check for missing quizzes in course #{}'.format(course_id))
+        missing = False
     return json.dumps(missing)
 
 